@@ -1,9 +1,10 @@
+import asyncio
 import logging
 import ecdsa
 import socket
 
 from hashlib import sha256
-from typing import List, Tuple, Type
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Type
 
 from protocol import *
 
@@ -37,12 +38,146 @@ class User:
         return self.auth_token.userid
 
 
+def _no_result(reply: ReplyMessage):
+    return None
+
+
+class Call(NamedTuple):
+    """
+    A request, and how to check and decode its reply into the result of the
+    client method. Client and AsyncClient perform the same calls, only over
+    blocking sockets and asyncio respectively.
+    """
+    req: RequestMessage
+    reply_cls: Optional[Type[DataType]] = None
+    check: bool = True
+    result: Callable[[ReplyMessage], Any] = _no_result
+
+
+class _Calls:
+    """
+    Builders of the calls of each client method, on behalf of a user.
+    """
+
+    @staticmethod
+    def echo(user: User, data: bytes) -> Call:
+        def result(reply: ReplyMessage):
+            if reply.reply.data != data:
+                raise ClientException(
+                    f'Mismatched echo reply: {reply.reply.data} vs {data}')
+        req = RequestMessage(REQUEST_KIND_ECHO, EchoRequest(data))
+        return Call(req, EchoReply, result=result)
+
+    @staticmethod
+    def register(user: User, exist_ok: bool) -> Call:
+        def result(reply: ReplyMessage):
+            if reply.status != REPLY_STATUS_OK:
+                if not exist_ok or reply.reply != b'User exists':
+                    raise ClientException(f'Failure reply: {reply}')
+        req = RequestMessage(REQUEST_KIND_REGISTER, RegisterRequest(
+            user.username, user.password, user.pubkey))
+        return Call(req, check=False, result=result)
+
+    @staticmethod
+    def auth(user: User) -> Call:
+        def result(reply: ReplyMessage):
+            user.auth_token = reply.reply.token
+        req = RequestMessage(REQUEST_KIND_AUTH, AuthRequest(
+            user.username, user.password))
+        return Call(req, AuthReply, result=result)
+
+    @staticmethod
+    def get_userid(user: User, username: str) -> Call:
+        req = RequestMessage(REQUEST_KIND_USERID, UseridRequest(
+            user.auth_token, username))
+        return Call(req, UseridReply, result=lambda reply: reply.reply.userid)
+
+    @staticmethod
+    def get_username(user: User, userid: int) -> Call:
+        req = RequestMessage(REQUEST_KIND_USERNAME, UsernameRequest(
+            user.auth_token, userid))
+        return Call(req, UsernameReply, result=lambda reply: reply.reply.username)
+
+    @staticmethod
+    def get_pubkey(user: User, userid: int) -> Call:
+        req = RequestMessage(REQUEST_KIND_PUBKEY, PubkeyRequest(
+            user.auth_token, userid))
+        return Call(req, PubkeyReply, result=lambda reply: reply.reply.pubkey)
+
+    @staticmethod
+    def chat_send(user: User, userid: int, content: str) -> Call:
+        return Call(RequestMessage(REQUEST_KIND_CHAT_SEND, ChatSendRequest(
+            user.auth_token, userid, content)))
+
+    @staticmethod
+    def chat_read(user: User) -> Call:
+        def result(reply: ReplyMessage):
+            if reply.status != REPLY_STATUS_OK:
+                if reply.reply != b'No messages':
+                    raise ClientException(f'Failure reply: {reply}')
+                return None, None, None
+            return reply.reply.sender_userid, reply.reply.timestamp, reply.reply.content
+        req = RequestMessage(REQUEST_KIND_CHAT_READ, ChatReadRequest(
+            user.auth_token))
+        return Call(req, ChatReadReply, check=False, result=result)
+
+    @staticmethod
+    def chat_read_many(user: User, count: int) -> Call:
+        def result(reply: ReplyMessage):
+            return [(msg.sender_userid, msg.timestamp, msg.content)
+                    for msg in reply.reply.messages]
+        req = RequestMessage(REQUEST_KIND_CHAT_READ_MANY, ChatReadManyRequest(
+            user.auth_token, count))
+        return Call(req, ChatReadManyReply, result=result)
+
+    @staticmethod
+    def get_balance(user: User, currency: int) -> Call:
+        req = RequestMessage(REQUEST_KIND_BALANCE, BalanceRequest(
+            user.auth_token, currency))
+        return Call(req, BalanceReply, result=lambda reply: reply.reply.balance)
+
+    @staticmethod
+    def transfer(user: User, userid: int, currency: int, amount: int) -> Call:
+        req = RequestMessage(REQUEST_KIND_TRANSFER, TransferRequest(
+            user.auth_token, amount, currency, userid))
+        return Call(req, TransferReply, result=lambda reply: reply.reply.receipt)
+
+    @staticmethod
+    def receive(user: User, receipt: TransferReceipt) -> Call:
+        return Call(RequestMessage(REQUEST_KIND_RECEIVE, ReceiveRequest(
+            user.auth_token, receipt)))
+
+    @staticmethod
+    def mint(user: User, amount: int) -> Call:
+        req = RequestMessage(REQUEST_KIND_MINT, MintRequest(
+            user.auth_token, amount))
+        return Call(req, MintReply, result=lambda reply: reply.reply.currency)
+
+    @staticmethod
+    def check_receipt(user: User, receipt: TransferReceipt) -> Call:
+        return Call(RequestMessage(REQUEST_KIND_CHECK_RECEIPT, CheckReceiptRequest(
+            user.auth_token, receipt)))
+
+    @staticmethod
+    def new_backup(user: User, data: bytes) -> Call:
+        req = RequestMessage(REQUEST_KIND_NEW_BACKUP, NewBackupRequest(
+            user.auth_token, data))
+        return Call(req, NewBackupReply, result=lambda reply: reply.reply.id)
+
+    @staticmethod
+    def get_backup(user: User, id: str) -> Call:
+        req = RequestMessage(REQUEST_KIND_GET_BACKUP, GetBackupRequest(
+            user.auth_token, id))
+        return Call(req, GetBackupReply, result=lambda reply: reply.reply.data)
+
+
 class Client:
     def __init__(self, user: User = None, timeout: float = 10.0):
         self.user = user
         self._timeout = timeout
         self._sock = None
         self._seq = 0
+        self._pending = {}
 
     def connect(self, host: str, port: int):
         self._sock = socket.create_connection(
@@ -51,117 +186,127 @@ class Client:
     def close(self):
         self._sock.close()
         self._sock = None
+        self._pending.clear()
 
     @property
     def connected(self):
         return self._sock is not None
 
     def echo(self, data: bytes):
-        req = RequestMessage(REQUEST_KIND_ECHO, EchoRequest(data))
-        reply = self._request(req, EchoReply).reply
-        if reply.data != data:
-            raise ClientException(
-                f'Mismatched echo reply: {reply.data} vs {data}')
+        return self._call(_Calls.echo(self.user, data))
 
     def register(self, exist_ok: bool = False):
-        req = RequestMessage(REQUEST_KIND_REGISTER, RegisterRequest(
-            self.user.username, self.user.password, self.user.pubkey))
-        reply = self._request(req, check=False)
-        if reply.status != REPLY_STATUS_OK:
-            if not exist_ok or reply.reply != b'User exists':
-                raise ClientException(f'Failure reply: {reply}')
+        return self._call(_Calls.register(self.user, exist_ok))
 
     def auth(self):
-        req = RequestMessage(REQUEST_KIND_AUTH, AuthRequest(
-            self.user.username, self.user.password))
-        reply = self._request(req, AuthReply).reply
-        self.user.auth_token = reply.token
+        return self._call(_Calls.auth(self.user))
 
     def get_userid(self, username: str) -> int:
-        req = RequestMessage(REQUEST_KIND_USERID, UseridRequest(
-            self.user.auth_token, username))
-        reply = self._request(req, UseridReply).reply
-        return reply.userid
+        return self._call(_Calls.get_userid(self.user, username))
 
     def get_username(self, userid: int) -> str:
-        req = RequestMessage(REQUEST_KIND_USERNAME, UsernameRequest(
-            self.user.auth_token, userid))
-        reply = self._request(req, UsernameReply).reply
-        return reply.username
+        return self._call(_Calls.get_username(self.user, userid))
 
     def get_pubkey(self, userid: int) -> str:
-        req = RequestMessage(REQUEST_KIND_PUBKEY, PubkeyRequest(
-            self.user.auth_token, userid))
-        reply = self._request(req, PubkeyReply).reply
-        return reply.pubkey
+        return self._call(_Calls.get_pubkey(self.user, userid))
 
     def chat_send(self, userid: int, content: str):
-        req = RequestMessage(REQUEST_KIND_CHAT_SEND, ChatSendRequest(
-            self.user.auth_token, userid, content))
-        self._request(req)
+        return self._call(_Calls.chat_send(self.user, userid, content))
 
     def chat_read(self) -> Tuple[Optional[int], Optional[int], Optional[str]]:
-        req = RequestMessage(REQUEST_KIND_CHAT_READ, ChatReadRequest(
-            self.user.auth_token))
-        reply = self._request(req, ChatReadReply, check=False)
-        if reply.status != REPLY_STATUS_OK:
-            if reply.reply != b'No messages':
-                raise ClientException(f'Failure reply: {reply}')
-            return None, None, None
-        return reply.reply.sender_userid, reply.reply.timestamp, reply.reply.content
+        return self._call(_Calls.chat_read(self.user))
+
+    def chat_read_many(self, count: int) -> List[Tuple[int, int, str]]:
+        return self._call(_Calls.chat_read_many(self.user, count))
 
     def get_balance(self, currency: int) -> int:
-        req = RequestMessage(REQUEST_KIND_BALANCE, BalanceRequest(
-            self.user.auth_token, currency))
-        reply = self._request(req, BalanceReply).reply
-        return reply.balance
+        return self._call(_Calls.get_balance(self.user, currency))
 
     def transfer(self, userid: int, currency: int, amount: int) -> TransferReceipt:
-        req = RequestMessage(REQUEST_KIND_TRANSFER, TransferRequest(
-            self.user.auth_token, amount, currency, userid))
-        reply = self._request(req, TransferReply).reply
-        return reply.receipt
+        return self._call(_Calls.transfer(self.user, userid, currency, amount))
 
     def receive(self, receipt: TransferReceipt):
-        req = RequestMessage(REQUEST_KIND_RECEIVE, ReceiveRequest(
-            self.user.auth_token, receipt))
-        self._request(req)
+        return self._call(_Calls.receive(self.user, receipt))
 
     def mint(self, amount: int) -> int:
-        req = RequestMessage(REQUEST_KIND_MINT, MintRequest(
-            self.user.auth_token, amount))
-        reply = self._request(req, MintReply).reply
-        return reply.currency
+        return self._call(_Calls.mint(self.user, amount))
 
     def check_receipt(self, receipt: TransferReceipt):
-        req = RequestMessage(REQUEST_KIND_CHECK_RECEIPT, CheckReceiptRequest(
-            self.user.auth_token, receipt))
-        self._request(req)
+        return self._call(_Calls.check_receipt(self.user, receipt))
 
     def new_backup(self, data: bytes = bytes()) -> str:
-        req = RequestMessage(REQUEST_KIND_NEW_BACKUP, NewBackupRequest(
-            self.user.auth_token, data))
-        reply = self._request(req, NewBackupReply).reply
-        return reply.id
+        return self._call(_Calls.new_backup(self.user, data))
 
     def get_backup(self, id: str) -> str:
-        req = RequestMessage(REQUEST_KIND_GET_BACKUP, GetBackupRequest(
-            self.user.auth_token, id))
-        reply = self._request(req, GetBackupReply).reply
-        return reply.data
+        return self._call(_Calls.get_backup(self.user, id))
+
+    def submit(self, req: RequestMessage, reply_cls: Type[DataType] = None) -> int:
+        """
+        Sends a request without waiting for its reply, and returns its sequence
+        number. Replies are received with collect(), in completion order.
+        """
+        seq = self._send(req)
+        self._pending[seq] = reply_cls
+        return seq
+
+    def collect(self, check=True) -> Tuple[int, ReplyMessage]:
+        reply_hdr = MessageHeader.dt_decode(self._recvn(MessageHeader.SIZE))
+        try:
+            reply_cls = self._pending.pop(reply_hdr.seq)
+        except KeyError:
+            raise ClientException(
+                f'Unexpected sequence number: {reply_hdr.seq}')
+        reply_data = self._recvn(reply_hdr.length)
+        reply = ReplyMessage.dt_decode(reply_data, reply_cls)
 
-    def _request(self, req: RequestMessage, reply_cls: Type[DataType] = None,
-                 check=True) -> ReplyMessage:
+        if check and reply.status != REPLY_STATUS_OK:
+            raise ClientException(f'Failure reply: {reply}')
+
+        return reply_hdr.seq, reply
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    def request_many(self, reqs: Iterable[RequestMessage], reply_cls: Type[DataType] = None,
+                     depth: int = 16, check=True) -> List[ReplyMessage]:
+        """
+        Performs requests keeping up to depth of them in flight, and returns
+        the replies in request order.
+        """
+        seqs = []
+        replies = {}
+        for req in reqs:
+            if self.in_flight >= depth:
+                seq, reply = self.collect(check)
+                replies[seq] = reply
+            seqs.append(self.submit(req, reply_cls))
+        while self.in_flight > 0:
+            seq, reply = self.collect(check)
+            replies[seq] = reply
+        return [replies[seq] for seq in seqs]
+
+    def _send(self, req: RequestMessage) -> int:
         req_data = req.dt_encode()
         hdr = MessageHeader(self._seq, len(req_data))
         self._seq += 1
-        msg = hdr.dt_encode() + req_data
-        self._sock.sendall(msg)
+        self._sock.sendall(hdr.dt_encode() + req_data)
+        return hdr.seq
+
+    def _call(self, call: Call) -> Any:
+        return call.result(self._request(call.req, call.reply_cls, call.check))
+
+    def _request(self, req: RequestMessage, reply_cls: Type[DataType] = None,
+                 check=True) -> ReplyMessage:
+        if self.in_flight > 0:
+            raise ClientException('Pipelined requests in flight')
+
+        seq = self._send(req)
 
         reply_hdr = MessageHeader.dt_decode(self._recvn(MessageHeader.SIZE))
-        if reply_hdr.seq != hdr.seq:
+        if reply_hdr.seq != seq:
             raise ClientException(
-                f'Incorrect sequence number: {reply_hdr.seq} vs {hdr.seq}')
+                f'Incorrect sequence number: {reply_hdr.seq} vs {seq}')
         reply_data = self._recvn(reply_hdr.length)
         reply = ReplyMessage.dt_decode(reply_data, reply_cls)
 
@@ -173,5 +318,234 @@ class Client:
     def _recvn(self, size: int) -> bytes:
         data = b''
         while len(data) < size:
-            data += self._sock.recv(size - len(data))
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                raise ClientException('Connection closed')
+            data += chunk
         return data
+
+
+class AsyncConnection:
+    """
+    Connection on asyncio streams, on which any number of coroutines can
+    have requests in flight. Replies are matched to their requests by
+    sequence number as they arrive, by a reader task. Note that the server
+    only handles as many requests per connection concurrently as its
+    pipeline depth allows, and the others wait behind them: in particular,
+    a chat read on an empty queue holds its slot for a few seconds.
+    """
+
+    def __init__(self, timeout: float = 10.0):
+        self._timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._seq = 0
+        self._pending: Dict[int, Tuple[asyncio.Future, Type[DataType]]] = {}
+        self._error = None
+
+    async def connect(self, host: str, port: int):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), self._timeout)
+        self._reader_task = asyncio.create_task(self._read_replies())
+
+    async def close(self):
+        if self._writer is None:
+            return
+        writer = self._writer
+        self._reader_task.cancel()
+        writer.close()
+        self._writer = None
+        self._fail_pending(ClientException('Connection closed'))
+        try:
+            await writer.wait_closed()
+        except OSError:
+            # Already reset by the server.
+            pass
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and self._error is None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    async def request(self, req: RequestMessage, reply_cls: Type[DataType] = None,
+                      check=True) -> ReplyMessage:
+        if not self.connected:
+            raise ClientException(f'Not connected: {self._error}')
+
+        seq = self._seq
+        self._seq = (self._seq + 1) & 0xffffffff
+        future = asyncio.get_running_loop().create_future()
+        self._pending[seq] = (future, reply_cls)
+
+        req_data = req.dt_encode()
+        try:
+            self._writer.write(
+                MessageHeader(seq, len(req_data)).dt_encode() + req_data)
+            await asyncio.wait_for(self._writer.drain(), self._timeout)
+            reply = await asyncio.wait_for(future, self._timeout)
+        finally:
+            self._pending.pop(seq, None)
+
+        if check and reply.status != REPLY_STATUS_OK:
+            raise ClientException(f'Failure reply: {reply}')
+
+        return reply
+
+    async def _read_replies(self):
+        try:
+            while True:
+                reply_hdr = MessageHeader.dt_decode(
+                    await self._reader.readexactly(MessageHeader.SIZE))
+                reply_data = await self._reader.readexactly(reply_hdr.length)
+                try:
+                    future, reply_cls = self._pending[reply_hdr.seq]
+                except KeyError:
+                    # Request timed out.
+                    continue
+                if not future.done():
+                    future.set_result(
+                        ReplyMessage.dt_decode(reply_data, reply_cls))
+        except Exception as e:
+            self._error = e
+            self._fail_pending(ClientException(f'Connection lost: {e}'))
+
+    def _fail_pending(self, exc: Exception):
+        for future, _ in self._pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+
+class ConnectionPool:
+    """
+    Fixed number of connections to the server, shared by any number of
+    AsyncClient instances. Each request goes to the connection with the
+    fewest requests in flight, and lost connections are replaced on use.
+    """
+
+    def __init__(self, host: str, port: int, size: int = 4, timeout: float = 10.0):
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._conns = [AsyncConnection(timeout) for _ in range(size)]
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        await asyncio.gather(*(conn.connect(self._host, self._port)
+                               for conn in self._conns))
+
+    async def close(self):
+        for conn in self._conns:
+            await conn.close()
+
+    @property
+    def in_flight(self) -> int:
+        return sum(conn.in_flight for conn in self._conns)
+
+    async def request(self, req: RequestMessage, reply_cls: Type[DataType] = None,
+                      check=True) -> ReplyMessage:
+        conn = min(self._conns, key=lambda conn: conn.in_flight)
+        if not conn.connected:
+            conn = await self._reconnect(conn)
+        return await conn.request(req, reply_cls, check)
+
+    async def _reconnect(self, conn: AsyncConnection) -> AsyncConnection:
+        async with self._lock:
+            i = self._conns.index(conn)
+            if self._conns[i] is conn:
+                await conn.close()
+                new_conn = AsyncConnection(self._timeout)
+                await new_conn.connect(self._host, self._port)
+                self._conns[i] = new_conn
+            return self._conns[i]
+
+
+class AsyncClient:
+    """
+    Asyncio counterpart of Client, acting as one user over a connection
+    pool. Many clients can share a pool, and each can have many requests in
+    flight, by awaiting them concurrently. A client connected by itself
+    owns a pool of one connection.
+    """
+
+    def __init__(self, user: User = None, pool: ConnectionPool = None,
+                 timeout: float = 10.0):
+        self.user = user
+        self._pool = pool
+        self._owns_pool = False
+        self._timeout = timeout
+
+    async def connect(self, host: str, port: int):
+        self._pool = ConnectionPool(host, port, 1, self._timeout)
+        self._owns_pool = True
+        await self._pool.connect()
+
+    async def close(self):
+        if self._owns_pool:
+            await self._pool.close()
+        self._pool = None
+
+    @property
+    def connected(self):
+        return self._pool is not None
+
+    async def echo(self, data: bytes):
+        return await self._call(_Calls.echo(self.user, data))
+
+    async def register(self, exist_ok: bool = False):
+        return await self._call(_Calls.register(self.user, exist_ok))
+
+    async def auth(self):
+        return await self._call(_Calls.auth(self.user))
+
+    async def get_userid(self, username: str) -> int:
+        return await self._call(_Calls.get_userid(self.user, username))
+
+    async def get_username(self, userid: int) -> str:
+        return await self._call(_Calls.get_username(self.user, userid))
+
+    async def get_pubkey(self, userid: int) -> str:
+        return await self._call(_Calls.get_pubkey(self.user, userid))
+
+    async def chat_send(self, userid: int, content: str):
+        return await self._call(_Calls.chat_send(self.user, userid, content))
+
+    async def chat_read(self) -> Tuple[Optional[int], Optional[int], Optional[str]]:
+        return await self._call(_Calls.chat_read(self.user))
+
+    async def chat_read_many(self, count: int) -> List[Tuple[int, int, str]]:
+        return await self._call(_Calls.chat_read_many(self.user, count))
+
+    async def get_balance(self, currency: int) -> int:
+        return await self._call(_Calls.get_balance(self.user, currency))
+
+    async def transfer(self, userid: int, currency: int, amount: int) -> TransferReceipt:
+        return await self._call(_Calls.transfer(self.user, userid, currency, amount))
+
+    async def receive(self, receipt: TransferReceipt):
+        return await self._call(_Calls.receive(self.user, receipt))
+
+    async def mint(self, amount: int) -> int:
+        return await self._call(_Calls.mint(self.user, amount))
+
+    async def check_receipt(self, receipt: TransferReceipt):
+        return await self._call(_Calls.check_receipt(self.user, receipt))
+
+    async def new_backup(self, data: bytes = bytes()) -> str:
+        return await self._call(_Calls.new_backup(self.user, data))
+
+    async def get_backup(self, id: str) -> str:
+        return await self._call(_Calls.get_backup(self.user, id))
+
+    async def _call(self, call: Call) -> Any:
+        return call.result(
+            await self._request(call.req, call.reply_cls, call.check))
+
+    async def _request(self, req: RequestMessage, reply_cls: Type[DataType] = None,
+                       check=True) -> ReplyMessage:
+        if self._pool is None:
+            raise ClientException('Not connected')
+        return await self._pool.request(req, reply_cls, check)
@@ -1,9 +1,10 @@
 import abc
 import struct
+import operator
 import functools
 import dataclasses
 
-from typing import Optional, Type, Union
+from typing import List, Optional, Tuple, Type, Union
 
 
 SIGNATURE_SIZE = 64
@@ -25,6 +26,7 @@ REQUEST_KIND_MINT = 0x0b
 REQUEST_KIND_CHECK_RECEIPT = 0x0c
 REQUEST_KIND_NEW_BACKUP = 0x0d
 REQUEST_KIND_GET_BACKUP = 0x0e
+REQUEST_KIND_CHAT_READ_MANY = 0x0f
 
 REPLY_STATUS_OK = 0x00
 REPLY_STATUS_FAIL = 0x01
@@ -35,6 +37,10 @@ class ProtocolException(Exception):
 
 
 class DataType(abc.ABC):
+    # Fixed-size wire format as a struct format string (without byte order),
+    # or None if the wire size depends on the value.
+    dt_struct_fmt: Optional[str] = None
+
     @abc.abstractmethod
     def dt_encode(self) -> bytes:
         pass
@@ -51,19 +57,35 @@ class DataType(abc.ABC):
     def dt_decode(bs: bytes) -> 'DataType':
         pass
 
+    @classmethod
+    def dt_decode_from(cls, buf: memoryview, offset: int) -> Tuple['DataType', int]:
+        value = cls.dt_decode(buf[offset:])
+        return value, offset + value.dt_wire_size
+
 
 def Integer(fmt: str):
+    packer = struct.Struct(fmt)
+
     class T(int, DataType):
+        dt_struct_fmt = fmt.lstrip('<')
+
         def dt_encode(self) -> bytes:
-            return struct.pack(fmt, self)
+            return packer.pack(self)
+
+        @property
+        def dt_wire_size(self):
+            return packer.size
 
         @staticmethod
         def dt_decode(bs: bytes) -> 'T':
-            size = len(struct.pack(fmt, 0))
-            if len(bs) < size:
+            return T.dt_decode_from(bs, 0)[0]
+
+        @classmethod
+        def dt_decode_from(cls, buf: memoryview, offset: int) -> Tuple['T', int]:
+            if len(buf) - offset < packer.size:
                 raise RuntimeError('Not enough data')
-            value, = struct.unpack(fmt, bs[:size])
-            return T(value)
+            value, = packer.unpack_from(buf, offset)
+            return T(value), offset + packer.size
 
     return T
 
@@ -74,8 +96,11 @@ Uint64 = Integer('<Q')
 Int64 = Integer('<q')
 
 
+@functools.lru_cache(maxsize=None)
 def RawBytes(size: int = None):
     class T(bytes, DataType):
+        dt_struct_fmt = f'{size}s' if size is not None else None
+
         def dt_encode(self) -> bytes:
             if size is not None and len(self) != size:
                 raise ProtocolException('Incorrect size')
@@ -89,32 +114,160 @@ def RawBytes(size: int = None):
                 bs = bs[:size]
             return T(bs)
 
+        @classmethod
+        def dt_decode_from(cls, buf: memoryview, offset: int) -> Tuple['T', int]:
+            end = len(buf) if size is None else offset + size
+            if end > len(buf):
+                raise ProtocolException('Not enough data')
+            return T(buf[offset:end]), end
+
     return T
 
 
+_length = struct.Struct('<I')
+
+
 class Bytes(bytes, DataType):
     def dt_encode(self) -> bytes:
-        return Uint32(len(self)).dt_encode() + self
+        return _length.pack(len(self)) + self
+
+    @property
+    def dt_wire_size(self):
+        return _length.size + len(self)
 
     @staticmethod
     def dt_decode(bs: bytes) -> 'Bytes':
-        length = Uint32.dt_decode(bs)
-        bs = bs[length.dt_wire_size:]
-        if length > len(bs):
+        return Bytes.dt_decode_from(memoryview(bs), 0)[0]
+
+    @classmethod
+    def dt_decode_from(cls, buf: memoryview, offset: int) -> Tuple['Bytes', int]:
+        if len(buf) - offset < _length.size:
+            raise RuntimeError('Not enough data')
+        length, = _length.unpack_from(buf, offset)
+        start = offset + _length.size
+        end = start + length
+        if end > len(buf):
             raise ProtocolException('Not enough data')
-        return Bytes(bs[:length])
+        return Bytes(buf[start:end]), end
 
 
 class String(str, DataType):
     def dt_encode(self) -> bytes:
-        return Bytes(self.encode()).dt_encode()
+        bs = self.encode()
+        return _length.pack(len(bs)) + bs
+
+    @property
+    def dt_wire_size(self):
+        return _length.size + len(self.encode())
 
     @staticmethod
     def dt_decode(bs: bytes) -> 'String':
-        bs = Bytes.dt_decode(bs)
-        if any(b == 0x00 or b > 0x7f for b in bs):
+        return String.dt_decode_from(memoryview(bs), 0)[0]
+
+    @classmethod
+    def dt_decode_from(cls, buf: memoryview, offset: int) -> Tuple['String', int]:
+        bs, end = Bytes.dt_decode_from(buf, offset)
+        if not bs.isascii() or 0x00 in bs:
             raise ProtocolException('Invalid characters in string')
-        return String(bs.decode())
+        return String(bs.decode()), end
+
+
+@functools.lru_cache(maxsize=None)
+def Array(item_type: Type[DataType]):
+    class T(list, DataType):
+        def dt_encode(self) -> bytes:
+            return _length.pack(len(self)) + b''.join(
+                item.dt_encode() for item in self)
+
+        def dt_validate(self):
+            for item in self:
+                item.dt_validate()
+
+        @staticmethod
+        def dt_decode(bs: bytes) -> 'T':
+            return T.dt_decode_from(memoryview(bs), 0)[0]
+
+        @classmethod
+        def dt_decode_from(cls, buf: memoryview, offset: int) -> Tuple['T', int]:
+            if len(buf) - offset < _length.size:
+                raise ProtocolException('Not enough data')
+            count, = _length.unpack_from(buf, offset)
+            offset += _length.size
+            items = T()
+            for _ in range(count):
+                item, offset = item_type.dt_decode_from(buf, offset)
+                items.append(item)
+            return items, offset
+
+    return T
+
+
+class _StructCodec:
+    """
+    Wire codec for a Struct, compiled once from its fields. Runs of fixed-size
+    fields are fused into a single struct.Struct, variable-size fields are
+    encoded one by one and decoded in place at an offset into the buffer.
+    """
+
+    def __init__(self, fields: Tuple[dataclasses.Field, ...]):
+        # Steps are (packer, getter, sized, types) for runs of fixed-size
+        # fields, and (None, getter, None, type) for variable-size fields.
+        self._steps = []
+        run = []
+        for field in fields:
+            if field.type.dt_struct_fmt is not None:
+                run.append(field)
+                continue
+            self._add_run(run)
+            run = []
+            self._steps.append(
+                (None, operator.attrgetter(field.name), None, field.type))
+        self._add_run(run)
+
+    def _add_run(self, run: List[dataclasses.Field]):
+        if not run:
+            return
+        packer = struct.Struct(
+            '<' + ''.join(field.type.dt_struct_fmt for field in run))
+        if len(run) == 1:
+            name = run[0].name
+
+            def getter(st):
+                return (getattr(st, name),)
+        else:
+            getter = operator.attrgetter(*(field.name for field in run))
+        # struct silently pads or truncates "s" fields, so check sizes here.
+        sized = [(i, struct.calcsize(field.type.dt_struct_fmt))
+                 for i, field in enumerate(run) if issubclass(field.type, bytes)]
+        types = [field.type for field in run]
+        self._steps.append((packer, getter, sized, types))
+
+    def encode(self, st: DataType) -> bytes:
+        parts = []
+        for packer, getter, sized, _ in self._steps:
+            if packer is None:
+                parts.append(getter(st).dt_encode())
+                continue
+            values = getter(st)
+            for i, size in sized:
+                if len(values[i]) != size:
+                    raise ProtocolException('Incorrect size')
+            parts.append(packer.pack(*values))
+        return b''.join(parts)
+
+    def decode(self, buf: memoryview, offset: int) -> Tuple[List[DataType], int]:
+        values = []
+        for packer, _, _, types in self._steps:
+            if packer is None:
+                value, offset = types.dt_decode_from(buf, offset)
+                values.append(value)
+                continue
+            if len(buf) - offset < packer.size:
+                raise ProtocolException('Not enough data')
+            raw = packer.unpack_from(buf, offset)
+            values.extend([t(v) for t, v in zip(types, raw)])
+            offset += packer.size
+        return values, offset
 
 
 def Struct(cls):
@@ -122,33 +275,37 @@ def Struct(cls):
     class T(dataclasses.dataclass(cls), DataType):
         def __init__(self, *args, **kwargs):
             super().__init__(*args, **kwargs)
-            for field in dataclasses.fields(T):
+            for field in fields:
                 value = getattr(self, field.name)
                 if not isinstance(value, field.type):
                     setattr(self, field.name, field.type(value))
 
         def dt_encode(self) -> bytes:
-            bs = b''
-            for field in dataclasses.fields(T):
-                value = getattr(self, field.name)
-                bs += value.dt_encode()
-            return bs
+            return codec.encode(self)
 
         def dt_validate(self):
-            for field in dataclasses.fields(T):
-                getattr(self, field.name).dt_validate()
+            for name in validated:
+                getattr(self, name).dt_validate()
             super().dt_validate()
 
         @staticmethod
         def dt_decode(bs: bytes) -> 'T':
-            values = {}
-            for field in dataclasses.fields(T):
-                value = field.type.dt_decode(bs)
-                values[field.name] = value
-                bs = bs[value.dt_wire_size:]
-            st = T(**values)
+            return T.dt_decode_from(memoryview(bs), 0)[0]
+
+        @classmethod
+        def dt_decode_from(cls, buf: memoryview, offset: int) -> Tuple['T', int]:
+            values, offset = codec.decode(buf, offset)
+            # Decoded values already have the right types, skip conversion.
+            st = T.__new__(T)
+            dataclass_init(st, *values)
             st.dt_validate()
-            return st
+            return st, offset
+
+    fields = dataclasses.fields(T)
+    validated = [field.name for field in fields
+                 if field.type.dt_validate is not DataType.dt_validate]
+    codec = _StructCodec(fields)
+    dataclass_init = T.__bases__[0].__init__
 
     return T
 
@@ -186,13 +343,14 @@ class RequestMessage(DataType):
 
     @staticmethod
     def dt_decode(bs: bytes) -> 'RequestMessage':
-        kind = Uint8.dt_decode(bs)
-        bs = bs[kind.dt_wire_size:]
+        buf = memoryview(bs)
+        kind, offset = Uint8.dt_decode_from(buf, 0)
         try:
             cls = request_kind_map[kind]
         except KeyError:
             raise ProtocolException('Unknown request kind')
-        return RequestMessage(kind, cls.dt_decode(bs))
+        req, _ = cls.dt_decode_from(buf, offset)
+        return RequestMessage(kind, req)
 
 
 @dataclasses.dataclass
@@ -205,12 +363,12 @@ class ReplyMessage(DataType):
 
     @staticmethod
     def dt_decode(bs: bytes, reply_cls: Type[DataType] = None) -> 'ReplyMessage':
-        status = Uint8.dt_decode(bs)
-        bs = bs[status.dt_wire_size:]
+        buf = memoryview(bs)
+        status, offset = Uint8.dt_decode_from(buf, 0)
         if status == REPLY_STATUS_OK and reply_cls is not None:
-            reply = reply_cls.dt_decode(bs)
+            reply, _ = reply_cls.dt_decode_from(buf, offset)
         else:
-            reply = RawBytes().dt_decode(bs)
+            reply, _ = RawBytes().dt_decode_from(buf, offset)
         return ReplyMessage(status, reply)
 
     @staticmethod
@@ -325,6 +483,17 @@ class ChatReadReply:
     content: String
 
 
+@request_kind(REQUEST_KIND_CHAT_READ_MANY)
+@Struct
+class ChatReadManyRequest(Authenticated):
+    count: Uint32
+
+
+@Struct
+class ChatReadManyReply:
+    messages: Array(ChatReadReply)
+
+
 @request_kind(REQUEST_KIND_BALANCE)
 @Struct
 class BalanceRequest(Authenticated):
@@ -1,53 +1,251 @@
+import abc
+import asyncio
 import ecdsa
 import struct
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
-from typing import Optional
+from typing import Hashable, Optional, Tuple
 
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.asymmetric.utils import \
+        decode_dss_signature, encode_dss_signature
+except ImportError:
+    ec = None
+
+from metrics import TIME_CRYPTO, timed
 from protocol import SIGNATURE_SIZE, AuthToken, TransferReceipt
 
 
-class Authenticator:
+TOKEN_CACHE_SIZE = 4096
+CRYPTO_THREADS = 4
+
+
+class VerifiedCache:
+    """
+    Bounded LRU set of signatures that passed verification. Only successful
+    verifications are cached, so invalid tokens cannot evict valid ones.
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key: Hashable) -> bool:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, key: Hashable):
+        if self._size <= 0:
+            return
+        self._entries[key] = None
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+
+class SignatureBackend(abc.ABC):
+    """
+    ECDSA P-256 with SHA-256 over the server key. Signatures are 64 bytes,
+    the big-endian r and s concatenated.
+    """
+
+    name: str = None
+    # Whether sign() and verify() run without holding the GIL, so that they
+    # can run in parallel with the event loop in a thread pool.
+    releases_gil: bool = False
+
+    @abc.abstractmethod
+    def sign(self, data: bytes) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def verify(self, sig: bytes, data: bytes) -> bool:
+        pass
+
+    @staticmethod
+    @abc.abstractmethod
+    def from_pem(pem: bytes) -> 'SignatureBackend':
+        pass
+
+    @staticmethod
+    @abc.abstractmethod
+    def generate() -> Tuple['SignatureBackend', bytes]:
+        pass
+
+
+class EcdsaBackend(SignatureBackend):
+    name = 'ecdsa'
+
     def __init__(self, sign_key: ecdsa.SigningKey):
         self._sk = sign_key
         self._vk = sign_key.get_verifying_key()
 
-    def make_token(self, userid: int) -> AuthToken:
+    def sign(self, data: bytes) -> bytes:
+        return self._sk.sign(data)
+
+    def verify(self, sig: bytes, data: bytes) -> bool:
+        try:
+            return self._vk.verify(sig, data)
+        except ecdsa.BadSignatureError:
+            return False
+
+    @staticmethod
+    def from_pem(pem: bytes) -> 'EcdsaBackend':
+        return EcdsaBackend(ecdsa.SigningKey.from_pem(pem, hashfunc=sha256))
+
+    @staticmethod
+    def generate() -> Tuple['EcdsaBackend', bytes]:
+        sk = ecdsa.SigningKey.generate(ecdsa.curves.NIST256p, hashfunc=sha256)
+        return EcdsaBackend(sk), sk.to_pem()
+
+
+class CryptographyBackend(SignatureBackend):
+    name = 'cryptography'
+    releases_gil = True
+
+    _SCALAR_SIZE = SIGNATURE_SIZE // 2
+
+    def __init__(self, sign_key: 'ec.EllipticCurvePrivateKey'):
+        self._sk = sign_key
+        self._vk = sign_key.public_key()
+        self._algorithm = ec.ECDSA(hashes.SHA256())
+
+    def sign(self, data: bytes) -> bytes:
+        r, s = decode_dss_signature(self._sk.sign(data, self._algorithm))
+        return r.to_bytes(self._SCALAR_SIZE, 'big') + \
+            s.to_bytes(self._SCALAR_SIZE, 'big')
+
+    def verify(self, sig: bytes, data: bytes) -> bool:
+        if len(sig) != SIGNATURE_SIZE:
+            return False
+        r = int.from_bytes(sig[:self._SCALAR_SIZE], 'big')
+        s = int.from_bytes(sig[self._SCALAR_SIZE:], 'big')
+        try:
+            self._vk.verify(encode_dss_signature(r, s), data, self._algorithm)
+        except InvalidSignature:
+            return False
+        return True
+
+    @staticmethod
+    def from_pem(pem: bytes) -> 'CryptographyBackend':
+        sk = serialization.load_pem_private_key(pem, password=None)
+        if not isinstance(sk, ec.EllipticCurvePrivateKey) or \
+                not isinstance(sk.curve, ec.SECP256R1):
+            raise ValueError('Not a P-256 private key')
+        return CryptographyBackend(sk)
+
+    @staticmethod
+    def generate() -> Tuple['CryptographyBackend', bytes]:
+        sk = ec.generate_private_key(ec.SECP256R1())
+        # Same SEC1 "EC PRIVATE KEY" PEM as written by ecdsa.
+        pem = sk.private_bytes(serialization.Encoding.PEM,
+                               serialization.PrivateFormat.TraditionalOpenSSL,
+                               serialization.NoEncryption())
+        return CryptographyBackend(sk), pem
+
+
+backend_map = {EcdsaBackend.name: EcdsaBackend}
+if ec is not None:
+    backend_map[CryptographyBackend.name] = CryptographyBackend
+
+DEFAULT_BACKEND = CryptographyBackend.name if ec is not None \
+    else EcdsaBackend.name
+
+
+class Authenticator:
+    """
+    Signs and verifies auth tokens and transfer receipts. With threads > 0,
+    the backend runs in a thread pool instead of blocking the event loop.
+    By default, the pool is only used if the backend releases the GIL.
+    """
+
+    def __init__(self, backend: SignatureBackend,
+                 token_cache_size: int = TOKEN_CACHE_SIZE,
+                 threads: Optional[int] = None):
+        self._backend = backend
+        self.token_cache = VerifiedCache(token_cache_size)
+        if threads is None:
+            threads = CRYPTO_THREADS if backend.releases_gil else 0
+        self._executor = ThreadPoolExecutor(
+            threads, thread_name_prefix='crypto') if threads > 0 else None
+
+    @property
+    def backend(self) -> SignatureBackend:
+        return self._backend
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    @timed(TIME_CRYPTO)
+    async def sign(self, data: bytes) -> bytes:
+        if self._executor is None:
+            return self._backend.sign(data)
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._backend.sign, data)
+
+    @timed(TIME_CRYPTO)
+    async def verify(self, sig: bytes, data: bytes) -> bool:
+        if self._executor is None:
+            return self._backend.verify(sig, data)
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._backend.verify, sig, data)
+
+    async def make_token(self, userid: int) -> AuthToken:
         token = AuthToken(userid, b'\x00' * SIGNATURE_SIZE)
-        sig = self._sk.sign(token.signed_data)
+        sig = await self.sign(token.signed_data)
         assert len(sig) == SIGNATURE_SIZE
         return AuthToken(userid, sig)
 
-    def check_token(self, token: AuthToken) -> bool:
-        return self._verify(token.signature, token.signed_data)
+    async def check_token(self, token: AuthToken) -> bool:
+        # The userid is the only signed field, so it identifies the signed data.
+        key = (int(token.userid), bytes(token.signature))
+        if self.token_cache.lookup(key):
+            return True
+        if not await self.verify(token.signature, token.signed_data):
+            return False
+        self.token_cache.add(key)
+        return True
 
-    def make_receipt(self, amount: int, currency: int, recipient: int) -> TransferReceipt:
+    async def make_receipt(self, amount: int, currency: int, recipient: int) -> TransferReceipt:
         receipt = TransferReceipt(
             amount, currency, recipient, b'\x00' * SIGNATURE_SIZE)
-        sig = self._sk.sign(receipt.signed_data)
+        sig = await self.sign(receipt.signed_data)
         assert len(sig) == SIGNATURE_SIZE
         return TransferReceipt(amount, currency, recipient, sig)
 
-    def check_receipt(self, receipt: TransferReceipt) -> bool:
-        return self._verify(receipt.signature, receipt.signed_data)
-
-    def _verify(self, sig: bytes, data: bytes) -> bool:
-        try:
-            return self._vk.verify(sig, data)
-        except ecdsa.BadSignatureError:
-            return False
+    async def check_receipt(self, receipt: TransferReceipt) -> bool:
+        return await self.verify(receipt.signature, receipt.signed_data)
 
     @staticmethod
-    def from_path(path: str):
+    def from_path(path: str, token_cache_size: int = TOKEN_CACHE_SIZE,
+                  backend: str = DEFAULT_BACKEND, threads: Optional[int] = None):
+        try:
+            backend_cls = backend_map[backend]
+        except KeyError:
+            raise ValueError(f'Unknown or unavailable crypto backend: {backend}')
         try:
-            with open(path) as f:
-                sk = ecdsa.SigningKey.from_pem(f.read(), hashfunc=sha256)
+            with open(path, 'rb') as f:
+                impl = backend_cls.from_pem(f.read())
         except FileNotFoundError:
-            sk = ecdsa.SigningKey.generate(
-                ecdsa.curves.NIST256p, hashfunc=sha256)
+            impl, pem = backend_cls.generate()
             with open(path, 'wb') as f:
-                f.write(sk.to_pem())
-        return Authenticator(sk)
+                f.write(pem)
+        return Authenticator(impl, token_cache_size, threads)
 
 
 def deserialize_pubkey(pubkey: str) -> Optional[ecdsa.VerifyingKey]:
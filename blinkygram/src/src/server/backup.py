@@ -0,0 +1,376 @@
+import io
+import os
+import json
+import stat
+import uuid
+import fcntl
+import shutil
+import zipfile
+
+from typing import Dict, List, Optional, Set, Tuple
+
+
+BACKUP_FILES = ['messages', 'public_key', 'balance']
+
+# Largest file that the zip and unzip subprocesses used to be allowed to
+# write, under ulimit -f 64 (in 512-byte blocks).
+MAX_FILE_SIZE = 64 * 512
+
+# Snapshot chains deeper than this are flattened by compaction.
+MAX_CHAIN_DEPTH = 8
+
+SNAPSHOT_FILE = 'snapshot'
+INDEX_FILE = '.index'
+LOCK_FILE = '.lock'
+
+
+class BackupException(Exception):
+    pass
+
+
+class ParentGone(BackupException):
+    pass
+
+
+def extract_backup(data: bytes, backup_dir: str):
+    """
+    Extracts the backup files from a ZIP archive into backup_dir. Other
+    entries are ignored, but symlinks and paths escaping the archive are
+    rejected anywhere in it. Nothing is written unless all files are valid.
+    """
+    contents: Dict[str, bytes] = {}
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        for info in zf.infolist():
+            if stat.S_ISLNK(info.external_attr >> 16):
+                raise BackupException(f'Symlink entry: {info.filename}')
+            parts = info.filename.replace('\\', '/').split('/')
+            if info.filename.startswith(('/', '\\')) or '..' in parts:
+                raise BackupException(f'Path traversal entry: {info.filename}')
+            if info.filename not in BACKUP_FILES:
+                continue
+            # Declared sizes can lie, so also bound the actual read.
+            if info.file_size > MAX_FILE_SIZE:
+                raise BackupException(f'File too large: {info.filename}')
+            with zf.open(info) as f:
+                content = f.read(MAX_FILE_SIZE + 1)
+            if len(content) > MAX_FILE_SIZE:
+                raise BackupException(f'File too large: {info.filename}')
+            contents[info.filename] = content
+
+    if not contents:
+        raise BackupException('No backup files')
+
+    for name, content in contents.items():
+        fd = os.open(f'{backup_dir}/{name}',
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o664)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(f'{backup_dir}/{name}', 0o664)
+
+
+def archive_backup(backup_dir: str) -> bytes:
+    """
+    Packs the backup files present in backup_dir into a ZIP archive, without
+    following symlinks. The messages of snapshots are materialized from their
+    chain of deltas, under the user's lock so that the chain is not retired
+    or compacted while it is read.
+    """
+    with _Lock(os.path.dirname(backup_dir), fcntl.LOCK_SH):
+        return _archive(backup_dir)
+
+
+def _archive(backup_dir: str) -> bytes:
+    bio = io.BytesIO()
+    count = 0
+    with zipfile.ZipFile(bio, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name in BACKUP_FILES:
+            if name == 'messages' and _exists(f'{backup_dir}/{SNAPSHOT_FILE}'):
+                content = _materialize(backup_dir)
+            else:
+                try:
+                    content = _read_file(f'{backup_dir}/{name}')
+                except FileNotFoundError:
+                    continue
+            zf.writestr(name, content)
+            count += 1
+
+    if count == 0:
+        raise BackupException('No backup files')
+    data = bio.getvalue()
+    if len(data) > MAX_FILE_SIZE:
+        raise BackupException('Archive too large')
+    return data
+
+
+class BackupStore:
+    """
+    Backups of each user, in path/<userid>/<backup id>. Besides uploaded
+    archives, a backup can be a snapshot of the user's data. Snapshots store
+    only the messages after the ones covered by their parent snapshot, and
+    their full messages are obtained by chaining the deltas. Messages are
+    thus backed up as they were when first covered by a snapshot.
+
+    Backups are listed in creation order in an index, and only the newest
+    keep - 1 of them are kept. Older snapshots are hidden (renamed with a dot
+    prefix) instead of deleted while newer ones still chain to them. A
+    compaction, meant to run in the background, flattens chains deeper than
+    max_depth and deletes hidden snapshots no longer needed.
+    """
+
+    def __init__(self, path: str, keep: int, max_depth: int = MAX_CHAIN_DEPTH):
+        self._path = path
+        self._keep = keep
+        self._max_depth = max_depth
+
+    def user_dir(self, userid: int) -> str:
+        return f'{self._path}/{userid}'
+
+    def backup_dir(self, userid: int, backup_id: str) -> Optional[str]:
+        """
+        Returns the directory of a backup, or None if backup_id is not a
+        backup ID (a UUID in canonical form), so that it cannot point
+        anywhere else than inside the user's directory.
+        """
+        try:
+            valid = str(uuid.UUID(backup_id)) == backup_id
+        except ValueError:
+            valid = False
+        if not valid:
+            return None
+        user_dir = os.path.realpath(self.user_dir(userid))
+        backup_dir = os.path.realpath(f'{user_dir}/{backup_id}')
+        if os.path.dirname(backup_dir) != user_dir:
+            return None
+        return backup_dir
+
+    def archive(self, userid: int, backup_id: str) -> Optional[bytes]:
+        """
+        Returns the ZIP archive of a backup (see archive_backup()), or None
+        if it is not one of the user's kept backups: retired snapshots are
+        only kept for the chains of newer ones.
+        """
+        backup_dir = self.backup_dir(userid, backup_id)
+        if backup_dir is None or not os.path.isdir(backup_dir):
+            return None
+        user_dir = self.user_dir(userid)
+        with _Lock(user_dir, fcntl.LOCK_SH):
+            if backup_id not in self._load_index(user_dir):
+                return None
+            return _archive(backup_dir)
+
+    def head(self, userid: int) -> Tuple[Optional[str], int]:
+        """
+        Returns the newest snapshot and the last message ID it covers, to be
+        the parent of the next snapshot, or None and 0 if there is none.
+        """
+        user_dir = self.user_dir(userid)
+        if not os.path.isdir(user_dir):
+            return None, 0
+        with _Lock(user_dir, fcntl.LOCK_SH):
+            for backup_id in reversed(self._load_index(user_dir)):
+                meta = _read_meta(f'{user_dir}/{backup_id}')
+                if meta is not None:
+                    return backup_id, meta['last_id']
+        return None, 0
+
+    def new_dir(self, userid: int) -> Tuple[str, str]:
+        """
+        Creates the directory of a new backup, to be filled and then added
+        with add(). Returns the backup ID and directory.
+        """
+        user_dir = self.user_dir(userid)
+        backup_id = str(uuid.uuid4())
+        backup_dir = f'{user_dir}/{backup_id}'
+        os.makedirs(backup_dir)
+        os.chmod(user_dir, 0o777)
+        os.chmod(backup_dir, 0o777)
+        return backup_id, backup_dir
+
+    def write_snapshot(self, userid: int, backup_dir: str, parent: Optional[str],
+                       last_id: int, delta: list, public_key: str, balance: list):
+        user_dir = self.user_dir(userid)
+        depth = 0
+        if parent is not None:
+            with _Lock(user_dir, fcntl.LOCK_SH):
+                parent_meta = _read_meta(_resolve(user_dir, parent))
+            if parent_meta is None:
+                raise ParentGone(f'Parent snapshot gone: {parent}')
+            depth = parent_meta['depth'] + 1
+        if delta:
+            last_id = delta[-1]['id']
+        meta = {'parent': parent, 'last_id': last_id, 'depth': depth}
+        _write_file(f'{backup_dir}/{SNAPSHOT_FILE}',
+                    _snapshot_content(meta, json.dumps(delta).encode()))
+        _write_file(f'{backup_dir}/public_key', public_key.encode())
+        _write_file(f'{backup_dir}/balance', json.dumps(balance).encode())
+
+    def add(self, userid: int, backup_id: str) -> bool:
+        """
+        Adds a new backup to the index, and retires the oldest ones. Returns
+        whether a compaction is due. Raises ParentGone if the backup is a
+        snapshot whose parent was deleted in the meantime.
+        """
+        user_dir = self.user_dir(userid)
+        with _Lock(user_dir, fcntl.LOCK_EX):
+            meta = _read_meta(f'{user_dir}/{backup_id}')
+            if meta is not None and meta['parent'] is not None and \
+                    _read_meta(_resolve(user_dir, meta['parent'])) is None:
+                raise ParentGone(f'Parent snapshot gone: {meta["parent"]}')
+
+            index = self._load_index(user_dir)
+            if backup_id not in index:
+                index.append(backup_id)
+            while len(index) > self._keep - 1:
+                old_dir = f'{user_dir}/{index.pop(0)}'
+                if _exists(f'{old_dir}/{SNAPSHOT_FILE}'):
+                    os.rename(old_dir, _hidden(old_dir))
+                else:
+                    shutil.rmtree(old_dir, ignore_errors=True)
+            self._save_index(user_dir, index)
+
+            # Hidden snapshots still needed by chains stay until those are
+            # flattened, which only a chain too deep calls for.
+            if meta is not None and meta['depth'] > self._max_depth:
+                return True
+            hidden = _hidden_ids(user_dir)
+            return bool(hidden) and not hidden <= _needed(user_dir, index)
+
+    def compact(self, userid: int):
+        user_dir = self.user_dir(userid)
+        with _Lock(user_dir, fcntl.LOCK_EX):
+            index = self._load_index(user_dir)
+            for backup_id in index:
+                backup_dir = f'{user_dir}/{backup_id}'
+                meta = _read_meta(backup_dir)
+                if meta is not None and meta['depth'] > self._max_depth:
+                    messages = _materialize(backup_dir)
+                    meta = {'parent': None, 'last_id': meta['last_id'], 'depth': 0}
+                    _write_file(f'{backup_dir}/{SNAPSHOT_FILE}',
+                                _snapshot_content(meta, messages))
+
+            for backup_id in _hidden_ids(user_dir) - _needed(user_dir, index):
+                shutil.rmtree(_hidden(f'{user_dir}/{backup_id}'), ignore_errors=True)
+
+    def _load_index(self, user_dir: str) -> List[str]:
+        try:
+            with open(f'{user_dir}/{INDEX_FILE}') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        # Backups from before the index, by creation order.
+        backup_dirs = [f'{user_dir}/{name}' for name in os.listdir(user_dir)
+                       if not name.startswith('.')]
+        backup_dirs.sort(key=os.path.getctime)
+        return [os.path.basename(path) for path in backup_dirs]
+
+    def _save_index(self, user_dir: str, index: List[str]):
+        _write_file(f'{user_dir}/{INDEX_FILE}', json.dumps(index).encode())
+
+
+class _Lock:
+    def __init__(self, user_dir: str, operation: int):
+        self._path = f'{user_dir}/{LOCK_FILE}'
+        self._operation = operation
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, self._operation)
+
+    def __exit__(self, *args):
+        os.close(self._fd)
+
+
+def _exists(path: str) -> bool:
+    return os.path.lexists(path)
+
+
+def _hidden(backup_dir: str) -> str:
+    head, name = os.path.split(backup_dir)
+    return f'{head}/.{name}'
+
+
+def _resolve(user_dir: str, backup_id: str) -> str:
+    backup_dir = f'{user_dir}/{backup_id}'
+    return backup_dir if os.path.isdir(backup_dir) else _hidden(backup_dir)
+
+
+def _hidden_ids(user_dir: str) -> Set[str]:
+    return {name[1:] for name in os.listdir(user_dir)
+            if name.startswith('.') and os.path.isdir(f'{user_dir}/{name}')}
+
+
+def _needed(user_dir: str, index: List[str]) -> Set[str]:
+    # Snapshots that the chains of the kept backups go through, reading each
+    # metadata line once.
+    needed = set()
+    for backup_id in index:
+        meta = _read_meta(f'{user_dir}/{backup_id}')
+        while meta is not None and meta['parent'] is not None and \
+                meta['parent'] not in needed:
+            needed.add(meta['parent'])
+            meta = _read_meta(_resolve(user_dir, meta['parent']))
+    return needed
+
+
+def _open_file(path: str) -> io.BufferedReader:
+    fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    f = os.fdopen(fd, 'rb')
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        f.close()
+        raise BackupException(f'Not a regular file: {path}')
+    return f
+
+
+def _read_file(path: str) -> bytes:
+    with _open_file(path) as f:
+        return f.read()
+
+
+def _write_file(path: str, content: bytes):
+    # Atomic, as snapshots can be rewritten under concurrent readers.
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.chmod(tmp_path, 0o664)
+    os.replace(tmp_path, path)
+
+
+def _snapshot_content(meta: dict, delta: bytes) -> bytes:
+    # The metadata line, then the JSON list of messages.
+    return json.dumps(meta).encode() + b'\n' + delta
+
+
+def _read_snapshot(backup_dir: str) -> Tuple[Optional[dict], bytes]:
+    try:
+        content = _read_file(f'{backup_dir}/{SNAPSHOT_FILE}')
+    except FileNotFoundError:
+        return None, b''
+    meta, delta = content.split(b'\n', 1)
+    return json.loads(meta), delta
+
+
+def _read_meta(backup_dir: str) -> Optional[dict]:
+    # Only the metadata line, not the messages after it.
+    try:
+        with _open_file(f'{backup_dir}/{SNAPSHOT_FILE}') as f:
+            return json.loads(f.readline())
+    except FileNotFoundError:
+        return None
+
+
+def _materialize(backup_dir: str) -> bytes:
+    # Callers hold the user's lock, so that the chain resolves consistently.
+    user_dir = os.path.dirname(backup_dir)
+    deltas = []
+    meta, delta = _read_snapshot(backup_dir)
+    while True:
+        deltas.append(delta)
+        if meta['parent'] is None:
+            break
+        meta, delta = _read_snapshot(_resolve(user_dir, meta['parent']))
+        if meta is None:
+            raise BackupException('Broken snapshot chain')
+    # Join the JSON lists without parsing them.
+    items = [delta[1:-1] for delta in reversed(deltas) if delta != b'[]']
+    return b'[' + b', '.join(items) + b']'
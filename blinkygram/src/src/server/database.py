@@ -1,8 +1,12 @@
 import time
+import asyncio
+import sqlite3
 import aiosqlite
 import dataclasses
 
-from typing import Iterable, List, Optional, Tuple
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, Set, Tuple, Union
+
+from metrics import TIME_DB, timed
 
 
 INIT_SQL = [
@@ -49,6 +53,18 @@ INIT_SQL = [
 ]
 
 
+# Schema migrations, applied in order on connect on top of INIT_SQL. The
+# number of applied migrations is kept in the database's user_version.
+MIGRATIONS = [
+    [
+        'CREATE INDEX IF NOT EXISTS messages_dst ON messages (uid_dst, delivered, id);',
+        'CREATE INDEX IF NOT EXISTS messages_src ON messages (uid_src, id);',
+    ],
+    [
+        'CREATE INDEX IF NOT EXISTS messages_dst_id ON messages (uid_dst, id);',
+    ],
+]
+
 class DatabaseException(Exception):
     pass
 
@@ -66,16 +82,32 @@ class CurrencyNotExists(DatabaseException):
 
 
 class Database:
-    def __init__(self, path: str, concurrency: int = 1):
+    """
+    With a nonzero group_window, inserts and updates are group committed:
+    writes issued within group_window seconds of each other, up to
+    group_size of them, run in a single transaction. User lookups go through
+    user_cache (a usercache.UserCache), if given.
+    """
+
+    def __init__(self, path: str, concurrency: int = 1,
+                 group_window: float = 0, group_size: int = 64,
+                 user_cache=None):
+        self.user_cache = user_cache
         self._path = path
         self._conn: aiosqlite.Connection = None
         self._concurrency = concurrency
+        self._group_window = group_window
+        self._group_size = group_size
+        # Pending writes as (is_insert, sql, parameters, future).
+        self._group: List[Tuple[bool, str, list, asyncio.Future]] = []
+        self._group_timer: asyncio.TimerHandle = None
+        self._group_tasks: Set[asyncio.Task] = set()
 
     @property
     def concurrency(self):
         return self._concurrency
 
-    async def connect(self):
+    async def connect(self, migrate: bool = True):
         self._conn = await aiosqlite.connect(self._path, isolation_level=None)
 
         await self._conn.execute('PRAGMA journal_mode = WAL;')
@@ -87,22 +119,149 @@ class Database:
         for stmt in INIT_SQL:
             await self._conn.execute(stmt)
 
+        if migrate:
+            await self.migrate()
+
+    async def migrate(self):
+        # Workers may connect concurrently: the write lock serializes them.
+        await self._conn.execute('BEGIN IMMEDIATE;')
+        try:
+            async with self._conn.execute('PRAGMA user_version;') as cursor:
+                version, = await cursor.fetchone()
+            if version < len(MIGRATIONS):
+                for stmts in MIGRATIONS[version:]:
+                    for stmt in stmts:
+                        await self._conn.execute(stmt)
+                await self._conn.execute(
+                    f'PRAGMA user_version = {len(MIGRATIONS)};')
+            await self._conn.execute('COMMIT;')
+        except:
+            await self._conn.execute('ROLLBACK;')
+            raise
+
     async def close(self):
+        if self._group:
+            self._flush_group()
+        if self._group_tasks:
+            await asyncio.wait(self._group_tasks)
         await self._conn.close()
 
+    @timed(TIME_DB)
     async def insert(self, sql: str, parameters: list = []) -> int:
+        if self._group_window:
+            return await self._grouped(True, sql, parameters)
         row = await self._conn.execute_insert(sql, parameters)
         row_id = row[0]
         return row_id
 
+    @timed(TIME_DB)
     async def update(self, sql: str, parameters: list = []) -> int:
+        if self._group_window:
+            return await self._grouped(False, sql, parameters)
         async with self._conn.execute(sql, parameters) as cursor:
             row_count = cursor.rowcount
         return row_count
 
+    @timed(TIME_DB)
     async def select(self, sql: str, parameters: list = []) -> Iterable[Tuple]:
         return await self._conn.execute_fetchall(sql, parameters)
 
+    @timed(TIME_DB)
+    async def transaction(self, func: Callable[..., Any], *args) -> Any:
+        """
+        Runs func(conn, *args) on the sqlite3 connection in the connection
+        thread, in a single trip, within an immediate transaction that is
+        rolled back if it raises.
+        """
+        return await self._in_connection(_run_transaction, func, args)
+
+    def _in_connection(self, func: Callable[..., Any], *args) -> Awaitable[Any]:
+        """
+        Runs func(conn, *args) on the underlying sqlite3 connection, in the
+        aiosqlite connection thread, so that it is serialized with every other
+        statement. aiosqlite has no public hook for this, so this is the only
+        place relying on its internals (Connection._execute and
+        Connection._conn); aiosqlite is pinned in requirements.txt for it.
+        """
+        return self._conn._execute(func, self._conn._conn, *args)
+
+    def _grouped(self, insert: bool, sql: str, parameters: list) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._group.append((insert, sql, parameters, future))
+        if len(self._group) >= self._group_size:
+            self._flush_group()
+        elif self._group_timer is None:
+            self._group_timer = loop.call_later(
+                self._group_window, self._flush_group)
+        return future
+
+    def _flush_group(self):
+        if self._group_timer is not None:
+            self._group_timer.cancel()
+            self._group_timer = None
+        group, self._group = self._group, []
+        task = asyncio.get_running_loop().create_task(self._commit_group(group))
+        self._group_tasks.add(task)
+        task.add_done_callback(self._group_tasks.discard)
+
+    async def _commit_group(self, group: List[Tuple[bool, str, list, asyncio.Future]]):
+        writes = [(insert, sql, parameters)
+                  for insert, sql, parameters, _ in group]
+        try:
+            # The whole group runs in the connection thread, in a single trip.
+            results = await self._in_connection(_run_group, writes)
+        except Exception as e:
+            results = [e] * len(group)
+        for (_, _, _, future), result in zip(group, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def _run_transaction(conn: sqlite3.Connection, func: Callable[..., Any],
+                     args: tuple) -> Any:
+    # Taking the write lock upfront, racing workers wait on the busy timeout
+    # instead of failing to upgrade a read transaction.
+    conn.execute('BEGIN IMMEDIATE;')
+    try:
+        result = func(conn, *args)
+        conn.execute('COMMIT;')
+    except:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK;')
+        raise
+    return result
+
+
+def _run_group(conn: sqlite3.Connection,
+               writes: List[Tuple[bool, str, list]]) -> List[Union[int, Exception]]:
+    # A failing statement is only undone by itself (the default ABORT
+    # conflict resolution), so its error goes to its caller only. Errors that
+    # roll back the whole transaction fail the whole group.
+    results = []
+    conn.execute('BEGIN IMMEDIATE;')
+    try:
+        for insert, sql, parameters in writes:
+            try:
+                cursor = conn.execute(sql, parameters)
+            except sqlite3.Error as e:
+                if not conn.in_transaction:
+                    raise
+                results.append(e)
+                continue
+            results.append(cursor.lastrowid if insert else cursor.rowcount)
+            cursor.close()
+        conn.execute('COMMIT;')
+    except:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK;')
+        raise
+    return results
+
 
 @dataclasses.dataclass
 class User:
@@ -111,34 +270,56 @@ class User:
     pubkey: str
     id: int = None
 
+    _INSERT = 'INSERT INTO users VALUES (NULL, ?, ?, ?)'
+    _UPDATE = ('UPDATE users SET username = ?, password = ?, pubkey = ? '
+               'WHERE id = ?')
+    _BY_ID = 'SELECT * FROM users WHERE id = ?'
+    _BY_NAME = 'SELECT * FROM users WHERE username = ?'
+
     async def commit(self, db: Database):
         params = [self.username, self.password, self.pubkey]
         if self.id is None:
             try:
-                row_id = await db.insert(
-                    'INSERT INTO users VALUES (NULL, ?, ?, ?)',
-                    params
-                )
+                row_id = await db.insert(User._INSERT, params)
             except aiosqlite.IntegrityError:
                 raise UserExists('User already exists')
             self.id = row_id
         else:
-            await db.update(
-                'UPDATE users SET username = ?, password = ?, pubkey = ? '
-                'WHERE id = ?',
-                params + [self.id]
-            )
+            await db.update(User._UPDATE, params + [self.id])
+            # New users need no invalidation, as misses are not cached.
+            if db.user_cache is not None:
+                db.user_cache.invalidate(self.id)
 
     @staticmethod
     async def by_id(db: Database, id: int) -> Optional['User']:
-        rows = await User._select(db, 'SELECT * FROM users WHERE id = ?', [id])
-        return rows[0] if rows else None
+        cache = db.user_cache
+        if cache is None:
+            rows = await User._select(db, User._BY_ID, [id])
+            return rows[0] if rows else None
+        user = cache.by_id(id)
+        if user is None:
+            user = await User._select_cached(db, User._BY_ID, [id])
+        return user
 
     @staticmethod
     async def by_name(db: Database, username: str) -> Optional['User']:
-        rows = await User._select(
-            db, 'SELECT * FROM users WHERE username = ?', [username])
-        return rows[0] if rows else None
+        cache = db.user_cache
+        if cache is None:
+            rows = await User._select(db, User._BY_NAME, [username])
+            return rows[0] if rows else None
+        user = cache.by_name(username)
+        if user is None:
+            user = await User._select_cached(db, User._BY_NAME, [username])
+        return user
+
+    @staticmethod
+    async def _select_cached(db: Database, sql: str, parameters: list) -> Optional['User']:
+        generation = db.user_cache.generation
+        rows = await User._select(db, sql, parameters)
+        if not rows:
+            return None
+        db.user_cache.add(rows[0], generation)
+        return rows[0]
 
     @staticmethod
     async def _select(db: Database, sql: str, parameters: list = []) -> List['User']:
@@ -158,47 +339,61 @@ class Message:
     timestamp: int = None
     delivered: bool = False
 
+    _INSERT = 'INSERT INTO messages VALUES (NULL, ?, ?, ?, ?, ?)'
+    _UPDATE = ('UPDATE messages SET timestamp = ?, uid_src = ?, uid_dst = ?, '
+               'content = ?, delivered = ? WHERE id = ?')
+    # Claiming in a single statement makes it atomic across workers.
+    _READ_ONE = ('UPDATE messages SET delivered = 1 WHERE id = ('
+                 'SELECT id FROM messages '
+                 'WHERE uid_dst = ? AND delivered = 0 '
+                 'ORDER BY id ASC LIMIT 1) '
+                 'RETURNING *')
+    _READ_MANY = ('UPDATE messages SET delivered = 1 WHERE id IN ('
+                  'SELECT id FROM ('
+                  'SELECT id, SUM(LENGTH(content) + ?) '
+                  'OVER (ORDER BY id ASC) AS size FROM messages '
+                  'WHERE uid_dst = ? AND delivered = 0 '
+                  'ORDER BY id ASC LIMIT ?) '
+                  'WHERE size <= ?) '
+                  'RETURNING *')
+    # Written as a union so that each side uses its own index.
+    _ALL_BY_USER = ('SELECT * FROM messages WHERE uid_dst = ? AND id > ? '
+                    'UNION SELECT * FROM messages WHERE uid_src = ? AND id > ? '
+                    'ORDER BY id ASC')
+
     async def commit(self, db: Database):
         ts = int(time.time()) if self.timestamp is None else self.timestamp
         params = [ts, self.uid_src, self.uid_dst, self.content, self.delivered]
         if self.id is None:
             try:
-                row_id = await db.insert(
-                    'INSERT INTO messages VALUES (NULL, ?, ?, ?, ?, ?)',
-                    params
-                )
+                row_id = await db.insert(Message._INSERT, params)
             except aiosqlite.IntegrityError:
                 raise UserNotExists('User does not exist')
             self.id = row_id
         else:
-            await db.update(
-                'UPDATE messages SET timestamp = ?, uid_src = ?, uid_dst = ?, '
-                'content = ?, delivered = ? WHERE id = ?',
-                params + [self.id]
-            )
+            await db.update(Message._UPDATE, params + [self.id])
         self.timestamp = ts
 
     @staticmethod
     async def read_one(db: Database, uid_dst: int) -> Optional['Message']:
-        msgids = await db.select(
-            'SELECT id FROM messages '
-            'WHERE uid_dst = ? AND delivered = 0 ORDER BY id ASC '
-            f'LIMIT {db.concurrency}',
-            [uid_dst])
-        for msgid, in msgids:
-            row_count = await db.update(
-                'UPDATE messages SET delivered = 1 WHERE id = ? AND delivered = 0',
-                [msgid])
-            if row_count > 0:
-                msg, = await Message._select(db, 'SELECT * FROM messages WHERE id = ?', [msgid])
-                return msg
-        return None
+        msgs = await Message._select(db, Message._READ_ONE, [uid_dst])
+        return msgs[0] if msgs else None
+
+    @staticmethod
+    async def read_many(db: Database, uid_dst: int, count: int,
+                        max_size: int, overhead: int = 0) -> List['Message']:
+        # Claims the oldest messages, up to count and as long as their sizes
+        # (content length plus overhead each) add up to at most max_size.
+        msgs = await Message._select(db, Message._READ_MANY,
+                                     [overhead, uid_dst, count, max_size])
+        # RETURNING does not guarantee any order.
+        msgs.sort(key=lambda msg: msg.id)
+        return msgs
 
     @staticmethod
-    async def all_by_user(db: Database, userid: int) -> List['Message']:
-        return await Message._select(db,
-                                     'SELECT * FROM messages WHERE uid_dst = ? OR uid_src = ? '
-                                     'ORDER BY id ASC', [userid, userid])
+    async def all_by_user(db: Database, userid: int, after_id: int = 0) -> List['Message']:
+        return await Message._select(db, Message._ALL_BY_USER,
+                                     [userid, after_id, userid, after_id])
 
     @staticmethod
     async def _select(db: Database, sql: str, parameters: list = []) -> List['Message']:
@@ -214,9 +409,11 @@ class Message:
 class Currency:
     id: int = None
 
+    _INSERT = 'INSERT INTO currencies VALUES (NULL)'
+
     async def commit(self, db: Database):
         if self.id is None:
-            row_id = await db.insert('INSERT INTO currencies VALUES (NULL)')
+            row_id = await db.insert(Currency._INSERT)
             self.id = row_id
 
 
@@ -226,33 +423,66 @@ class Balance:
     currency_id: int
     balance: int
 
+    _REPLACE = 'INSERT OR REPLACE INTO balances VALUES (?, ?, ?)'
+    _CREATE = ('INSERT INTO balances VALUES (?, ?, ?) '
+               'ON CONFLICT (uid, currency_id) DO NOTHING')
+    _FIND = 'SELECT * FROM balances WHERE uid = ? AND currency_id = ?'
+    _ADJUST = ('UPDATE balances SET balance = balance + ? '
+               'WHERE uid = ? AND currency_id = ? AND balance + ? >= 0')
+    _ALL_BY_USER = 'SELECT * FROM balances WHERE uid = ?'
+
     async def commit(self, db: Database):
         try:
-            await db.update(
-                'INSERT OR REPLACE INTO balances VALUES (?, ?, ?)',
-                [self.uid, self.currency_id, self.balance])
+            await db.update(Balance._REPLACE,
+                            [self.uid, self.currency_id, self.balance])
         except aiosqlite.IntegrityError:
             raise CurrencyNotExists('Currency does not exist')
 
     @staticmethod
     async def find(db: Database, uid: int, currency_id: int) -> Optional['Balance']:
-        rows = await Balance._select(db,
-                                     'SELECT * FROM balances WHERE uid = ? AND currency_id = ?',
-                                     [uid, currency_id])
+        rows = await Balance._select(db, Balance._FIND, [uid, currency_id])
         return rows[0] if rows else None
 
     @staticmethod
     async def adjust(db: Database, uid: int, currency_id: int, delta: int) -> bool:
         row_count = await db.update(
-            'UPDATE balances SET balance = balance + ? '
-            'WHERE uid = ? AND currency_id = ? AND balance + ? >= 0',
-            [delta, uid, currency_id, delta])
+            Balance._ADJUST, [delta, uid, currency_id, delta])
         return row_count > 0
 
+    @staticmethod
+    async def withdraw(db: Database, uid: int, currency_id: int, amount: int,
+                       initial: int) -> bool:
+        """
+        Subtracts amount from a balance, created with the initial amount if
+        missing, in a single transaction. Returns whether the balance was
+        sufficient, and raises CurrencyNotExists for an unknown currency.
+        """
+        return await db.transaction(Balance._withdraw, uid, currency_id, amount, initial)
+
     @staticmethod
     async def all_by_user(db: Database, uid: int) -> List['Balance']:
-        return await Balance._select(db,
-                                     'SELECT * FROM balances WHERE uid = ?', [uid])
+        return await Balance._select(db, Balance._ALL_BY_USER, [uid])
+
+    @staticmethod
+    def _withdraw(conn: sqlite3.Connection, uid: int, currency_id: int,
+                  amount: int, initial: int) -> bool:
+        Balance._create(conn, uid, currency_id, initial)
+        cursor = conn.execute(
+            Balance._ADJUST, [-amount, uid, currency_id, -amount])
+        return cursor.rowcount > 0
+
+    @staticmethod
+    def _deposit(conn: sqlite3.Connection, uid: int, currency_id: int,
+                 amount: int, initial: int):
+        Balance._create(conn, uid, currency_id, initial)
+        conn.execute(Balance._ADJUST, [amount, uid, currency_id, amount])
+
+    @staticmethod
+    def _create(conn: sqlite3.Connection, uid: int, currency_id: int, initial: int):
+        try:
+            conn.execute(Balance._CREATE, [uid, currency_id, initial])
+        except sqlite3.IntegrityError:
+            raise CurrencyNotExists('Currency does not exist')
 
     @staticmethod
     async def _select(db: Database, sql: str, parameters: list = []) -> List['Balance']:
@@ -264,16 +494,40 @@ class Balance:
 
 
 class SpentReceipt:
+    _FIND = 'SELECT * FROM spent_receipts WHERE receipt = ?'
+    _INSERT = 'INSERT INTO spent_receipts VALUES (?)'
+
     @staticmethod
     async def find(db: Database, receipt: bytes) -> bool:
-        rows = await db.select(
-            'SELECT * FROM spent_receipts WHERE receipt = ?', [receipt])
+        rows = await db.select(SpentReceipt._FIND, [receipt])
         return len(rows) > 0
 
     @staticmethod
     async def spend(db: Database, receipt: bytes) -> bool:
         try:
-            await db.insert('INSERT INTO spent_receipts VALUES (?)', [receipt])
+            await db.insert(SpentReceipt._INSERT, [receipt])
         except aiosqlite.IntegrityError:
             return False
         return True
+
+    @staticmethod
+    async def redeem(db: Database, receipt: bytes, uid: int, currency_id: int,
+                     amount: int, initial: int) -> bool:
+        """
+        Spends a receipt and deposits its amount to a balance, created with
+        the initial amount if missing, in a single transaction. Returns
+        False if the receipt was already spent, and raises
+        CurrencyNotExists for an unknown currency.
+        """
+        return await db.transaction(
+            SpentReceipt._redeem, receipt, uid, currency_id, amount, initial)
+
+    @staticmethod
+    def _redeem(conn: sqlite3.Connection, receipt: bytes, uid: int,
+                currency_id: int, amount: int, initial: int) -> bool:
+        try:
+            conn.execute(SpentReceipt._INSERT, [receipt])
+        except sqlite3.IntegrityError:
+            return False
+        Balance._deposit(conn, uid, currency_id, amount, initial)
+        return True
@@ -0,0 +1,152 @@
+import asyncio
+import os
+import socket
+import struct
+import time
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from database import Database, Message
+
+
+READ_TIMEOUT = 5.0
+
+# How often the list of peer worker sockets is refreshed, in case an
+# announcement of a new worker got lost.
+PEERS_REFRESH = 1.0
+
+_notification = struct.Struct('<Q')
+# Sent by workers as they start, so that the others rescan their peers.
+_announcement = b'\0'
+
+
+class Delivery:
+    """
+    Push-based chat delivery. Readers wait for a notification for their user
+    ID and claim one message at a time. Every worker listens on a Unix
+    datagram socket in a shared directory, and senders fan notifications out
+    to all of them, so that a message sent through any worker wakes readers
+    waiting in any other worker. Workers announce themselves to the others
+    on start, which then include them in their next fan-out.
+    """
+
+    def __init__(self, db: Database, path: str):
+        self._db = db
+        self._path = path
+        self._sock_path = f'{path}/{os.getpid()}'
+        self._sock: socket.socket = None
+        self._waiters: Dict[int, Set[asyncio.Future]] = {}
+        self._peers: List[str] = []
+        # None forces a rescan.
+        self._peers_time: Optional[float] = None
+
+    async def start(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        try:
+            os.unlink(self._sock_path)
+        except FileNotFoundError:
+            pass
+        self._sock.bind(self._sock_path)
+        asyncio.get_running_loop().add_reader(
+            self._sock.fileno(), self._on_readable)
+        self._broadcast(_announcement)
+
+    def close(self):
+        if self._sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self._sock_path)
+        except FileNotFoundError:
+            pass
+
+    async def read_one(self, uid: int, timeout: float = READ_TIMEOUT) -> Optional[Message]:
+        return await self._read(uid, lambda: Message.read_one(self._db, uid), timeout)
+
+    async def read_many(self, uid: int, count: int, max_size: int, overhead: int,
+                        timeout: float = READ_TIMEOUT) -> List[Message]:
+        msgs = await self._read(uid, lambda: Message.read_many(
+            self._db, uid, count, max_size, overhead), timeout)
+        return msgs or []
+
+    async def _read(self, uid: int, claim: Callable[[], Awaitable[Any]], timeout: float) -> Any:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            # Register before claiming, so that a message committed right
+            # after a failed claim still wakes us up.
+            waiter = loop.create_future()
+            self._waiters.setdefault(uid, set()).add(waiter)
+            try:
+                result = await claim()
+                if result:
+                    return result
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                try:
+                    await asyncio.wait_for(waiter, remaining)
+                except asyncio.TimeoutError:
+                    return None
+            finally:
+                self._remove_waiter(uid, waiter)
+
+    def notify(self, uid: int):
+        self._wake(uid)
+        # Pick up announcements of workers started since the last fan-out.
+        self._on_readable()
+        self._broadcast(_notification.pack(uid))
+
+    def _broadcast(self, data: bytes):
+        for peer in self._get_peers():
+            try:
+                self._sock.sendto(data, peer)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # Worker gone: forget its socket.
+                self._remove_peer(peer)
+            except BlockingIOError:
+                # Peer backlogged: its readers fall back to the timeout.
+                pass
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self._sock.recv(_notification.size)
+            except BlockingIOError:
+                return
+            if len(data) == _notification.size:
+                uid, = _notification.unpack(data)
+                self._wake(uid)
+            elif data == _announcement:
+                self._peers_time = None
+
+    def _wake(self, uid: int):
+        for waiter in self._waiters.pop(uid, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _remove_waiter(self, uid: int, waiter: asyncio.Future):
+        waiters = self._waiters.get(uid)
+        if waiters is None:
+            return
+        waiters.discard(waiter)
+        if not waiters:
+            del self._waiters[uid]
+
+    def _get_peers(self) -> List[str]:
+        now = time.monotonic()
+        if self._peers_time is None or now - self._peers_time > PEERS_REFRESH:
+            self._peers = [entry.path for entry in os.scandir(self._path)
+                           if entry.path != self._sock_path]
+            self._peers_time = now
+        return self._peers
+
+    def _remove_peer(self, peer: str):
+        try:
+            os.unlink(peer)
+        except FileNotFoundError:
+            pass
+        self._peers = [p for p in self._peers if p != peer]
@@ -0,0 +1,173 @@
+import asyncio
+import os
+import socket
+import traceback
+
+from typing import Awaitable, Callable, Optional, Tuple
+
+from protocol import MAX_MESSAGE_LEN, MessageHeader, RequestMessage
+
+
+BUFFER_SIZE = 1 << 16
+MAX_FRAME_SIZE = MessageHeader.SIZE + MAX_MESSAGE_LEN
+
+# Decoded frames queued before we stop reading from the socket.
+MAX_PENDING_FRAMES = 64
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """
+    Server-side request framing. Socket data is received directly into a
+    reusable buffer, and every complete frame delivered by a read is decoded
+    from a memoryview over the buffer, without intermediate copies.
+    """
+
+    def __init__(self, client_cb: Callable[['FrameProtocol'], Awaitable]):
+        self._client_cb = client_cb
+        self._buf = bytearray(BUFFER_SIZE)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self._frames = asyncio.Queue()
+        self._failed = False
+        self._transport: asyncio.Transport = None
+        self._task: asyncio.Task = None
+        self._reading_paused = False
+        self._writing_paused = False
+        self._drain_waiter: Optional[asyncio.Future] = None
+        self._closed = False
+
+    def connection_made(self, transport: asyncio.Transport):
+        self._transport = transport
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self._closed = True
+        self._frames.put_nowait(None)
+        self._wake_drain(exc)
+
+    @property
+    def peer_host(self) -> str:
+        peername = self._transport.get_extra_info('peername')
+        return peername[0] if peername else ''
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+        while self._end - self._start >= MessageHeader.SIZE:
+            try:
+                hdr, body = MessageHeader.dt_decode_from(
+                    self._view, self._start)
+                if self._end - body < hdr.length:
+                    break
+                msg = RequestMessage.dt_decode(
+                    self._view[body:body + hdr.length])
+            except Exception as e:
+                self._fail(e)
+                return
+            self._start = body + hdr.length
+            self._frames.put_nowait((hdr.seq, msg))
+
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buf) - self._start < MAX_FRAME_SIZE:
+            # Move the partial frame to the front so that it can complete.
+            size = self._end - self._start
+            self._buf[:size] = bytes(self._view[self._start:self._end])
+            self._start, self._end = 0, size
+
+        if self._frames.qsize() >= MAX_PENDING_FRAMES:
+            self._pause_reading()
+
+    def eof_received(self) -> bool:
+        # Keep the connection half-open, so that the replies to requests
+        # already received are still written: the client callback closes it
+        # once they are.
+        self._frames.put_nowait(None)
+        return True
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._wake_drain()
+
+    async def read_frame(self) -> Optional[Tuple[int, RequestMessage]]:
+        frame = await self._frames.get()
+        if self._reading_paused and self._frames.qsize() < MAX_PENDING_FRAMES // 2:
+            self._resume_reading()
+        if isinstance(frame, Exception):
+            raise frame
+        return frame
+
+    def write_frame(self, seq: int, data: bytes):
+        if self._closed or self._transport.is_closing():
+            return
+        hdr = MessageHeader(seq, len(data))
+        self._transport.writelines([hdr.dt_encode(), data])
+
+    async def drain(self):
+        if self._closed:
+            raise ConnectionResetError('Connection lost')
+        if not self._writing_paused:
+            return
+        # Pipelined requests may be draining concurrently: share the waiter.
+        if self._drain_waiter is None:
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+        await asyncio.shield(self._drain_waiter)
+
+    def close(self):
+        self._transport.close()
+
+    def detach(self) -> Optional[socket.socket]:
+        """
+        Closes the connection on this side only, and returns a duplicate of
+        its socket, to be served elsewhere. Only possible between frames,
+        with nothing buffered in either direction, otherwise returns None.
+        """
+        if self._closed or self._transport.is_closing() or \
+                self._start != self._end or not self._frames.empty() or \
+                self._transport.get_write_buffer_size() > 0:
+            return None
+        sock = self._transport.get_extra_info('socket')
+        # The duplicate keeps the connection open when the transport closes.
+        dup = socket.socket(fileno=os.dup(sock.fileno()))
+        self._transport.close()
+        return dup
+
+    async def _run(self):
+        try:
+            await self._client_cb(self)
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.close()
+
+    def _fail(self, exc: Exception):
+        self._failed = True
+        self._frames.put_nowait(exc)
+        self._pause_reading()
+
+    def _pause_reading(self):
+        if not self._reading_paused:
+            self._reading_paused = True
+            self._transport.pause_reading()
+
+    def _resume_reading(self):
+        if self._reading_paused and not self._failed and not self._closed:
+            self._reading_paused = False
+            self._transport.resume_reading()
+
+    def _wake_drain(self, exc: Optional[Exception] = None):
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is None or waiter.done():
+            return
+        if exc is None:
+            waiter.set_result(None)
+        else:
+            waiter.set_exception(exc)
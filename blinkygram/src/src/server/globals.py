@@ -1,14 +1,25 @@
 import dataclasses
 
 from auth import Authenticator
+from backup import BackupStore
 from database import Database
+from delivery import Delivery
+from handoff import Handoff
+from metrics import WorkerMetrics
+from monitor import LoopLagMonitor
+from throttle import WorkerThrottle
 
 
 @dataclasses.dataclass
 class Globals:
-    backup_path: str = None
+    backups: BackupStore = None
     auth: Authenticator = None
     db: Database = None
+    delivery: Delivery = None
+    handoff: Handoff = None
+    throttle: WorkerThrottle = None
+    lag_monitor: LoopLagMonitor = None
+    metrics: WorkerMetrics = None
 
 
 G = Globals()
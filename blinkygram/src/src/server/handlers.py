@@ -1,19 +1,17 @@
 import asyncio
 import dataclasses
 import os
-import json
 import shutil
-import shlex
 import sys
-import tempfile
 import traceback
-import uuid
+import zipfile
+import zlib
 
-from collections import OrderedDict
 from hashlib import sha256
 
+from backup import BackupException, ParentGone, extract_backup
 from globals import G
-from utils import USER_BACKUP
+from metrics import TIME_IO, timed
 
 from auth import *
 from database import *
@@ -22,6 +20,11 @@ from protocol import *
 
 MAX_CHAT_MSG_LEN = 1000
 
+# Batched reads are limited by count and by what fits in a single reply.
+MAX_CHAT_READ_MANY = 1024
+CHAT_READ_MANY_SIZE = MAX_MESSAGE_LEN - ReplyMessage.ok(ChatReadManyReply([])).dt_wire_size
+CHAT_READ_MANY_OVERHEAD = ChatReadReply(0, 0, '').dt_wire_size
+
 INITIAL_BALANCE = 10
 
 MAX_USER_BACKUPS = 5
@@ -34,44 +37,6 @@ class HandlerException(Exception):
     pass
 
 
-class MessageCache:
-    _lock = asyncio.Lock()
-    _uid_conds = OrderedDict()
-
-    _CACHE_SIZE = 1000
-
-    @staticmethod
-    async def read_one(uid: int, timeout: float = 5.0) -> Optional[Message]:
-        async with MessageCache._lock:
-            msg = await Message.read_one(G.db, uid)
-            if msg is not None:
-                return msg
-            cond = MessageCache._get_uid_cond(uid, add=True)
-            try:
-                await asyncio.wait_for(cond.wait(), timeout=timeout)
-            except asyncio.TimeoutError:
-                return None
-            return await Message.read_one(G.db, uid)
-
-    @staticmethod
-    async def notify_one(uid: int):
-        async with MessageCache._lock:
-            cond = MessageCache._get_uid_cond(uid)
-            if cond is not None:
-                cond.notify()
-
-    @staticmethod
-    def _get_uid_cond(uid: int, add: bool = False) -> Optional[asyncio.Condition]:
-        if uid in MessageCache._uid_conds:
-            MessageCache._uid_conds.move_to_end(uid)
-        elif add:
-            while len(MessageCache._uid_conds) >= MessageCache._CACHE_SIZE:
-                MessageCache._uid_conds.popitem(last=False)
-            MessageCache._uid_conds[uid] = asyncio.Condition(
-                MessageCache._lock)
-        return MessageCache._uid_conds.get(uid)
-
-
 handler_map = {}
 
 
@@ -84,8 +49,9 @@ def handler(req_cls: type):
 
 def authenticated(func):
     async def wrapper(req):
-        if not G.auth.check_token(req.auth_token):
+        if not await G.auth.check_token(req.auth_token):
             return ReplyMessage.fail('Unauthorized')
+        await G.throttle.throttle_user(req.auth_token.userid)
         return await func(req, req.auth_token.userid)
     return wrapper
 
@@ -100,6 +66,12 @@ async def handle_request(req: RequestMessage):
     return await func(req)
 
 
+@timed(TIME_IO)
+async def run_io(func, *args):
+    # Blocking file operations, in the default executor.
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
 async def get_balance(userid: int, currency: int) -> Balance:
     balance = await Balance.find(G.db, userid, currency)
     if balance is None:
@@ -133,7 +105,7 @@ async def auth_handler(req: AuthRequest):
         return ReplyMessage.fail('User not found')
     if sha256(req.password.encode()).hexdigest() != user.password:
         return ReplyMessage.fail('Wrong password')
-    token = G.auth.make_token(user.id)
+    token = await G.auth.make_token(user.id)
     return ReplyMessage.ok(AuthReply(token))
 
 
@@ -174,19 +146,31 @@ async def chat_send_handler(req: ChatSendRequest, userid: int):
         return ReplyMessage.fail('Recipient not found')
     msg = Message(userid, req.recipient_userid, req.content)
     await msg.commit(G.db)
-    await MessageCache.notify_one(req.recipient_userid)
+    G.delivery.notify(req.recipient_userid)
     return ReplyMessage.ok()
 
 
 @handler(ChatReadRequest)
 @authenticated
 async def chat_read_handler(req: ChatReadRequest, userid: int):
-    msg = await MessageCache.read_one(userid)
+    msg = await G.delivery.read_one(userid)
     if msg is None:
         return ReplyMessage.fail('No messages')
     return ReplyMessage.ok(ChatReadReply(msg.uid_src, msg.timestamp, msg.content))
 
 
+@handler(ChatReadManyRequest)
+@authenticated
+async def chat_read_many_handler(req: ChatReadManyRequest, userid: int):
+    count = min(req.count, MAX_CHAT_READ_MANY)
+    if count == 0:
+        return ReplyMessage.fail('Invalid count')
+    msgs = await G.delivery.read_many(userid, count, CHAT_READ_MANY_SIZE,
+                                      CHAT_READ_MANY_OVERHEAD)
+    return ReplyMessage.ok(ChatReadManyReply([
+        ChatReadReply(msg.uid_src, msg.timestamp, msg.content) for msg in msgs]))
+
+
 @handler(BalanceRequest)
 @authenticated
 async def balance_handler(req: BalanceRequest, userid: int):
@@ -201,12 +185,12 @@ async def balance_handler(req: BalanceRequest, userid: int):
 @authenticated
 async def transfer_handler(req: TransferRequest, userid: int):
     try:
-        await get_balance(userid, req.currency)
+        if not await Balance.withdraw(G.db, userid, req.currency, req.amount,
+                                      INITIAL_BALANCE):
+            return ReplyMessage.fail('Insufficient balance')
     except CurrencyNotExists:
         return ReplyMessage.fail('Unknown currency')
-    if not await Balance.adjust(G.db, userid, req.currency, -req.amount):
-        return ReplyMessage.fail('Insufficient balance')
-    receipt = G.auth.make_receipt(
+    receipt = await G.auth.make_receipt(
         req.amount, req.currency, req.recipient_userid)
     return ReplyMessage.ok(TransferReply(receipt))
 
@@ -214,24 +198,24 @@ async def transfer_handler(req: TransferRequest, userid: int):
 @handler(ReceiveRequest)
 @authenticated
 async def receive_handler(req: ReceiveRequest, userid: int):
-    if not G.auth.check_receipt(req.receipt):
+    if not await G.auth.check_receipt(req.receipt):
         return ReplyMessage.fail('Invalid receipt')
     if userid != req.receipt.recipient_userid:
         return ReplyMessage.fail('Not your receipt')
-    if not await SpentReceipt.spend(G.db, req.receipt.dt_encode()):
-        return ReplyMessage.fail('Already spent')
     try:
-        await get_balance(userid, req.receipt.currency)
+        if not await SpentReceipt.redeem(G.db, req.receipt.dt_encode(), userid,
+                                         req.receipt.currency, req.receipt.amount,
+                                         INITIAL_BALANCE):
+            return ReplyMessage.fail('Already spent')
     except CurrencyNotExists:
         return ReplyMessage.fail('Unknown currency')
-    await Balance.adjust(G.db, userid, req.receipt.currency, req.receipt.amount)
     return ReplyMessage.ok()
 
 
 @handler(CheckReceiptRequest)
 @authenticated
 async def check_receipt_handler(req: CheckReceiptRequest, userid: int):
-    if not G.auth.check_receipt(req.receipt):
+    if not await G.auth.check_receipt(req.receipt):
         return ReplyMessage.fail('Invalid receipt')
     if await SpentReceipt.find(G.db, req.receipt.dt_encode()):
         return ReplyMessage.fail('Already spent')
@@ -251,85 +235,73 @@ async def mint_handler(req: MintRequest, userid: int):
 @handler(NewBackupRequest)
 @authenticated
 async def new_backup_handler(req: NewBackupRequest, userid: int):
-    backup_id = str(uuid.uuid4())
-    user_backups_dir = f'{G.backup_path}/{userid}'
-    backup_dir = f'{user_backups_dir}/{backup_id}'
+    loop = asyncio.get_running_loop()
 
+    backup_dir = None
+    added = False
     try:
-        os.makedirs(backup_dir)
-        os.chmod(user_backups_dir, 0o777)
-        os.chmod(backup_dir, 0o777)
-
-        existing_backups = [f'{user_backups_dir}/{name}'
-                            for name in os.listdir(user_backups_dir)]
-        if len(existing_backups) >= MAX_USER_BACKUPS-1:
-            existing_backups.sort(key=os.path.getctime)
-            for path in existing_backups[:-(MAX_USER_BACKUPS-1)]:
-                shutil.rmtree(path, ignore_errors=True)
+        backup_id, backup_dir = G.backups.new_dir(userid)
 
         if len(req.data) > 0 and len(req.data) < MAX_USER_BACKUP_SIZE:
-            with tempfile.TemporaryDirectory() as tmpdir:
-                tmpzip = f'{tmpdir}/backup.zip'
-                with open(tmpzip, 'wb') as f:
-                    f.write(req.data)
-                os.chmod(tmpdir, 0o777)
-                os.chmod(tmpzip, 0o664)
-                process = await asyncio.subprocess.create_subprocess_exec(
-                    'sudo', '-u', USER_BACKUP, '--', 'sh', '-c',
-                    f'ulimit -f 64 && cd {backup_dir} && unzip {tmpzip} messages public_key balance',
-                    stdout=asyncio.subprocess.DEVNULL,
-                    stderr=asyncio.subprocess.DEVNULL
-                )
-                await process.wait()
-                if process.returncode != 0:
-                    return ReplyMessage.fail(f'Backup failed (cannot unzip)')
+            try:
+                await run_io(extract_backup, bytes(req.data), backup_dir)
+            except (BackupException, zipfile.BadZipFile, zlib.error,
+                    NotImplementedError, RuntimeError, EOFError):
+                return ReplyMessage.fail(f'Backup failed (cannot unzip)')
+            compact = await run_io(G.backups.add, userid, backup_id)
         else:
-            with open(f'{backup_dir}/messages', 'w') as f:
-                msgs = await Message.all_by_user(G.db, userid)
-                json.dump([dataclasses.asdict(msg) for msg in msgs], f)
-            os.chmod(f'{backup_dir}/messages', 0o664)
-            with open(f'{backup_dir}/public_key', 'w') as f:
-                user = await User.by_id(G.db, userid)
-                f.write(user.pubkey)
-            os.chmod(f'{backup_dir}/public_key', 0o664)
-            with open(f'{backup_dir}/balance', 'w') as f:
-                balances = await Balance.all_by_user(G.db, userid)
-                json.dump([dataclasses.asdict(balance)
-                           for balance in balances], f)
-            os.chmod(f'{backup_dir}/balance', 0o664)
+            try:
+                await write_snapshot(userid, backup_dir, incremental=True)
+                compact = await run_io(G.backups.add, userid, backup_id)
+            except ParentGone:
+                await write_snapshot(userid, backup_dir, incremental=False)
+                compact = await run_io(G.backups.add, userid, backup_id)
+        added = True
+
+        if compact:
+            loop.run_in_executor(None, G.backups.compact, userid) \
+                .add_done_callback(print_exception)
     except Exception:
         traceback.print_exc()
         return ReplyMessage.fail(f'Backup failed')
+    finally:
+        # Backups not added to the index must not be served.
+        if backup_dir is not None and not added:
+            shutil.rmtree(backup_dir, ignore_errors=True)
 
     return ReplyMessage.ok(NewBackupReply(backup_id))
 
 
+async def write_snapshot(userid: int, backup_dir: str, incremental: bool):
+    parent, last_id = None, 0
+    if incremental:
+        parent, last_id = await run_io(G.backups.head, userid)
+    msgs = await Message.all_by_user(G.db, userid, after_id=last_id)
+    user = await User.by_id(G.db, userid)
+    balances = await Balance.all_by_user(G.db, userid)
+    await run_io(
+        G.backups.write_snapshot, userid, backup_dir, parent, last_id,
+        [dataclasses.asdict(msg) for msg in msgs], user.pubkey,
+        [dataclasses.asdict(balance) for balance in balances])
+
+
+def print_exception(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        exc = future.exception()
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+
 @handler(GetBackupRequest)
 @authenticated
 async def get_backup_handler(req: GetBackupRequest, userid: int):
-    user_backups_dir = f'{G.backup_path}/{userid}'
-    backup_dir = f'{user_backups_dir}/{req.id}'
-
-    if not os.path.isdir(backup_dir):
-        return ReplyMessage.fail(f'Backup not found')
-
     try:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            tmpzip = f'{tmpdir}/backup.zip'
-            os.chmod(tmpdir, 0o777)
-            process = await asyncio.subprocess.create_subprocess_exec(
-                'sudo', '-u', USER_BACKUP, '--', 'sh', '-c',
-                f'ulimit -f 64 && cd {shlex.quote(backup_dir)} && zip {tmpzip} messages public_key balance && chmod 664 {tmpzip}',
-                stdout=asyncio.subprocess.DEVNULL,
-                stderr=asyncio.subprocess.DEVNULL
-            )
-            await process.wait()
-            if process.returncode != 0:
-                return ReplyMessage.fail(f'Get backup failed (cannot zip)')
-            with open(tmpzip, 'rb') as f:
-                backup = f.read()
+        backup = await run_io(G.backups.archive, userid, req.id)
+    except (BackupException, OSError):
+        return ReplyMessage.fail(f'Get backup failed (cannot zip)')
     except Exception:
         traceback.print_exc()
         return ReplyMessage.fail(f'Get backup failed')
 
+    if backup is None:
+        return ReplyMessage.fail(f'Backup not found')
     return ReplyMessage.ok(GetBackupReply(backup))
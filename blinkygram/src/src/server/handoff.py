@@ -0,0 +1,105 @@
+import array
+import asyncio
+import os
+import random
+import socket
+
+from typing import Callable, List, Set
+
+
+class Handoff:
+    """
+    Hands idle client connections over to other workers, so that a
+    draining worker does not drop long-lived connections. Every worker
+    listens on a Unix datagram socket in a shared directory, and receives
+    connection sockets as SCM_RIGHTS file descriptors, which it then serves
+    as if it had accepted them.
+    """
+
+    def __init__(self, path: str, protocol_factory: Callable[[], asyncio.BaseProtocol]):
+        self._path = path
+        self._sock_path = f'{path}/{os.getpid()}'
+        self._protocol_factory = protocol_factory
+        self._sock: socket.socket = None
+        self._receiving = False
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def start(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        try:
+            os.unlink(self._sock_path)
+        except FileNotFoundError:
+            pass
+        self._sock.bind(self._sock_path)
+        asyncio.get_running_loop().add_reader(
+            self._sock.fileno(), self._on_readable)
+        self._receiving = True
+
+    def stop_receiving(self):
+        """
+        Stops accepting connections from other workers, passing on those
+        already sent to this one.
+        """
+        if not self._receiving:
+            return
+        self._receiving = False
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        try:
+            os.unlink(self._sock_path)
+        except FileNotFoundError:
+            pass
+        self._on_readable()
+
+    def close(self):
+        if self._sock is None:
+            return
+        self.stop_receiving()
+        self._sock.close()
+        self._sock = None
+
+    def peers(self) -> List[str]:
+        return [entry.path for entry in os.scandir(self._path)
+                if entry.path != self._sock_path]
+
+    def send(self, sock: socket.socket) -> bool:
+        """
+        Sends a connection socket to another worker, and closes it here.
+        Returns False if no worker took it, leaving it open.
+        """
+        peers = self.peers()
+        random.shuffle(peers)
+        for peer in peers:
+            try:
+                # socket.send_fds() ignores its address.
+                self._sock.sendmsg([b'\0'], [(
+                    socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                    array.array('i', [sock.fileno()]))], 0, peer)
+            except OSError:
+                # Worker gone or draining, or backlogged.
+                continue
+            sock.close()
+            return True
+        return False
+
+    def _on_readable(self):
+        while True:
+            try:
+                _, fds, _, _ = socket.recv_fds(self._sock, 1, 1)
+            except BlockingIOError:
+                return
+            for fd in fds:
+                sock = socket.socket(fileno=fd)
+                if self._receiving or not self.send(sock):
+                    self.serve(sock)
+
+    def serve(self, sock: socket.socket):
+        """
+        Serves a connection socket in this worker.
+        """
+        sock.setblocking(False)
+        loop = asyncio.get_running_loop()
+        task = loop.create_task(
+            loop.connect_accepted_socket(self._protocol_factory, sock))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
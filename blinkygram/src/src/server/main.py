@@ -1,96 +1,310 @@
 #!/usr/bin/env python3
 
 import os
+import json
 import random
+import shutil
 import signal
+import socket
 import sys
 import time
 import asyncio
-import multiprocessing
+import dataclasses
 
-from typing import Awaitable
+from typing import Awaitable, Callable, Dict, Optional, Set
 
-from auth import Authenticator
+from auth import DEFAULT_BACKEND, Authenticator, SignatureBackend
+from backup import BackupStore
 from database import Database
+from delivery import Delivery
+from framing import FrameProtocol
+from handoff import Handoff
 from globals import G
-from protocol import MessageHeader, RequestMessage
-from handlers import handle_request
+from handlers import MAX_USER_BACKUPS, handle_request
+from metrics import TIME_IO, Metrics, timed
+from monitor import LoopLagMonitor
+from protocol import REPLY_STATUS_OK, ReplyMessage, RequestMessage
+from supervisor import HEARTBEAT_INTERVAL, Supervisor, WorkerStatus
+from throttle import Throttle
+from usercache import InvalidationLog, UserCache
 from utils import set_perms_server
 
 
 BIND_HOST = os.environ['SERVER_BIND_HOST']
 BIND_PORT = int(os.environ['SERVER_BIND_PORT'])
 WORKERS = int(os.environ['SERVER_WORKERS'])
+# Upper bound for scaling up with SIGTTIN.
+MAX_WORKERS = max(int(os.environ.get('SERVER_MAX_WORKERS', 2 * WORKERS)), WORKERS)
 THROTTLE_RPS = float(os.environ['SERVER_THROTTLE_RPS'])
+THROTTLE_BURST = float(os.environ.get('SERVER_THROTTLE_BURST', 1))
+THROTTLE_IP_RPS = float(os.environ.get('SERVER_THROTTLE_IP_RPS', 0))
+THROTTLE_IP_BURST = float(os.environ.get('SERVER_THROTTLE_IP_BURST', 1))
+THROTTLE_USER_RPS = float(os.environ.get('SERVER_THROTTLE_USER_RPS', 0))
+THROTTLE_USER_BURST = float(os.environ.get('SERVER_THROTTLE_USER_BURST', 1))
+PIPELINE_DEPTH = int(os.environ.get('SERVER_PIPELINE_DEPTH', 1))
+# Group commit window in seconds, zero disables group commit.
+DB_GROUP_WINDOW = float(os.environ.get('SERVER_DB_GROUP_WINDOW', 0))
+DB_GROUP_SIZE = int(os.environ.get('SERVER_DB_GROUP_SIZE', 64))
+TOKEN_CACHE_SIZE = int(os.environ.get('SERVER_TOKEN_CACHE_SIZE', 4096))
+USER_CACHE_SIZE = int(os.environ.get('SERVER_USER_CACHE_SIZE', 4096))
+CRYPTO_BACKEND = os.environ.get('SERVER_CRYPTO_BACKEND', DEFAULT_BACKEND)
+# Crypto thread pool size, by default only used if the backend releases the GIL.
+CRYPTO_THREADS = os.environ.get('SERVER_CRYPTO_THREADS')
+CRYPTO_THREADS = int(CRYPTO_THREADS) if CRYPTO_THREADS else None
+# Interval in seconds between dumps of the request metrics of all workers to
+# STATS_PATH, zero disables metrics.
+STATS_INTERVAL = float(os.environ.get('SERVER_STATS_INTERVAL', 0))
+# Workers with a heartbeat older than this are restarted.
+HEALTH_TIMEOUT = float(os.environ.get('SERVER_HEALTH_TIMEOUT', 10))
+# Time given to a stopping worker to finish its requests.
+DRAIN_TIMEOUT = float(os.environ.get('SERVER_DRAIN_TIMEOUT', 10))
 
 SOCKET_TIMEOUT = 30
+LISTEN_BACKLOG = 1024
 
 STORAGE_PATH = './storage'
 BACKUP_PATH = f'{STORAGE_PATH}/backups'
+DELIVERY_PATH = f'{STORAGE_PATH}/delivery'
+HANDOFF_PATH = f'{STORAGE_PATH}/handoff'
 DB_PATH = f'{STORAGE_PATH}/data.db'
 SK_PATH = f'{STORAGE_PATH}/sk.pem'
+STATS_PATH = f'{STORAGE_PATH}/stats.json'
+WORKERS_PATH = f'{STORAGE_PATH}/workers.json'
 
 
 async def timeout(aw: Awaitable) -> Awaitable:
     return await asyncio.wait_for(aw, timeout=SOCKET_TIMEOUT)
 
 
-async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    while True:
-        try:
-            hdr_bs = await timeout(reader.readexactly(MessageHeader.SIZE))
-        except asyncio.IncompleteReadError as e:
-            if len(e.partial) == 0:
+async def handle_frame(conn: FrameProtocol, seq: int, msg: RequestMessage):
+    if G.metrics is None:
+        reply = await handle_request(msg.req)
+        await send_reply(conn, seq, reply)
+        return
+
+    # Timed until the reply is drained. The database, crypto and I/O calls
+    # made by this task add up their times.
+    start = time.perf_counter()
+    times = G.metrics.start()
+    ok = False
+    try:
+        reply = await handle_request(msg.req)
+        ok = reply.status == REPLY_STATUS_OK
+        await send_reply(conn, seq, reply)
+    finally:
+        G.metrics.record(msg.kind, ok, time.perf_counter() - start, times)
+
+
+@timed(TIME_IO)
+async def send_reply(conn: FrameProtocol, seq: int, reply: ReplyMessage):
+    conn.write_frame(seq, reply.dt_encode())
+    if draining:
+        # Before the client can send another request.
+        release(conn, asyncio.current_task())
+    await timeout(conn.drain())
+
+
+async def handle_client(conn: FrameProtocol):
+    # Up to PIPELINE_DEPTH requests per connection are handled concurrently,
+    # and their replies are written as they complete, tagged by sequence
+    # number. Dispatches wait for the connection and source IP throttles.
+    global in_flight, requests
+    slots = asyncio.Semaphore(PIPELINE_DEPTH)
+    tasks = set()
+    failed = []
+
+    def task_done(task: asyncio.Task):
+        global in_flight
+        in_flight -= 1
+        tasks.discard(task)
+        slots.release()
+        if not task.cancelled() and task.exception() is not None:
+            failed.append(task.exception())
+            conn.close()
+
+    bucket = G.throttle.connection_bucket()
+    connections[conn] = tasks
+    try:
+        while not failed:
+            waiting.add(conn)
+            try:
+                frame = await timeout(conn.read_frame())
+            finally:
+                waiting.discard(conn)
+            if frame is None:
                 break
-            raise e
+            seq, msg = frame
 
-        hdr = MessageHeader.dt_decode(hdr_bs)
-        msg_bs = await timeout(reader.readexactly(hdr.length))
-        msg = RequestMessage.dt_decode(msg_bs)
+            await slots.acquire()
+            await G.throttle.throttle_connection(bucket, conn.peer_host)
 
-        t1 = time.time()
-        reply = await handle_request(msg.req)
-        reply_bs = reply.dt_encode()
-        reply_hdr_bs = MessageHeader(hdr.seq, len(reply_bs)).dt_encode()
-        writer.write(reply_hdr_bs + reply_bs)
-        await timeout(writer.drain())
-        t2 = time.time()
+            task = asyncio.create_task(handle_frame(conn, seq, msg))
+            tasks.add(task)
+            in_flight += 1
+            requests += 1
+            task.add_done_callback(task_done)
 
-        throttle_sleep = 1 / THROTTLE_RPS - (t2 - t1)
-        if throttle_sleep > 0:
-            await asyncio.sleep(throttle_sleep)
+        if tasks:
+            await asyncio.wait(tasks)
+    finally:
+        connections.pop(conn, None)
+        for task in tasks:
+            task.cancel()
+
+    if failed:
+        raise failed[0]
+
+
+def print_worker_stats():
+    stats = {
+        'loop_lag': G.lag_monitor.stats(reset=True),
+        'token_cache': {
+            'size': len(G.auth.token_cache),
+            'hits': G.auth.token_cache.hits,
+            'misses': G.auth.token_cache.misses,
+        },
+        'user_cache': {
+            'size': len(G.db.user_cache),
+            'hits': G.db.user_cache.hits,
+            'misses': G.db.user_cache.misses,
+        },
+    }
+    print(f'Worker {os.getpid()}: {json.dumps(stats)}')
+    sys.stdout.flush()
 
 
-async def initialize_worker():
-    loop = asyncio.get_event_loop()
-    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+@dataclasses.dataclass
+class Shared:
+    """
+    State set up before forking, shared by all workers.
+    """
+    listener: socket.socket
+    auth_backend: SignatureBackend
+    throttle: Throttle
+    invalidations: InvalidationLog
+    status: WorkerStatus
+    metrics: Optional[Metrics]
+
 
-    G.backup_path = BACKUP_PATH
-    G.auth = Authenticator.from_path(SK_PATH)
-    G.db = Database(DB_PATH, concurrency=WORKERS)
+# Connections of this worker with their requests in flight, those waiting
+# for a request, and request counters, for its status.
+connections: Dict[FrameProtocol, Set[asyncio.Task]] = {}
+waiting: Set[FrameProtocol] = set()
+in_flight = 0
+requests = 0
+draining = False
+# Set by SIGTERM until the worker loop installs its own handler.
+stop_requested = False
+
+
+async def initialize_worker(shared: Shared, slot: int):
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGUSR1, print_worker_stats)
+
+    metrics = shared.metrics.worker(slot) if shared.metrics else None
+    G.backups = BackupStore(BACKUP_PATH, keep=MAX_USER_BACKUPS)
+    G.throttle = shared.throttle.worker(slot)
+    G.metrics = metrics
+    G.auth = Authenticator(shared.auth_backend, TOKEN_CACHE_SIZE, CRYPTO_THREADS)
+    G.lag_monitor = LoopLagMonitor(metrics=metrics)
+    G.lag_monitor.start()
+    G.db = Database(DB_PATH, concurrency=WORKERS,
+                    group_window=DB_GROUP_WINDOW, group_size=DB_GROUP_SIZE,
+                    user_cache=UserCache(USER_CACHE_SIZE, shared.invalidations))
     await G.db.connect()
+    G.delivery = Delivery(G.db, DELIVERY_PATH)
+    await G.delivery.start()
+    G.handoff = Handoff(HANDOFF_PATH, lambda: FrameProtocol(handle_client))
+    await G.handoff.start()
 
 
 async def shutdown_worker():
+    G.handoff.close()
+    G.delivery.close()
+    G.auth.close()
     await G.db.close()
 
 
-async def worker_main():
-    await initialize_worker()
-    server = await asyncio.start_server(
-        handle_client, BIND_HOST, BIND_PORT, reuse_port=True)
-    async with server:
-        await server.serve_forever()
+async def heartbeat(status: WorkerStatus, slot: int):
+    while True:
+        status.update(slot, len(connections), in_flight, requests)
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+def release(conn: FrameProtocol, current: asyncio.Task = None):
+    # Hands an idle connection over to another worker, or closes it if there
+    # are none (the whole server is stopping). Idle means waiting for a
+    # request with none in flight, other than the current one if it has
+    # written its reply.
+    if conn not in waiting or not connections[conn] <= {current}:
+        return
+    if not G.handoff.peers():
+        conn.close()
+        return
+    sock = conn.detach()
+    if sock is not None and not G.handoff.send(sock):
+        G.handoff.serve(sock)
+
+
+async def drain(server: asyncio.AbstractServer):
+    # The listener stays open in the supervisor and the other workers: only
+    # this worker stops accepting. Connections are released as soon as they
+    # are idle, either here or right after a reply. Whatever is left after
+    # DRAIN_TIMEOUT is closed.
+    global draining
+    draining = True
+    server.close()
+    G.handoff.stop_receiving()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + DRAIN_TIMEOUT
+    while connections and loop.time() < deadline:
+        for conn in list(connections):
+            release(conn)
+        await asyncio.sleep(0.1)
+    for conn in list(connections):
+        conn.close()
+
+
+async def worker_main(shared: Shared, slot: int):
+    await initialize_worker(shared, slot)
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    # A SIGTERM received while initializing is not lost.
+    if stop_requested:
+        stop.set()
+
+    server = await loop.create_server(
+        lambda: FrameProtocol(handle_client), sock=shared.listener)
+    heartbeat_task = asyncio.create_task(heartbeat(shared.status, slot))
+    try:
+        await stop.wait()
+        print(f'Worker {os.getpid()} draining')
+        sys.stdout.flush()
+        await drain(server)
+    finally:
+        heartbeat_task.cancel()
+
 
+def stop_request_handler(signum, frame):
+    global stop_requested
+    stop_requested = True
 
-def worker():
+
+def worker(shared: Shared, slot: int):
     print(f'Worker running')
     sys.stdout.flush()
 
     random.seed()
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    # Signals for the supervisor, in case they are sent to the process group.
+    for signum in [signal.SIGINT, signal.SIGHUP, signal.SIGTTIN, signal.SIGTTOU]:
+        signal.signal(signum, signal.SIG_IGN)
+    # Replaces the SIGTERM handler inherited from the supervisor.
+    signal.signal(signal.SIGTERM, stop_request_handler)
 
     try:
-        asyncio.run(worker_main())
+        asyncio.run(worker_main(shared, slot))
     finally:
         asyncio.run(shutdown_worker())
 
@@ -99,8 +313,13 @@ async def initialize_main():
     os.makedirs(STORAGE_PATH, exist_ok=True)
     os.makedirs(BACKUP_PATH, exist_ok=True)
     os.chmod(BACKUP_PATH, 0o777)
+    for path in [DELIVERY_PATH, HANDOFF_PATH]:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        set_perms_server(path)
 
-    Authenticator.from_path(SK_PATH)
+    # The key is loaded once, and inherited by the workers.
+    auth = Authenticator.from_path(SK_PATH, backend=CRYPTO_BACKEND, threads=0)
     set_perms_server(SK_PATH)
 
     db = Database(DB_PATH)
@@ -108,24 +327,72 @@ async def initialize_main():
     await db.close()
     set_perms_server(DB_PATH)
 
+    return auth.backend
 
-def main():
-    print(f'Starting up on {BIND_HOST}:{BIND_PORT} with {WORKERS} workers')
-    sys.stdout.flush()
 
-    asyncio.run(initialize_main())
+def stats_dumper(metrics: Metrics) -> Callable[[], None]:
+    # Runs in the supervisor loop rather than a thread: the supervisor forks.
+    next_time = time.monotonic() + STATS_INTERVAL
 
-    procs = [multiprocessing.Process(target=worker) for _ in range(WORKERS)]
-    for proc in procs:
-        proc.start()
+    def dump_stats():
+        nonlocal next_time
+        if time.monotonic() < next_time:
+            return
+        next_time = time.monotonic() + STATS_INTERVAL
+        tmp_path = f'{STATS_PATH}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(metrics.stats(), f, indent=2)
+        os.replace(tmp_path, STATS_PATH)
 
-    def sigterm_handler(signum, frame):
-        for proc in procs:
-            proc.terminate()
-    signal.signal(signal.SIGTERM, sigterm_handler)
+    return dump_stats
+
+
+def remove_worker_sockets(pid: int):
+    # A crashed worker leaves its sockets behind.
+    for path in [DELIVERY_PATH, HANDOFF_PATH]:
+        try:
+            os.unlink(f'{path}/{pid}')
+        except FileNotFoundError:
+            pass
+
+
+def main():
+    print(f'Starting up on {BIND_HOST}:{BIND_PORT} with {WORKERS} workers '
+          f'({CRYPTO_BACKEND} crypto backend)')
+    sys.stdout.flush()
 
-    for proc in procs:
-        proc.join()
+    auth_backend = asyncio.run(initialize_main())
+
+    # Workers accept from this socket, which stays open as they come and go.
+    listener = socket.create_server(
+        (BIND_HOST, BIND_PORT), backlog=LISTEN_BACKLOG, reuse_port=True)
+
+    # One slot per worker that can run at once, the spare one for reloads.
+    slots = MAX_WORKERS + 1
+    throttle = Throttle(slots, THROTTLE_RPS, THROTTLE_BURST,
+                        THROTTLE_IP_RPS, THROTTLE_IP_BURST,
+                        THROTTLE_USER_RPS, THROTTLE_USER_BURST)
+    invalidations = InvalidationLog()
+    status = WorkerStatus(slots)
+    metrics = Metrics(slots) if STATS_INTERVAL else None
+    shared = Shared(listener, auth_backend, throttle, invalidations, status, metrics)
+
+    supervisor = Supervisor(
+        lambda slot: worker(shared, slot), WORKERS, MAX_WORKERS, status,
+        WORKERS_PATH, HEALTH_TIMEOUT, DRAIN_TIMEOUT, remove_worker_sockets,
+        stats_dumper(metrics) if metrics is not None else None)
+
+    def sigusr1_handler(signum, frame):
+        print(f'Throttle: {json.dumps(throttle.stats())}')
+        if metrics is not None:
+            print(f'Metrics: {json.dumps(metrics.stats())}')
+        print(f'Workers: {json.dumps(supervisor.stats())}')
+        sys.stdout.flush()
+        for pid in supervisor.pids():
+            os.kill(pid, signal.SIGUSR1)
+    signal.signal(signal.SIGUSR1, sigusr1_handler)
+
+    supervisor.run()
 
 
 if __name__ == '__main__':
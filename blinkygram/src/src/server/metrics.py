@@ -0,0 +1,202 @@
+import time
+import functools
+import contextvars
+
+from ctypes import c_uint64
+from multiprocessing.sharedctypes import RawArray
+from typing import Dict, List, Optional
+
+from protocol import request_kind_map
+
+
+# Categories of time spent handling a request.
+TIME_DB = 0
+TIME_CRYPTO = 1
+TIME_IO = 2
+TIME_CATEGORIES = ['db', 'crypto', 'io']
+
+# Latency histogram buckets have HISTOGRAM_PRECISION significant bits (at most
+# 1/4 relative error), up to HISTOGRAM_MAX microseconds.
+HISTOGRAM_PRECISION = 3
+HISTOGRAM_MAX = 1 << 24
+PERCENTILES = [50, 90, 99]
+
+# Counters of each request kind, followed by its histogram.
+FIELD_COUNT = 0
+FIELD_ERRORS = 1
+FIELD_TOTAL_US = 2
+FIELD_TIME_US = 3
+KIND_FIELDS = FIELD_TIME_US + len(TIME_CATEGORIES)
+
+# Event loop lag counters of each worker, after its request kinds.
+FIELD_LAG_SAMPLES = 0
+FIELD_LAG_TOTAL_US = 1
+FIELD_LAG_MAX_US = 2
+LAG_FIELDS = 3
+
+_times: contextvars.ContextVar[Optional[List[float]]] = \
+    contextvars.ContextVar('times', default=None)
+
+
+def timed(category: int):
+    """
+    Decorator adding the time spent in a coroutine function to the given
+    category of the request being handled, if any.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            times = _times.get()
+            if times is None:
+                return await func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                times[category] += time.perf_counter() - start
+        return wrapper
+    return decorator
+
+
+def _bucket_index(value: int) -> int:
+    sub = 1 << HISTOGRAM_PRECISION
+    if value < sub:
+        return value
+    shift = value.bit_length() - HISTOGRAM_PRECISION
+    return (shift + 1) * (sub >> 1) + (value >> shift) - (sub >> 1)
+
+
+def _bucket_highest(index: int) -> int:
+    sub = 1 << HISTOGRAM_PRECISION
+    if index < sub:
+        return index
+    half = sub >> 1
+    shift = index // half - 1
+    return ((index % half + half + 1) << shift) - 1
+
+
+NUM_BUCKETS = _bucket_index(HISTOGRAM_MAX - 1) + 1
+
+
+class Metrics:
+    """
+    Request counters, latency histograms and time breakdowns by request
+    kind, plus event loop lag, of all workers. They are kept in shared
+    memory, each worker recording into its own slot without locking, so
+    that any process can aggregate them.
+    """
+
+    def __init__(self, workers: int):
+        self._kinds = sorted(request_kind_map)
+        self._kind_index = {kind: i for i, kind in enumerate(self._kinds)}
+        self._kind_size = KIND_FIELDS + NUM_BUCKETS
+        self._worker_size = len(self._kinds) * self._kind_size + LAG_FIELDS
+        self._workers = workers
+        self._counters = RawArray(c_uint64, workers * self._worker_size)
+
+    def worker(self, index: int) -> 'WorkerMetrics':
+        return WorkerMetrics(self, index)
+
+    def stats(self) -> dict:
+        counters = self._counters
+        requests = {}
+        for kind_index, kind in enumerate(self._kinds):
+            fields = [0] * KIND_FIELDS
+            buckets = [0] * NUM_BUCKETS
+            for worker in range(self._workers):
+                base = worker * self._worker_size + kind_index * self._kind_size
+                for i in range(KIND_FIELDS):
+                    fields[i] += counters[base + i]
+                for i in range(NUM_BUCKETS):
+                    buckets[i] += counters[base + KIND_FIELDS + i]
+            if fields[FIELD_COUNT]:
+                name = request_kind_map[kind].__name__.removesuffix('Request')
+                requests[name] = _kind_stats(fields, buckets)
+
+        workers = []
+        for worker in range(self._workers):
+            base = (worker + 1) * self._worker_size - LAG_FIELDS
+            samples = counters[base + FIELD_LAG_SAMPLES]
+            workers.append({
+                'requests': sum(
+                    counters[worker * self._worker_size + i * self._kind_size + FIELD_COUNT]
+                    for i in range(len(self._kinds))),
+                'loop_lag': {
+                    'samples': samples,
+                    'avg_ms': counters[base + FIELD_LAG_TOTAL_US] / samples / 1e3
+                    if samples else 0.0,
+                    'max_ms': counters[base + FIELD_LAG_MAX_US] / 1e3,
+                },
+            })
+
+        return {'requests': requests, 'workers': workers}
+
+
+class WorkerMetrics:
+    def __init__(self, metrics: Metrics, index: int):
+        self._counters = metrics._counters
+        self._kind_index = metrics._kind_index
+        self._kind_size = metrics._kind_size
+        self._base = index * metrics._worker_size
+        self._lag_base = (index + 1) * metrics._worker_size - LAG_FIELDS
+
+    def start(self) -> List[float]:
+        """
+        Starts timing a request in the current task, and returns its time
+        breakdown, to be passed to record() once handled.
+        """
+        times = [0.0] * len(TIME_CATEGORIES)
+        _times.set(times)
+        return times
+
+    def record(self, kind: int, ok: bool, elapsed: float, times: List[float]):
+        counters = self._counters
+        base = self._base + self._kind_index[kind] * self._kind_size
+        elapsed_us = int(elapsed * 1e6)
+        # The bucket first, so that a request counted is in the histogram.
+        bucket = _bucket_index(min(elapsed_us, HISTOGRAM_MAX - 1))
+        counters[base + KIND_FIELDS + bucket] += 1
+        counters[base + FIELD_COUNT] += 1
+        if not ok:
+            counters[base + FIELD_ERRORS] += 1
+        counters[base + FIELD_TOTAL_US] += elapsed_us
+        for i, category_time in enumerate(times):
+            counters[base + FIELD_TIME_US + i] += int(category_time * 1e6)
+
+    def record_lag(self, lag: float):
+        counters = self._counters
+        lag_us = int(lag * 1e6)
+        counters[self._lag_base + FIELD_LAG_SAMPLES] += 1
+        counters[self._lag_base + FIELD_LAG_TOTAL_US] += lag_us
+        if lag_us > counters[self._lag_base + FIELD_LAG_MAX_US]:
+            counters[self._lag_base + FIELD_LAG_MAX_US] = lag_us
+
+
+def _kind_stats(fields: List[int], buckets: List[int]) -> Dict[str, float]:
+    count = fields[FIELD_COUNT]
+    stats = {
+        'count': count,
+        'errors': fields[FIELD_ERRORS],
+        'mean_ms': fields[FIELD_TOTAL_US] / count / 1e3,
+    }
+    for i, category in enumerate(TIME_CATEGORIES):
+        stats[f'{category}_ms'] = fields[FIELD_TIME_US + i] / count / 1e3
+
+    # Percentiles are bucket upper bounds. Counters are read while workers
+    # update them, so the buckets may lag behind the count, and even all be
+    # empty: percentiles are then of the requests in the buckets.
+    seen = 0
+    highest = None
+    total = sum(buckets)
+    targets = [(p, total * p / 100) for p in PERCENTILES]
+    for index, bucket_count in enumerate(buckets):
+        if not bucket_count:
+            continue
+        seen += bucket_count
+        while targets and seen >= targets[0][1]:
+            stats[f'p{targets[0][0]}_ms'] = _bucket_highest(index) / 1e3
+            targets.pop(0)
+        highest = index
+    if highest is not None:
+        stats['max_ms'] = _bucket_highest(highest) / 1e3
+    return stats
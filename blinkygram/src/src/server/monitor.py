@@ -0,0 +1,51 @@
+import asyncio
+
+from typing import Dict
+
+from metrics import WorkerMetrics
+
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag as the delay of a periodic wakeup past its
+    deadline: any callback hogging the loop shows up as lag. Samples are
+    also recorded into metrics, if given.
+    """
+
+    def __init__(self, interval: float = 0.1, metrics: WorkerMetrics = None):
+        self._interval = interval
+        self._metrics = metrics
+        self._task: asyncio.Task = None
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self, reset: bool = False) -> Dict[str, float]:
+        stats = {
+            'samples': self._count,
+            'avg_ms': self._total / self._count * 1e3 if self._count else 0.0,
+            'max_ms': self._max * 1e3,
+        }
+        if reset:
+            self._count, self._total, self._max = 0, 0.0, 0.0
+        return stats
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            deadline = loop.time() + self._interval
+            await asyncio.sleep(self._interval)
+            lag = max(0.0, loop.time() - deadline)
+            self._count += 1
+            self._total += lag
+            self._max = max(self._max, lag)
+            if self._metrics is not None:
+                self._metrics.record_lag(lag)
@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import time
+import signal
+import multiprocessing
+
+from ctypes import c_double
+from multiprocessing.sharedctypes import RawArray
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+# Status of each worker slot, written by the worker running in it.
+STATUS_PID = 0
+STATUS_HEARTBEAT = 1
+STATUS_CONNECTIONS = 2
+STATUS_IN_FLIGHT = 3
+STATUS_REQUESTS = 4
+STATUS_FIELDS = 5
+
+HEARTBEAT_INTERVAL = 1.0
+
+# How often the supervisor checks on workers.
+CHECK_INTERVAL = 0.2
+
+# No workers are started for this long after one exits, against crash loops.
+RESTART_DELAY = 1.0
+
+
+class WorkerStatus:
+    """
+    Liveness and load of the worker in each slot, in shared memory. Workers
+    update their slot every HEARTBEAT_INTERVAL, from their event loop, so a
+    stale heartbeat means a stuck loop.
+    """
+
+    def __init__(self, slots: int):
+        self._values = RawArray(c_double, slots * STATUS_FIELDS)
+
+    def update(self, slot: int, connections: int, in_flight: int, requests: int):
+        base = slot * STATUS_FIELDS
+        self._values[base + STATUS_PID] = os.getpid()
+        self._values[base + STATUS_CONNECTIONS] = connections
+        self._values[base + STATUS_IN_FLIGHT] = in_flight
+        self._values[base + STATUS_REQUESTS] = requests
+        self._values[base + STATUS_HEARTBEAT] = time.time()
+
+    def clear(self, slot: int):
+        base = slot * STATUS_FIELDS
+        for i in range(STATUS_FIELDS):
+            self._values[base + i] = 0
+
+    def pid(self, slot: int) -> int:
+        return int(self._values[slot * STATUS_FIELDS + STATUS_PID])
+
+    def heartbeat(self, slot: int) -> float:
+        return self._values[slot * STATUS_FIELDS + STATUS_HEARTBEAT]
+
+    def load(self, slot: int) -> Dict[str, int]:
+        base = slot * STATUS_FIELDS
+        return {
+            'connections': int(self._values[base + STATUS_CONNECTIONS]),
+            'in_flight': int(self._values[base + STATUS_IN_FLIGHT]),
+            'requests': int(self._values[base + STATUS_REQUESTS]),
+        }
+
+
+class Supervisor:
+    """
+    Keeps the configured number of worker processes running, each in a slot
+    of the shared status (and metrics) tables. Workers that exit are
+    restarted, and workers whose heartbeat goes stale are killed and
+    restarted.
+
+    Signals:
+    - SIGHUP: replaces workers one at a time, draining each old worker only
+      once its replacement is serving. This only recycles the processes:
+      workers are forked from the supervisor, so they run the code it
+      loaded, and new code needs a full restart.
+    - SIGTTIN, SIGTTOU: one more or one less worker, up to max_workers.
+    - SIGTERM, SIGINT: drains all workers and exits.
+
+    Workers drain on SIGTERM: they stop accepting, finish their requests
+    and close their connections within drain_timeout, after which they are
+    killed. The listening socket is owned by the supervisor, so it stays
+    open throughout. The status of all workers is written to status_path
+    every HEARTBEAT_INTERVAL.
+
+    The supervisor must not run other threads, as it keeps forking workers:
+    periodic work goes in on_tick, called from its loop every CHECK_INTERVAL.
+    """
+
+    def __init__(self, target: Callable[[int], None], workers: int, max_workers: int,
+                 status: WorkerStatus, status_path: str, health_timeout: float,
+                 drain_timeout: float, on_exit: Callable[[int], None] = None,
+                 on_tick: Callable[[], None] = None):
+        self._target = target
+        self._workers = workers
+        self._max_workers = max_workers
+        self._status = status
+        self._status_path = status_path
+        self._health_timeout = health_timeout
+        self._drain_timeout = drain_timeout
+        self._on_exit = on_exit
+        self._on_tick = on_tick
+        # Serving workers by slot, and when they were started.
+        self._procs: Dict[int, multiprocessing.Process] = {}
+        self._started: Dict[int, float] = {}
+        self._restarts: Dict[int, int] = {}
+        # Draining workers by slot, with their kill deadline.
+        self._draining: Dict[int, Tuple[multiprocessing.Process, float]] = {}
+        # Rolling replacement: old slots left, and the pending (old, new) pair.
+        self._replace_queue: List[int] = []
+        self._replacing: Optional[Tuple[int, int]] = None
+        self._stopping = False
+        self._status_time = 0.0
+        self._exit_time = -RESTART_DELAY
+
+    @property
+    def slots(self) -> int:
+        # One spare slot for the replacement of a worker being reloaded.
+        return self._max_workers + 1
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop_handler)
+        signal.signal(signal.SIGINT, self._stop_handler)
+        signal.signal(signal.SIGHUP, self._reload_handler)
+        signal.signal(signal.SIGTTIN, self._scale_handler)
+        signal.signal(signal.SIGTTOU, self._scale_handler)
+
+        while not self._stopping:
+            self._check()
+            time.sleep(CHECK_INTERVAL)
+
+        self._shutdown()
+
+    def pids(self) -> List[int]:
+        procs = list(self._procs.values()) + \
+            [proc for proc, _ in self._draining.values()]
+        return [proc.pid for proc in procs if proc.is_alive()]
+
+    def stats(self) -> List[dict]:
+        now = time.time()
+        stats = []
+        workers = [(slot, proc, 'serving') for slot, proc in self._procs.items()] + \
+            [(slot, proc, 'draining') for slot, (proc, _) in self._draining.items()]
+        for slot, proc, state in sorted(workers, key=lambda worker: worker[0]):
+            heartbeat = self._status.heartbeat(slot)
+            if state == 'serving' and not self._ready(slot, proc):
+                state = 'starting'
+            stats.append({
+                'slot': slot,
+                'pid': proc.pid,
+                'state': state,
+                'alive': proc.is_alive(),
+                'heartbeat_age': now - heartbeat if heartbeat else None,
+                'restarts': self._restarts.get(slot, 0),
+                **self._status.load(slot),
+            })
+        return stats
+
+    def _check(self):
+        now = time.monotonic()
+
+        for slot, proc in list(self._procs.items()):
+            if not proc.is_alive():
+                print(f'Worker {proc.pid} exited with code {proc.exitcode}, restarting')
+                sys.stdout.flush()
+                self._reap(slot, proc)
+                del self._procs[slot]
+                self._restarts[slot] = self._restarts.get(slot, 0) + 1
+                self._exit_time = now
+                if self._replacing is not None and slot in self._replacing:
+                    old_slot, new_slot = self._replacing
+                    if slot == new_slot:
+                        self._replace_queue.insert(0, old_slot)
+                    self._replacing = None
+            elif self._stale(slot, proc, now):
+                print(f'Worker {proc.pid} not responding, killing')
+                sys.stdout.flush()
+                proc.kill()
+
+        for slot, (proc, deadline) in list(self._draining.items()):
+            if not proc.is_alive():
+                self._reap(slot, proc)
+                del self._draining[slot]
+            elif now > deadline:
+                print(f'Worker {proc.pid} did not drain in time, killing')
+                sys.stdout.flush()
+                proc.kill()
+
+        self._check_replacement()
+
+        serving = len(self._procs) - (self._replacing is not None)
+        while serving < self._workers:
+            if self._start() is None:
+                break
+            serving += 1
+        while serving > self._workers:
+            slot = max(slot for slot in self._procs
+                       if self._replacing is None or slot not in self._replacing)
+            self._drain(slot)
+            serving -= 1
+
+        if time.monotonic() - self._status_time >= HEARTBEAT_INTERVAL:
+            self._status_time = time.monotonic()
+            self._write_status()
+
+        if self._on_tick is not None:
+            self._on_tick()
+
+    def _check_replacement(self):
+        if self._replacing is not None:
+            old_slot, new_slot = self._replacing
+            if not self._ready(new_slot, self._procs[new_slot]):
+                return
+            self._drain(old_slot)
+            self._replacing = None
+
+        while self._replace_queue:
+            old_slot = self._replace_queue.pop(0)
+            if old_slot not in self._procs:
+                continue
+            new_slot = self._start()
+            if new_slot is None:
+                self._replace_queue.insert(0, old_slot)
+                return
+            self._replacing = (old_slot, new_slot)
+            return
+
+    def _start(self) -> Optional[int]:
+        now = time.monotonic()
+        if now - self._exit_time < RESTART_DELAY:
+            return None
+        for slot in range(self.slots):
+            if slot in self._procs or slot in self._draining:
+                continue
+            self._status.clear(slot)
+            proc = multiprocessing.Process(target=self._target, args=(slot,))
+            proc.start()
+            self._procs[slot] = proc
+            self._started[slot] = now
+            return slot
+        return None
+
+    def _drain(self, slot: int):
+        proc = self._procs.pop(slot)
+        # Workers bound their own drain by drain_timeout, kill after a grace.
+        self._draining[slot] = (proc, time.monotonic() + self._drain_timeout + 5)
+        if proc.is_alive():
+            os.kill(proc.pid, signal.SIGTERM)
+
+    def _reap(self, slot: int, proc: multiprocessing.Process):
+        proc.join()
+        self._status.clear(slot)
+        if self._on_exit is not None:
+            self._on_exit(proc.pid)
+
+    def _ready(self, slot: int, proc: multiprocessing.Process) -> bool:
+        return self._status.pid(slot) == proc.pid and self._status.heartbeat(slot) > 0
+
+    def _stale(self, slot: int, proc: multiprocessing.Process, now: float) -> bool:
+        if not self._ready(slot, proc):
+            # Not serving yet: only give up on it after the health timeout.
+            return now - self._started[slot] > self._health_timeout
+        return time.time() - self._status.heartbeat(slot) > self._health_timeout
+
+    def _write_status(self):
+        tmp_path = f'{self._status_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'workers': self._workers, 'status': self.stats()}, f, indent=2)
+        os.replace(tmp_path, self._status_path)
+
+    def _shutdown(self):
+        print('Draining workers')
+        sys.stdout.flush()
+        for slot in list(self._procs):
+            self._drain(slot)
+        self._replace_queue.clear()
+        self._replacing = None
+        while self._draining:
+            self._check()
+            time.sleep(CHECK_INTERVAL)
+
+    def _stop_handler(self, signum, frame):
+        self._stopping = True
+        self._workers = 0
+
+    def _reload_handler(self, signum, frame):
+        print('Reloading workers')
+        sys.stdout.flush()
+        self._replace_queue = sorted(self._procs)
+
+    def _scale_handler(self, signum, frame):
+        if signum == signal.SIGTTIN:
+            self._workers = min(self._workers + 1, self._max_workers)
+        else:
+            self._workers = max(self._workers - 1, 1)
+        print(f'Scaling to {self._workers} workers')
+        sys.stdout.flush()
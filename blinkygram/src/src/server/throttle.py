@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import multiprocessing
+import time
+
+from ctypes import c_double, c_uint64
+from multiprocessing.sharedctypes import RawArray
+from typing import Dict, Optional
+
+
+# Shared tables are set-associative: a key maps to one set of TABLE_WAYS
+# slots, and evicts the least recently used slot of the set if not present.
+TABLE_SETS = 1024
+TABLE_WAYS = 8
+TABLE_LOCKS = 64
+
+THROTTLE_KINDS = ['conn', 'ip', 'user']
+WORKER_COUNTERS = 2 * len(THROTTLE_KINDS)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+
+    def take(self) -> float:
+        now = time.monotonic()
+        self._tokens = _refill(self._tokens, self._last, now,
+                               self._rate, self._burst) - 1
+        self._last = now
+        return _deficit(self._tokens, self._rate)
+
+
+class SharedBucketTable:
+    """
+    Token buckets keyed by strings, kept in shared memory so that all worker
+    processes forked after creation draw from the same buckets.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        size = TABLE_SETS * TABLE_WAYS
+        self._rate = rate
+        self._burst = burst
+        self._keys = RawArray(c_uint64, size)
+        self._tokens = RawArray(c_double, size)
+        self._last = RawArray(c_double, size)
+        self._locks = [multiprocessing.Lock() for _ in range(TABLE_LOCKS)]
+
+    def take(self, key: str) -> float:
+        # Zero marks an empty slot.
+        h = _key_hash(key) or 1
+        first = (h % TABLE_SETS) * TABLE_WAYS
+        now = time.monotonic()
+        with self._locks[h % TABLE_LOCKS]:
+            slot = None
+            for i in range(first, first + TABLE_WAYS):
+                if self._keys[i] == h:
+                    slot = i
+                    break
+                if slot is None or self._last[i] < self._last[slot]:
+                    slot = i
+            if self._keys[slot] != h:
+                self._keys[slot] = h
+                self._tokens[slot] = self._burst
+                self._last[slot] = now
+            tokens = _refill(self._tokens[slot], self._last[slot], now,
+                             self._rate, self._burst) - 1
+            self._tokens[slot] = tokens
+            self._last[slot] = now
+        return _deficit(tokens, self._rate)
+
+
+class Throttle:
+    """
+    Request throttling with token buckets per connection, per source IP and
+    per authenticated user. A rate of zero disables the respective bucket.
+    Requests are not rejected: they wait until their tokens are available.
+    Workers throttle through worker(), counting admitted and throttled
+    requests into their own slot without locking.
+    """
+
+    def __init__(self, workers: int, conn_rate: float, conn_burst: float,
+                 ip_rate: float = 0, ip_burst: float = 1,
+                 user_rate: float = 0, user_burst: float = 1):
+        self._conn_rate = conn_rate
+        self._conn_burst = conn_burst
+        self._ip = SharedBucketTable(ip_rate, ip_burst) if ip_rate else None
+        self._user = SharedBucketTable(
+            user_rate, user_burst) if user_rate else None
+        # Admitted and throttled request counters for each kind, per worker.
+        self._workers = workers
+        self._counters = RawArray(c_uint64, workers * WORKER_COUNTERS)
+
+    def worker(self, index: int) -> 'WorkerThrottle':
+        return WorkerThrottle(self, index)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        counters = [0] * WORKER_COUNTERS
+        for worker in range(self._workers):
+            base = worker * WORKER_COUNTERS
+            for i in range(WORKER_COUNTERS):
+                counters[i] += self._counters[base + i]
+        return {
+            kind: {'admitted': counters[2*i], 'throttled': counters[2*i + 1]}
+            for i, kind in enumerate(THROTTLE_KINDS)
+        }
+
+
+class WorkerThrottle:
+    def __init__(self, throttle: Throttle, index: int):
+        self._conn_rate = throttle._conn_rate
+        self._conn_burst = throttle._conn_burst
+        self._ip = throttle._ip
+        self._user = throttle._user
+        self._counters = throttle._counters
+        self._base = index * WORKER_COUNTERS
+
+    def connection_bucket(self) -> Optional[TokenBucket]:
+        if not self._conn_rate:
+            return None
+        return TokenBucket(self._conn_rate, self._conn_burst)
+
+    async def throttle_connection(self, bucket: Optional[TokenBucket], ip: str):
+        wait = 0
+        if bucket is not None:
+            wait = self._count(0, bucket.take())
+        if self._ip is not None:
+            wait = max(wait, self._count(1, self._ip.take(ip)))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def throttle_user(self, userid: int):
+        if self._user is None:
+            return
+        wait = self._count(2, self._user.take(str(userid)))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _count(self, kind: int, wait: float) -> float:
+        self._counters[self._base + 2*kind + (wait > 0)] += 1
+        return wait
+
+
+def _refill(tokens: float, last: float, now: float, rate: float, burst: float) -> float:
+    return min(burst, tokens + (now - last) * rate)
+
+
+def _deficit(tokens: float, rate: float) -> float:
+    return -tokens / rate if tokens < 0 else 0.0
+
+
+def _key_hash(key: str) -> int:
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
@@ -0,0 +1,125 @@
+import dataclasses
+import multiprocessing
+
+from collections import OrderedDict
+from ctypes import c_uint64
+from multiprocessing.sharedctypes import RawArray, RawValue
+from typing import Dict, List, Optional, Tuple
+
+from database import User
+
+
+INVALIDATION_LOG_SIZE = 1024
+
+
+class InvalidationLog:
+    """
+    Ring of the most recently invalidated user IDs, kept in shared memory so
+    that all worker processes forked after creation see each invalidation as
+    soon as it is appended.
+    """
+
+    def __init__(self, size: int = INVALIDATION_LOG_SIZE):
+        self._ids = RawArray(c_uint64, size)
+        self._count = RawValue(c_uint64, 0)
+        self._lock = multiprocessing.Lock()
+
+    @property
+    def count(self) -> int:
+        return self._count.value
+
+    def append(self, userid: int):
+        with self._lock:
+            self._ids[self._count.value % len(self._ids)] = userid
+            self._count.value += 1
+
+    def read(self, since: int) -> Tuple[int, Optional[List[int]]]:
+        """
+        Returns the current count and the IDs appended after since, or None
+        if some of them have already been overwritten.
+        """
+        with self._lock:
+            count = self._count.value
+            if count - since > len(self._ids):
+                return count, None
+            return count, [self._ids[i % len(self._ids)]
+                           for i in range(since, count)]
+
+
+class UserCache:
+    """
+    Bounded LRU cache of users, by ID and by username. Only found users are
+    cached, so registrations need no invalidation. Updates are invalidated
+    through the shared log, which is checked on every lookup. Callers get
+    copies, so that changing a user before committing it does not affect
+    the cache.
+    """
+
+    def __init__(self, size: int, log: InvalidationLog):
+        self._size = size
+        self._log = log
+        self._seen = log.count
+        self._by_id = OrderedDict()
+        self._by_name: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._by_id)
+
+    @property
+    def generation(self) -> int:
+        """
+        Log position to pass to add() for a user read from the database
+        after this call.
+        """
+        self._sync()
+        return self._seen
+
+    def by_id(self, userid: int) -> Optional[User]:
+        self._sync()
+        user = self._by_id.get(userid)
+        return self._count(user)
+
+    def by_name(self, username: str) -> Optional[User]:
+        self._sync()
+        userid = self._by_name.get(username)
+        user = self._by_id.get(userid) if userid is not None else None
+        return self._count(user)
+
+    def add(self, user: User, generation: int):
+        # An invalidation since the read might be for this very user.
+        self._sync()
+        if self._size <= 0 or generation != self._seen:
+            return
+        self._by_id[user.id] = dataclasses.replace(user)
+        self._by_id.move_to_end(user.id)
+        self._by_name[user.username] = user.id
+        while len(self._by_id) > self._size:
+            _, evicted = self._by_id.popitem(last=False)
+            del self._by_name[evicted.username]
+
+    def invalidate(self, userid: int):
+        self._log.append(userid)
+        self._sync()
+
+    def _count(self, user: Optional[User]) -> Optional[User]:
+        if user is None:
+            self.misses += 1
+            return None
+        self._by_id.move_to_end(user.id)
+        self.hits += 1
+        return dataclasses.replace(user)
+
+    def _sync(self):
+        if self._log.count == self._seen:
+            return
+        self._seen, userids = self._log.read(self._seen)
+        if userids is None:
+            self._by_id.clear()
+            self._by_name.clear()
+            return
+        for userid in userids:
+            user = self._by_id.pop(userid, None)
+            if user is not None:
+                del self._by_name[user.username]
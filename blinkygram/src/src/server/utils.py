@@ -5,7 +5,6 @@ import pwd
 from functools import lru_cache
 
 
-USER_BACKUP = 'userbackup'
 USER_SERVER = 'server'
 
 
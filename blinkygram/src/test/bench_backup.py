@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import json
+import time
+import uuid
+import shlex
+import asyncio
+import zipfile
+import argparse
+import tempfile
+
+from backup import BACKUP_FILES, archive_backup, extract_backup
+
+
+# The subprocess commands the server used to run, minus sudo.
+async def subprocess_new(data: bytes, backup_dir: str):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpzip = f'{tmpdir}/backup.zip'
+        with open(tmpzip, 'wb') as f:
+            f.write(data)
+        process = await asyncio.subprocess.create_subprocess_exec(
+            'sh', '-c',
+            f'ulimit -f 64 && cd {backup_dir} && unzip {tmpzip} messages public_key balance',
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        await process.wait()
+        assert process.returncode == 0
+
+
+async def subprocess_get(backup_dir: str) -> bytes:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpzip = f'{tmpdir}/backup.zip'
+        process = await asyncio.subprocess.create_subprocess_exec(
+            'sh', '-c',
+            f'ulimit -f 64 && cd {shlex.quote(backup_dir)} && zip {tmpzip} messages public_key balance',
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+        await process.wait()
+        assert process.returncode == 0
+        with open(tmpzip, 'rb') as f:
+            return f.read()
+
+
+async def inprocess_new(data: bytes, backup_dir: str):
+    await asyncio.get_running_loop().run_in_executor(
+        None, extract_backup, data, backup_dir)
+
+
+async def inprocess_get(backup_dir: str) -> bytes:
+    return await asyncio.get_running_loop().run_in_executor(
+        None, archive_backup, backup_dir)
+
+
+def make_backup(num_msgs: int) -> bytes:
+    msgs = [{'id': i, 'timestamp': int(time.time()), 'uid_src': 1, 'uid_dst': 2,
+             'content': 'test', 'delivered': True} for i in range(num_msgs)]
+    bio = io.BytesIO()
+    with zipfile.ZipFile(bio, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('messages', json.dumps(msgs))
+        zf.writestr('public_key', 'pubkey')
+        zf.writestr('balance', json.dumps([]))
+    return bio.getvalue()
+
+
+async def bench(name: str, op, count: int, jobs: int):
+    async def job():
+        for _ in range(count // jobs):
+            await op()
+
+    t1 = time.perf_counter()
+    await asyncio.gather(*(job() for _ in range(jobs)))
+    elapsed = time.perf_counter() - t1
+    print(f'{name:<16} {count // jobs * jobs / elapsed:10.1f} backups/s')
+
+
+async def run(args: argparse.Namespace, base: str):
+    data = make_backup(args.messages)
+    print(f'Backup archive size: {len(data)} bytes')
+
+    def new_dir() -> str:
+        path = f'{base}/{uuid.uuid4()}'
+        os.makedirs(path)
+        return path
+
+    src_dir = new_dir()
+    extract_backup(data, src_dir)
+    assert sorted(os.listdir(src_dir)) == sorted(BACKUP_FILES)
+
+    await bench('subprocess new', lambda: subprocess_new(data, new_dir()),
+                args.count, args.jobs)
+    await bench('in-process new', lambda: inprocess_new(data, new_dir()),
+                args.count, args.jobs)
+    await bench('subprocess get', lambda: subprocess_get(src_dir),
+                args.count, args.jobs)
+    await bench('in-process get', lambda: inprocess_get(src_dir),
+                args.count, args.jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backup engine benchmark.')
+    parser.add_argument('-n', '--count', type=int, default=1000,
+                        help='Backups per benchmark.')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Concurrent backups.')
+    parser.add_argument('-m', '--messages', type=int, default=20,
+                        help='Messages in the backup.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(args, tmp))
+
+
+if __name__ == '__main__':
+    main()
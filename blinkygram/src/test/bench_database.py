@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import multiprocessing
+
+from database import INIT_SQL, Balance, Database, Message, SpentReceipt, User
+
+
+INITIAL_BALANCE = 10
+
+
+async def bench_queries(db: Database, num_users: int, queries: int):
+    ops = {
+        'User.by_id': lambda uid: User.by_id(db, uid),
+        'Message.read_one': lambda uid: Message.read_one(db, uid),
+        'Message.read_many': lambda uid: Message.read_many(db, uid, 256, 8192, 20),
+        'Message.all_by_user': lambda uid: Message.all_by_user(db, uid),
+    }
+    for name, op in ops.items():
+        t1 = time.perf_counter()
+        for _ in range(queries):
+            await op(random.randint(1, num_users))
+        elapsed = time.perf_counter() - t1
+        print(f'  {name:<20} {elapsed / queries * 1e6:10.1f} us/query')
+
+
+async def bench_writes(path: str, writers: int, writes: int, group_window: float):
+    db = Database(path, group_window=group_window)
+    await db.connect()
+
+    async def writer():
+        for _ in range(writes):
+            await Message(1, 2, 'test').commit(db)
+
+    t1 = time.perf_counter()
+    await asyncio.gather(*(writer() for _ in range(writers)))
+    elapsed = time.perf_counter() - t1
+    await db.close()
+    mode = f'group commit ({group_window * 1e3:g} ms)' if group_window else 'autocommit'
+    print(f'  {mode:<24} {writers * writes / elapsed:10.1f} writes/s')
+
+
+async def legacy_transfer(db: Database, src: int, dst: int, currency: int) -> bool:
+    # The separate statements the handlers used to run.
+    for uid in [src, dst]:
+        if await Balance.find(db, uid, currency) is None:
+            await Balance(uid, currency, INITIAL_BALANCE).commit(db)
+    if not await Balance.adjust(db, src, currency, -1):
+        return False
+    if not await SpentReceipt.spend(db, os.urandom(16)):
+        return False
+    await Balance.adjust(db, dst, currency, 1)
+    return True
+
+
+async def atomic_transfer(db: Database, src: int, dst: int, currency: int) -> bool:
+    if not await Balance.withdraw(db, src, currency, 1, INITIAL_BALANCE):
+        return False
+    return await SpentReceipt.redeem(db, os.urandom(16), dst, currency, 1,
+                                     INITIAL_BALANCE)
+
+
+def transfer_worker(path: str, mode: str, accounts: int, currency: int,
+                    jobs: int, transfers: int):
+    transfer = atomic_transfer if mode == 'atomic' else legacy_transfer
+
+    async def job(db: Database):
+        for _ in range(transfers):
+            src, dst = random.sample(range(1, accounts + 1), 2)
+            await transfer(db, src, dst, currency)
+
+    async def run():
+        db = Database(path)
+        await db.connect(migrate=False)
+        await asyncio.gather(*(job(db) for _ in range(jobs)))
+        await db.close()
+
+    random.seed()
+    asyncio.run(run())
+
+
+def bench_transfers(path: str, mode: str, procs: int, accounts: int, jobs: int,
+                    transfers: int):
+    # Transfers between a few accounts of a new currency, by racing
+    # processes. Every balance starts at INITIAL_BALANCE, and transfers
+    # must preserve the total.
+    conn = sqlite3.connect(path)
+    currency = conn.execute('INSERT INTO currencies VALUES (NULL)').lastrowid
+    conn.commit()
+
+    workers = [multiprocessing.Process(target=transfer_worker, args=(
+        path, mode, accounts, currency, jobs, transfers)) for _ in range(procs)]
+    t1 = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - t1
+
+    rows, total, lowest = conn.execute(
+        'SELECT COUNT(*), SUM(balance), MIN(balance) FROM balances '
+        'WHERE currency_id = ?', [currency]).fetchone()
+    conn.close()
+    consistent = total == rows * INITIAL_BALANCE and lowest >= 0
+    print(f'  {mode:<24} {procs * jobs * transfers / elapsed:10.1f} transfers/s'
+          f' (total {total} of {rows * INITIAL_BALANCE}, '
+          f'{"consistent" if consistent else "INCONSISTENT"})')
+
+
+def populate(path: str, num_users: int, num_msgs: int, undelivered: float):
+    conn = sqlite3.connect(path)
+    for stmt in INIT_SQL:
+        conn.execute(stmt)
+    conn.executemany('INSERT INTO users VALUES (NULL, ?, ?, ?)',
+                     ((f'user{i}', 'password', 'pubkey') for i in range(num_users)))
+    now = int(time.time())
+    conn.executemany('INSERT INTO messages VALUES (NULL, ?, ?, ?, ?, ?)', (
+        (now, random.randint(1, num_users), random.randint(1, num_users),
+         'test', int(random.random() >= undelivered))
+        for _ in range(num_msgs)))
+    conn.commit()
+    conn.close()
+
+
+async def run(args: argparse.Namespace, path: str):
+    print(f'Populating {args.messages} messages, {args.users} users')
+    populate(path, args.users, args.messages, args.undelivered)
+
+    db = Database(path)
+    await db.connect(migrate=False)
+    print('Without indexes:')
+    await bench_queries(db, args.users, args.queries)
+    t1 = time.perf_counter()
+    await db.migrate()
+    print(f'Migration took {time.perf_counter() - t1:.2f} s')
+    print('With indexes:')
+    await bench_queries(db, args.users, args.queries)
+    await db.close()
+
+    print(f'Message.commit, {args.writers} concurrent writers:')
+    for group_window in [0, args.group_window]:
+        await bench_writes(path, args.writers, args.writes, group_window)
+
+    print(f'Transfers between {args.accounts} accounts, {args.procs} processes '
+          f'with {args.writers} concurrent transfers each:')
+    for mode in ['legacy', 'atomic']:
+        bench_transfers(path, mode, args.procs, args.accounts, args.writers,
+                        args.transfers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Database benchmark.')
+    parser.add_argument('-n', '--messages', type=int, default=1000000,
+                        help='Messages in the table.')
+    parser.add_argument('-u', '--users', type=int, default=1000,
+                        help='Users in the table.')
+    parser.add_argument('-U', '--undelivered', type=float, default=0.1,
+                        help='Fraction of undelivered messages.')
+    parser.add_argument('-q', '--queries', type=int, default=200,
+                        help='Queries per operation.')
+    parser.add_argument('-w', '--writers', type=int, default=64,
+                        help='Concurrent writers.')
+    parser.add_argument('-W', '--writes', type=int, default=200,
+                        help='Writes per writer.')
+    parser.add_argument('-g', '--group-window', type=float, default=0.001,
+                        help='Group commit window, in seconds.')
+    parser.add_argument('-a', '--accounts', type=int, default=8,
+                        help='Accounts to transfer between.')
+    parser.add_argument('-P', '--procs', type=int, default=4,
+                        help='Processes racing on transfers.')
+    parser.add_argument('-t', '--transfers', type=int, default=100,
+                        help='Transfers per concurrent writer.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(run(args, os.path.join(tmp, 'data.db')))
+
+
+if __name__ == '__main__':
+    main()
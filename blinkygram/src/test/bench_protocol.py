@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib.util
+import timeit
+
+from types import ModuleType
+from typing import Callable, Dict, Tuple
+
+import protocol
+
+
+def load_protocol(path: str) -> ModuleType:
+    spec = importlib.util.spec_from_file_location('protocol_baseline', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def sample_messages(p: ModuleType) -> Dict[str, Tuple[object, Callable]]:
+    token = p.AuthToken(1337, bytes(range(p.SIGNATURE_SIZE)))
+    receipt = p.TransferReceipt(-100, 3, 42, bytes(p.SIGNATURE_SIZE))
+
+    def request(kind, req):
+        return p.RequestMessage(kind, req), p.RequestMessage.dt_decode
+
+    def reply(rep):
+        return p.ReplyMessage.ok(rep), \
+            lambda bs: p.ReplyMessage.dt_decode(bs, rep.__class__)
+
+    return {
+        'header': (p.MessageHeader(7, 123), p.MessageHeader.dt_decode),
+        'auth': request(p.REQUEST_KIND_AUTH,
+                        p.AuthRequest('username', 'password')),
+        'userid': request(p.REQUEST_KIND_USERID,
+                          p.UseridRequest(token, 'username')),
+        'chat_send': request(p.REQUEST_KIND_CHAT_SEND,
+                             p.ChatSendRequest(token, 42, 'hello ' * 100)),
+        'chat_read': reply(p.ChatReadReply(42, 1660000000, 'hello ' * 100)),
+        'transfer': request(p.REQUEST_KIND_TRANSFER,
+                            p.TransferRequest(token, 100, 3, 42)),
+        'receive': request(p.REQUEST_KIND_RECEIVE,
+                           p.ReceiveRequest(token, receipt)),
+        'new_backup': request(p.REQUEST_KIND_NEW_BACKUP,
+                              p.NewBackupRequest(token, b'\x00' * 4000)),
+    }
+
+
+def measure(msg: object, decode: Callable, number: int) -> Tuple[float, float]:
+    bs = msg.dt_encode()
+    t_enc = min(timeit.repeat(msg.dt_encode, number=number, repeat=3))
+    t_dec = min(timeit.repeat(lambda: decode(bs), number=number, repeat=3))
+    return t_enc / number * 1e6, t_dec / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Protocol codec benchmark.')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='Iterations per measurement.')
+    parser.add_argument('-b', '--baseline', default=None,
+                        help='Path to a baseline protocol.py to compare with.')
+    args = parser.parse_args()
+
+    samples = sample_messages(protocol)
+    baseline = None
+    if args.baseline is not None:
+        baseline = sample_messages(load_protocol(args.baseline))
+
+    header = f'{"message":<12} {"enc us":>8} {"dec us":>8}'
+    if baseline is not None:
+        header += f' {"base enc":>9} {"base dec":>9} {"speedup":>8}'
+    print(header)
+
+    for name, (msg, decode) in samples.items():
+        t_enc, t_dec = measure(msg, decode, args.number)
+        line = f'{name:<12} {t_enc:>8.2f} {t_dec:>8.2f}'
+        if baseline is not None:
+            base_msg, base_decode = baseline[name]
+            if base_msg.dt_encode() != msg.dt_encode():
+                raise RuntimeError(f'Wire format mismatch for {name}')
+            b_enc, b_dec = measure(base_msg, base_decode, args.number)
+            speedup = (b_enc + b_dec) / (t_enc + t_dec)
+            line += f' {b_enc:>9.2f} {b_dec:>9.2f} {speedup:>7.2f}x'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import json
+import random
+import string
+import argparse
+
+from collections import deque
+from typing import Dict, List
+
+from benchlib import Worker, Benchmark
+from client import Client, User
+
+
+OPERATIONS = [
+    'register', 'auth', 'userid', 'username', 'pubkey', 'chat_send',
+    'chat_read', 'balance', 'transfer', 'receive', 'check_receipt', 'mint',
+    'new_backup', 'get_backup',
+]
+
+# Bound on the outstanding receipts and unread messages tracked per worker.
+MAX_PENDING = 10000
+
+# Currency minted by each user at startup, for transfers.
+MINT_AMOUNT = 1 << 40
+
+
+def randstr(length: int) -> str:
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(random.choices(alphabet, k=length))
+
+
+def load_scenario(path: str) -> dict:
+    """
+    Loads a scenario file: a JSON object with the number of users of each
+    worker, the length of chat messages, and the relative weight of each
+    operation. Operations not listed are not performed.
+    """
+    with open(path) as f:
+        scenario = json.load(f)
+    scenario.setdefault('users', 16)
+    scenario.setdefault('message_length', 64)
+    operations = scenario.get('operations')
+    if not operations:
+        raise ValueError('Scenario without operations')
+    for op, weight in operations.items():
+        if op not in OPERATIONS:
+            raise ValueError(f'Unknown operation: {op}')
+        if weight < 0:
+            raise ValueError(f'Negative weight: {op}')
+    if scenario['users'] < 1:
+        raise ValueError('Scenario without users')
+    return scenario
+
+
+class WorkerImpl(Worker):
+    """
+    Performs operations drawn by weight on behalf of a population of users,
+    tracking what they have to read, receive and restore. An operation that
+    cannot be performed yet is replaced by the one enabling it (a send for a
+    read without unread messages, a transfer for a receive without
+    receipts, a new backup for a restore), and recorded as that one.
+    """
+
+    def __init__(self, host: str, port: int, scenario: dict, *args, **kwargs):
+        super().__init__(*args, ops=OPERATIONS, **kwargs)
+        self._host = host
+        self._port = port
+        self._num_users = scenario['users']
+        self._content = 'x' * scenario['message_length']
+        self._ops = list(scenario['operations'])
+        self._weights = list(scenario['operations'].values())
+        self._client = None
+        self._users: List[User] = []
+        self._currencies: List[int] = []
+        self._unread = deque(maxlen=MAX_PENDING)
+        self._receipts = deque(maxlen=MAX_PENDING)
+        self._backups: Dict[int, str] = {}
+
+    def initialize(self):
+        self._client = Client()
+        self._client.connect(self._host, self._port)
+        for _ in range(self._num_users):
+            self._client.user = User(randstr(16), randstr(16))
+            self._client.register()
+            self._client.auth()
+            self._users.append(self._client.user)
+            self._currencies.append(self._client.mint(MINT_AMOUNT))
+
+    def request(self) -> int:
+        op = random.choices(self._ops, self._weights)[0]
+        getattr(self, f'_{op}')()
+        return 1
+
+    def _as(self, op: str, user: int = None) -> int:
+        if user is None:
+            user = random.randrange(self._num_users)
+        self.op = op
+        self._client.user = self._users[user]
+        return user
+
+    def _other(self) -> User:
+        return random.choice(self._users)
+
+    def _register(self):
+        self.op = 'register'
+        self._client.user = User(randstr(16), randstr(16),
+                                 sk=self._client.user.sk)
+        self._client.register()
+
+    def _auth(self):
+        self._as('auth')
+        self._client.auth()
+
+    def _userid(self):
+        self._as('userid')
+        self._client.get_userid(self._other().username)
+
+    def _username(self):
+        self._as('username')
+        self._client.get_username(self._other().userid)
+
+    def _pubkey(self):
+        self._as('pubkey')
+        self._client.get_pubkey(self._other().userid)
+
+    def _chat_send(self):
+        self._as('chat_send')
+        recipient = random.randrange(self._num_users)
+        self._client.chat_send(self._users[recipient].userid, self._content)
+        self._unread.append(recipient)
+
+    def _chat_read(self):
+        # The server waits for a message on an empty queue.
+        if not self._unread:
+            return self._chat_send()
+        self._as('chat_read', self._unread.popleft())
+        self._client.chat_read()
+
+    def _balance(self):
+        user = self._as('balance')
+        self._client.get_balance(self._currencies[user])
+
+    def _transfer(self):
+        user = self._as('transfer')
+        recipient = random.randrange(self._num_users)
+        receipt = self._client.transfer(
+            self._users[recipient].userid, self._currencies[user], 1)
+        self._receipts.append((recipient, receipt))
+
+    def _receive(self):
+        if not self._receipts:
+            return self._transfer()
+        recipient, receipt = self._receipts.popleft()
+        self._as('receive', recipient)
+        self._client.receive(receipt)
+
+    def _check_receipt(self):
+        if not self._receipts:
+            return self._transfer()
+        self._as('check_receipt')
+        self._client.check_receipt(random.choice(self._receipts)[1])
+
+    def _mint(self):
+        self._as('mint')
+        self._client.mint(1)
+
+    def _new_backup(self):
+        user = self._as('new_backup')
+        self._backups[user] = self._client.new_backup()
+
+    def _get_backup(self):
+        # Only the newest backup of a user is sure not to be retired.
+        if not self._backups:
+            return self._new_backup()
+        user = random.choice(list(self._backups))
+        self._as('get_backup', user)
+        self._client.get_backup(self._backups[user])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scenario server benchmark.')
+    parser.add_argument('scenario', help='Scenario file.')
+    parser.add_argument('-H', '--host', default='127.0.0.1',
+                        help='Server host.')
+    parser.add_argument('-p', '--port', type=int,
+                        default=10050, help='Server port.')
+    Benchmark.add_args(parser)
+    args = parser.parse_args()
+
+    scenario = load_scenario(args.scenario)
+    bench = Benchmark.from_args(args, WorkerImpl, args.host, args.port, scenario)
+
+    bench.run()
+
+
+if __name__ == '__main__':
+    main()
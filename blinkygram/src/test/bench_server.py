@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
+import time
 import random
 import string
 import argparse
 
 from benchlib import Worker, Benchmark
 from client import Client, User
+from protocol import *
 
 
 def randstr(length: int) -> str:
@@ -14,13 +16,22 @@ def randstr(length: int) -> str:
 
 
 class WorkerImpl(Worker):
-    def __init__(self, host: str, port: int, username: str, password: str, *args, **kwargs):
+    def __init__(self, host: str, port: int, username: str, password: str,
+                 depth: int, workload: str, backlog: int, batch: int,
+                 *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._host = host
         self._port = port
+        self._depth = depth
+        self._workload = workload
+        self._backlog = backlog
+        self._batch = batch
+        self._remaining = 0
+        self._drain_start = 0.0
         self._username = username if username is not None else randstr(16)
         self._password = password if password is not None else randstr(16)
         self._client = None
+        self._reader = None
 
     def initialize(self):
         self._client = Client()
@@ -28,11 +39,67 @@ class WorkerImpl(Worker):
         self._client.user = User(self._username, self._password)
         self._client.register(exist_ok=True)
         self._client.auth()
+        if self._workload == 'chat_rtt':
+            self._reader = Client(self._client.user)
+            self._reader.connect(self._host, self._port)
 
     def request(self) -> int:
-        self._client.chat_send(self._client.user.userid, 'test')
+        if self._workload == 'auth':
+            # Every auth signs a new token, whose first use is a cache miss.
+            self._client.auth()
+            self._client.get_userid(self._client.user.username)
+            return 2
+        if self._workload == 'chat_rtt':
+            # The read is usually waiting before the send, so it must be
+            # woken up, possibly from a different server worker.
+            user = self._client.user
+            self._reader.submit(RequestMessage(REQUEST_KIND_CHAT_READ, ChatReadRequest(
+                user.auth_token)), ChatReadReply)
+            self._client.chat_send(user.userid, 'test')
+            self._reader.collect()
+            return 2
+        if self._workload == 'drain':
+            return self._drain()
+        if self._depth <= 1:
+            self._client.chat_send(self._client.user.userid, 'test')
+            return 1
+        # Keep the pipeline full: one reply in, one request out.
+        while self._client.in_flight < self._depth:
+            self._client.submit(self._chat_send_req())
+        self._client.collect()
         return 1
 
+    def _fill_backlog(self):
+        reqs = (self._chat_send_req() for _ in range(self._backlog))
+        self._client.request_many(reqs, depth=max(self._depth, 16))
+        self._remaining = self._backlog
+        self._drain_start = time.time()
+
+    def _drain(self) -> int:
+        # Counts messages, not requests. Reads never ask for more than what
+        # is left, as the server waits for new messages on an empty queue.
+        if self._remaining == 0:
+            self._fill_backlog()
+        count = min(self._batch, self._remaining)
+        if self._batch == 1:
+            sender_userid, _, _ = self._client.chat_read()
+            num_msgs = 0 if sender_userid is None else 1
+        else:
+            num_msgs = len(self._client.chat_read_many(count))
+        if num_msgs == 0:
+            raise RuntimeError('Backlog drained early')
+        self._remaining -= num_msgs
+        if self._remaining == 0:
+            elapsed = time.time() - self._drain_start
+            print(f'Drained {self._backlog} messages in {elapsed:.2f} s '
+                  f'({self._backlog / elapsed:.2f} msg/s)')
+        return num_msgs
+
+    def _chat_send_req(self) -> RequestMessage:
+        user = self._client.user
+        return RequestMessage(REQUEST_KIND_CHAT_SEND, ChatSendRequest(
+            user.auth_token, user.userid, 'test'))
+
 
 def main():
     parser = argparse.ArgumentParser(description='Server benchmark.')
@@ -42,11 +109,21 @@ def main():
                         default=10050, help='Server port.')
     parser.add_argument('-u', '--username', default=None, help='Username.')
     parser.add_argument('-P', '--password', default=None, help='Password.')
+    parser.add_argument('-d', '--depth', type=int, default=1,
+                        help='Pipelined requests in flight per worker.')
+    parser.add_argument('-w', '--workload',
+                        choices=['chat', 'auth', 'chat_rtt', 'drain'],
+                        default='chat', help='Request workload.')
+    parser.add_argument('-b', '--backlog', type=int, default=10000,
+                        help='Messages to drain per round (drain workload).')
+    parser.add_argument('-B', '--batch', type=int, default=256,
+                        help='Messages per read, 1 for single reads (drain workload).')
     Benchmark.add_args(parser)
     args = parser.parse_args()
 
     bench = Benchmark.from_args(
-        args, WorkerImpl, args.host, args.port, args.username, args.password)
+        args, WorkerImpl, args.host, args.port, args.username, args.password,
+        args.depth, args.workload, args.backlog, args.batch)
 
     bench.run()
 
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import time
+import random
+import string
+import asyncio
+import argparse
+
+from typing import List
+
+from benchlib import PERCENTILES, Histogram
+from client import AsyncClient, ConnectionPool, User, generate_key
+
+
+def randstr(length: int) -> str:
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(random.choices(alphabet, k=length))
+
+
+async def user_loop(client: AsyncClient, clients: List[AsyncClient], workload: str,
+                    count: int, histogram: Histogram):
+    for _ in range(count):
+        other = random.choice(clients).user
+        start = time.perf_counter()
+        if workload == 'chat':
+            await client.chat_send(other.userid, 'test')
+        else:
+            await client.get_username(other.userid)
+        histogram.record((time.perf_counter() - start) * 1e6)
+
+
+async def run(args: argparse.Namespace):
+    pool = ConnectionPool(args.host, args.port, args.connections)
+    await pool.connect()
+
+    # Key generation is slow and irrelevant here, so users share a key.
+    sk = generate_key()
+    clients = [AsyncClient(User(randstr(16), randstr(16), sk=sk), pool)
+               for _ in range(args.users)]
+
+    async def login(client: AsyncClient):
+        await client.register()
+        await client.auth()
+
+    t1 = time.perf_counter()
+    await asyncio.gather(*(login(client) for client in clients))
+    elapsed = time.perf_counter() - t1
+    print(f'Registered {args.users} users in {elapsed:.2f} s '
+          f'({2 * args.users / elapsed:.2f} req/s)')
+
+    histogram = Histogram()
+    t1 = time.perf_counter()
+    await asyncio.gather(*(user_loop(client, clients, args.workload, args.count,
+                                     histogram) for client in clients))
+    elapsed = time.perf_counter() - t1
+    await pool.close()
+
+    summary = histogram.summary()
+    print(f'{summary["count"]} requests in {elapsed:.2f} s '
+          f'({summary["count"] / elapsed:.2f} req/s)')
+    print('Latency (ms):')
+    for key in ['mean'] + [f'p{p:g}' for p in PERCENTILES] + ['max']:
+        print(f'  {key:>8} {summary[key] / 1e3:10.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Server benchmark simulating many users in one process.')
+    parser.add_argument('-H', '--host', default='127.0.0.1',
+                        help='Server host.')
+    parser.add_argument('-p', '--port', type=int,
+                        default=10050, help='Server port.')
+    parser.add_argument('-u', '--users', type=int, default=1000,
+                        help='Concurrent users.')
+    parser.add_argument('-C', '--connections', type=int, default=8,
+                        help='Pooled connections shared by the users.')
+    parser.add_argument('-c', '--count', type=int, default=10,
+                        help='Requests per user.')
+    parser.add_argument('-w', '--workload', choices=['chat', 'lookup'],
+                        default='chat', help='Request workload.')
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import abc
 import argparse
+import json
 import multiprocessing
 import random
 import signal
@@ -7,22 +8,108 @@ import sys
 import time
 import traceback
 
-from ctypes import c_bool, c_double
-from multiprocessing.sharedctypes import Value
-from typing import List, Type
+from ctypes import c_bool, c_double, c_uint64
+from multiprocessing.sharedctypes import RawArray, Value
+from typing import Dict, List, Type
 
 
 RATE_DECAY = 0.25
 RATE_SLEEP_K = 0.5
 
+ARRIVALS = ['closed', 'constant', 'poisson']
+
+# Histogram buckets have HISTOGRAM_PRECISION significant bits (at most 1/64
+# relative error), up to HISTOGRAM_MAX microseconds.
+HISTOGRAM_PRECISION = 7
+HISTOGRAM_MAX = 1 << 32
+PERCENTILES = [50, 90, 99, 99.9, 99.99]
+
+
+class Histogram:
+    """
+    HDR-style latency histogram in microseconds, with log-linear buckets of
+    bounded relative error. Counts are in shared memory, so that histograms
+    recorded by worker processes can be merged by the parent.
+    """
+
+    def __init__(self):
+        self._sub = 1 << HISTOGRAM_PRECISION
+        self._half = self._sub >> 1
+        self._counts = RawArray(c_uint64, self._index(HISTOGRAM_MAX - 1) + 1)
+
+    def record(self, value: float):
+        value = min(max(int(value), 0), HISTOGRAM_MAX - 1)
+        self._counts[self._index(value)] += 1
+
+    def merge(self, other: 'Histogram'):
+        for i, count in enumerate(other._counts):
+            if count:
+                self._counts[i] += count
+
+    @property
+    def count(self) -> int:
+        return sum(self._counts)
+
+    def buckets(self) -> List[List[int]]:
+        """
+        Non-empty buckets, as [highest value, count] pairs.
+        """
+        return [[self._highest(i), count]
+                for i, count in enumerate(self._counts) if count]
+
+    def summary(self) -> Dict[str, float]:
+        buckets = self.buckets()
+        total = sum(count for _, count in buckets)
+        summary = {'count': total}
+        if total == 0:
+            return summary
+        summary['mean'] = sum(value * count for value, count in buckets) / total
+        summary['max'] = buckets[-1][0]
+        for p in PERCENTILES:
+            target = total * p / 100
+            seen = 0
+            for value, count in buckets:
+                seen += count
+                if seen >= target:
+                    summary[f'p{p:g}'] = value
+                    break
+        return summary
+
+    def _index(self, value: int) -> int:
+        if value < self._sub:
+            return value
+        shift = value.bit_length() - HISTOGRAM_PRECISION
+        return (shift + 1) * self._half + (value >> shift) - self._half
+
+    def _highest(self, index: int) -> int:
+        if index < self._sub:
+            return index
+        shift = index // self._half - 1
+        return ((index % self._half + self._half + 1) << shift) - 1
+
 
 class Worker(abc.ABC):
-    def __init__(self, count: int = None, rate: float = None):
+    """
+    Benchmark worker process, calling request() in a loop. Closed-loop
+    workers issue requests back to back, optionally slowed down to the target
+    rate. Open-loop workers issue them at scheduled arrival times, at constant
+    intervals or as a Poisson process, and measure latency from the scheduled
+    time, so that a slow request also counts against the ones it delays.
+    """
+
+    def __init__(self, count: int = None, rate: float = None, arrival: str = 'closed',
+                 ops: List[str] = ()):
         self._count = count
         self._target_rate = rate
+        self._arrival = arrival
         self._proc = None
         self._cur_rate = Value(c_double, 0.0)
         self._done = Value(c_bool, False)
+        self.histogram = Histogram()
+        # Workers performing different operations set op in request(), to
+        # also record latencies per operation.
+        self.op = None
+        self.op_histograms = {op: Histogram() for op in ops}
 
     @property
     def cur_rate(self) -> float:
@@ -57,6 +144,10 @@ class Worker(abc.ABC):
             self._done.value = True
             return
 
+        if self._arrival != 'closed':
+            self._open_loop()
+            return
+
         rate_avg = None
         rate_sleep = 0 if self._target_rate is None else None
 
@@ -65,12 +156,14 @@ class Worker(abc.ABC):
             num_reqs = 0
             t1 = time.time()
             for _ in range(5):
+                start = time.perf_counter()
                 try:
                     num_reqs += self.request()
                 except:
                     traceback.print_exc()
                     self._done.value = True
                     return
+                self._record((time.perf_counter() - start) * 1e6)
             t2 = time.time()
             req_time = (t2 - t1) / num_reqs
 
@@ -102,16 +195,53 @@ class Worker(abc.ABC):
 
         self._done.value = True
 
+    def _record(self, latency: float):
+        self.histogram.record(latency)
+        if self.op is not None:
+            self.op_histograms[self.op].record(latency)
+
+    def _open_loop(self):
+        interval = 1 / self._target_rate
+        start = time.perf_counter()
+        scheduled = start
+
+        i = 0
+        while self._count is None or i < self._count:
+            now = time.perf_counter()
+            if scheduled > now:
+                time.sleep(scheduled - now)
+            try:
+                num_reqs = self.request()
+            except:
+                traceback.print_exc()
+                break
+            i += num_reqs
+            now = time.perf_counter()
+            self._record((now - scheduled) * 1e6)
+            self._cur_rate.value = i / (now - start)
+
+            # The rate counts requests, and a call may issue several: the
+            # next call arrives once each of them has had its interval.
+            num_reqs = max(num_reqs, 1)
+            if self._arrival == 'poisson':
+                scheduled += random.gammavariate(num_reqs, interval)
+            else:
+                scheduled += num_reqs * interval
+
+        self._done.value = True
+
 
 class Benchmark:
-    def __init__(self, workers: List[Worker], refresh: int):
+    def __init__(self, workers: List[Worker], refresh: int, json_path: str = None):
         self._workers = workers
         self._refresh = refresh
+        self._json_path = json_path
 
     def add_worker(self, worker: Worker):
         self._workers.append(worker)
 
     def run(self):
+        start = time.perf_counter()
         for worker in self._workers:
             worker.start()
 
@@ -120,8 +250,11 @@ class Benchmark:
 
         for worker in self._workers:
             worker.join()
+        signal.alarm(0)
+        elapsed = time.perf_counter() - start
 
         self._print_summary()
+        self._print_latency(elapsed)
 
     def _alarm_handler(self, signum, stack):
         self._print_summary()
@@ -138,6 +271,47 @@ class Benchmark:
             f'({min(rates):.2f} - {max(rates):.2f})')
         sys.stdout.flush()
 
+    def _print_latency(self, elapsed: float):
+        histogram = Histogram()
+        op_histograms = {}
+        for worker in self._workers:
+            histogram.merge(worker.histogram)
+            for op, op_histogram in worker.op_histograms.items():
+                op_histograms.setdefault(op, Histogram()).merge(op_histogram)
+        summary = histogram.summary()
+        op_summaries = {op: op_histogram.summary()
+                        for op, op_histogram in op_histograms.items()}
+
+        print(f'{summary["count"]} calls in {elapsed:.2f} s '
+              f'({summary["count"] / elapsed:.2f} calls/s)')
+        if summary['count']:
+            print('Latency (ms):')
+            for key in ['mean'] + [f'p{p:g}' for p in PERCENTILES] + ['max']:
+                print(f'  {key:>8} {summary[key] / 1e3:10.3f}')
+        if op_summaries:
+            print(f'{"Operation":<16} {"calls":>8} {"calls/s":>10} {"mean ms":>10} '
+                  f'{"p50 ms":>10} {"p99 ms":>10} {"max ms":>10}')
+            for op, op_summary in op_summaries.items():
+                if not op_summary['count']:
+                    continue
+                print(f'{op:<16} {op_summary["count"]:>8} '
+                      f'{op_summary["count"] / elapsed:>10.2f} ' +
+                      ' '.join(f'{op_summary[key] / 1e3:>10.3f}'
+                               for key in ['mean', 'p50', 'p99', 'max']))
+        sys.stdout.flush()
+
+        if self._json_path is not None:
+            arrival = self._workers[0]._arrival if self._workers else None
+            with open(self._json_path, 'w') as f:
+                json.dump({
+                    'arrival': arrival,
+                    'workers': len(self._workers),
+                    'elapsed': elapsed,
+                    'latency_us': summary,
+                    'ops_latency_us': op_summaries,
+                    'histogram_us': histogram.buckets(),
+                }, f, indent=2)
+
     @staticmethod
     def add_args(parser: argparse.ArgumentParser):
         parser.add_argument('-c', '--count', type=int, default=None,
@@ -148,13 +322,21 @@ class Benchmark:
                             default=1, help='Parallel workers.')
         parser.add_argument('-R', '--refresh', type=int,
                             default=1, help='Refresh rate, in seconds.')
+        parser.add_argument('-a', '--arrival', choices=ARRIVALS, default='closed',
+                            help='Request arrivals: closed loop, or open loop at '
+                            'the total request rate with constant or Poisson '
+                            'intervals.')
+        parser.add_argument('--json', default=None,
+                            help='Dump latency results to a JSON file.')
 
     @staticmethod
     def from_args(cmd_args: argparse.Namespace, worker_cls: Type[Worker], *args, **kwargs):
+        if cmd_args.arrival != 'closed' and cmd_args.rate is None:
+            raise ValueError('Open-loop arrivals need a request rate')
         worker_rate = cmd_args.rate / cmd_args.jobs if cmd_args.rate is not None else None
         workers = [
-            worker_cls(count=cmd_args.count,
-                       rate=worker_rate, *args, **kwargs)
+            worker_cls(count=cmd_args.count, rate=worker_rate,
+                       arrival=cmd_args.arrival, *args, **kwargs)
             for _ in range(cmd_args.jobs)
         ]
-        return Benchmark(workers, cmd_args.refresh)
+        return Benchmark(workers, cmd_args.refresh, cmd_args.json)
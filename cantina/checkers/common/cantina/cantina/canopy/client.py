@@ -6,10 +6,9 @@ from typing import Dict, Optional, Tuple
 from functools import partial
 
 from cantina import Cipher
-from .fields import ExtraData, Session, MessageLength, SequenceNumber, \
-    CipherData
+from .fields import ExtraData, Session, MessageLength, CipherData
 from .messages import SessionStartMessage, SessionDataMessage
-from .session import SessionState
+from .session import SessionState, SessionTable
 
 
 class Client:
@@ -22,10 +21,7 @@ class Client:
     ):
         self.send_queue = send_queue
         self.cipher = cipher
-        self.sessions: Dict[
-            Session,
-            SessionState
-        ] = dict()
+        self.sessions = SessionTable()
 
         if logger:
             self.logger = logger
@@ -66,17 +62,14 @@ class Client:
         state: SessionState,
         data: bytes
     ) -> None:
-        # Chunk size is leftover of CAN-FD frame size 
-        chunk_size = 64 - SessionDataMessage.min_length()
-        for offset in range(0, len(data), chunk_size):
-            chunk = data[offset:offset + chunk_size]
-            msg = SessionDataMessage.encrypt(
-                state.cipher,
-                session_id,
-                SequenceNumber(offset // chunk_size),
-                data=chunk
-            )
-            await self.send_queue.put(msg.can_msg(self.mid_data))
+        frames = SessionDataMessage.encrypt_frames(
+            state.cipher,
+            session_id,
+            data,
+            self.mid_data
+        )
+        for msg in frames:
+            await self.send_queue.put(msg)
 
     async def _handle_reply_start(self, can_msg: can.Message) -> None:
         msg = SessionStartMessage.from_msg(can_msg)
@@ -86,7 +79,7 @@ class Client:
             return
 
         session = self.sessions.get(msg.session_id)
-        if session is None:
+        if session is None or session.started:
             # Not our session (or possible error)
             return
         
@@ -100,8 +93,8 @@ class Client:
             ))
             return 
 
-        # Store number of bytes to receive in reply
-        session.remaining_bytes = msg.length.value
+        # Set up for the number of bytes to receive in reply
+        session.expect(msg.length.value)
         session.start_data = msg.extra_data.value
 
     async def _handle_reply_data(self, can_msg: can.Message) -> None:
@@ -116,8 +109,8 @@ class Client:
             # Not our session (or possible error)
             return
 
-        if session.seq != msg.seq:
-            # Sequence IDs don't match up
+        if not session.in_window(msg.seq):
+            # Sequence ID not expected (yet)
             return
         
         plain_data = msg.decrypt(session.cipher)
@@ -130,21 +123,18 @@ class Client:
             ))
             return 
 
-        # Check if we still expect enough data
-        data_len = len(plain_data)
-        if data_len > session.remaining_bytes:
+        # Store the chunk, checking it has the expected size
+        if not session.add_chunk(msg.seq, plain_data):
             # I don't think this can technically
             # happen together with the other precautions,
             # but just checking it to be safe
-            logging.info('Payload bigger than expected, ' \
-                'got {}, expected {}'.format(
-                    data_len,
-                    session.remaining_bytes
+            logging.info('Unexpected payload size {} ' \
+                'for {}, {}'.format(
+                    len(plain_data),
+                    msg.session_id,
+                    msg.seq
                 )
             )
-            return
-
-        session.add_data(plain_data)
 
     async def send(
         self,
@@ -172,7 +162,8 @@ class Client:
         if session_id is None:
             session_id = Session()
 
-            # TODO: Race condition!
+            # Nothing awaits until the session is inserted below, so
+            # no other handler can take the ID in the meantime
             while session_id in self.sessions:
                 session_id = Session()
 
@@ -241,7 +232,8 @@ class Client:
         finally:
             # STEP 4: Cleanup session info
             # ---------------------------------------------------------
-            del self.sessions[session_id]
+            if self.sessions.get(session_id) is state:
+                self.sessions.pop(session_id)
 
     def recv_handlers(self):
         return {
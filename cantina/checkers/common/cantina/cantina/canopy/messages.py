@@ -1,55 +1,96 @@
 import can
+import struct
 
 from dataclasses import dataclass, fields
-from typing import Optional, TypeVar, Type
+from typing import List, Optional, TypeVar, Type
 
 from cantina import Cipher
 from .fields import CanopyField, ExtraData, Session, SequenceNumber, \
         MessageLength, CipherData
 
 
+class _Layout:
+    """
+    Wire layout of a session message, compiled once per class: the
+    fixed size fields up front, packed with a single struct, followed
+    by the cipher data taking the rest of the frame.
+    """
+
+    def __init__(self, cls: type):
+        self.names: List[str] = []
+        self.types: List[Type[CanopyField]] = []
+        packing = '>'
+        cname: Optional[str] = None
+        for field in fields(cls):
+            assert issubclass(field.type, CanopyField), \
+                "Only CanopyField attributes supported"
+            if field.type == CipherData:
+                cname = field.name
+                continue
+            assert cname is None, "CipherData has to be the last field"
+            self.names.append(field.name)
+            self.types.append(field.type)
+            if field.type.PACKING:
+                packing += field.type.PACKING.lstrip('>')
+            else:
+                packing += f'{field.type.FIELD_SIZE}s'
+        assert cname is not None, "No CipherData field found"
+
+        self.cipher_name = cname
+        self.header = struct.Struct(packing)
+        self.min_length = self.header.size + CipherData.FIELD_SIZE
+
+
 _SessionMessage = TypeVar('_SessionMessage', bound='SessionMessage')
 @dataclass(frozen=True)
 class SessionMessage:
-    def can_msg(self, arbitration_id: int) -> can.Message:
-        # Add all attributes
-        payload = bytearray()
-        for field in fields(self):
-            payload += bytes(getattr(self, field.name))
+    @classmethod
+    def _layout(cls: Type[_SessionMessage]) -> _Layout:
+        # Not inherited: every subclass has its own fields
+        layout = cls.__dict__.get('_compiled_layout')
+        if layout is None:
+            layout = _Layout(cls)
+            setattr(cls, '_compiled_layout', layout)
+        return layout
+
+    def _header(self, layout: _Layout) -> bytes:
+        return layout.header.pack(*[
+            getattr(self, name).value for name in layout.names
+        ])
 
+    def can_msg(self, arbitration_id: int) -> can.Message:
+        layout = self._layout()
+        cipher_data = getattr(self, layout.cipher_name)
         return can.Message(
             arbitration_id=arbitration_id,
-            data=payload,
+            data=self._header(layout) + cipher_data.value,
             is_fd=True,
             is_extended_id=False
         )
 
     @classmethod
     def min_length(cls: Type[_SessionMessage]):
-        length = 0 
-        for field in fields(cls):
-            length += field.type.FIELD_SIZE
-        return length
+        return cls._layout().min_length
 
     @classmethod
     def from_msg(
         cls: Type[_SessionMessage],
         msg: can.Message
     ) -> Optional[_SessionMessage]:
-        data = bytes(msg.data)
-        kwargs = dict()
-
-        for field in fields(cls):
-            if not issubclass(field.type, CanopyField):
-                continue
+        layout = cls._layout()
+        data = memoryview(msg.data)
+        if len(data) < layout.min_length:
+            return None
 
-            value, num_bytes = field.type.from_bytes(data)
-            if value is None:
+        kwargs = dict()
+        values = layout.header.unpack_from(data)
+        for name, ftype, value in zip(layout.names, layout.types, values):
+            if not ftype._value_valid(value):
                 return None
+            kwargs[name] = ftype(value)
 
-            kwargs[field.name] = value
-            data = data[num_bytes:]
-
+        kwargs[layout.cipher_name] = CipherData(
+            bytes(data[layout.header.size:]))
         return cls(**kwargs)
 
     @classmethod
@@ -59,45 +100,26 @@ class SessionMessage:
         *args,
         data: bytes = b''
     ) -> _SessionMessage:
-        kwargs = dict()
-
-        # Find cipher data attribute
-        cname: Optional[str] = None
-        for field in fields(cls):
-            if field.type == CipherData:
-                cname = field.name
-                break
-        assert cname is not None, "No CipherData field found"
+        layout = cls._layout()
+        assert len(args) == len(layout.types), "Invalid Arguments"
 
         # Add all attributes
-        ad = bytearray()
-        for arg, field in zip(args, fields(cls)):
-            assert isinstance(arg, field.type), "Invalid Argument"
-            kwargs[field.name] = arg
-            ad += bytes(arg)
+        kwargs = dict()
+        for arg, name, ftype in zip(args, layout.names, layout.types):
+            assert isinstance(arg, ftype), "Invalid Argument"
+            kwargs[name] = arg
 
         # Encrypt
-        ad = bytes(ad)
-        cd = CipherData.from_plaintext(cipher, data, ad)
-        kwargs[cname] = cd
+        ad = layout.header.pack(*[arg.value for arg in args])
+        kwargs[layout.cipher_name] = CipherData.from_plaintext(
+            cipher, data, ad)
         return cls(**kwargs)
 
     def decrypt(self, cipher: Cipher) -> Optional[bytes]:
-        cipher_data: Optional[CipherData] = None
-
-        # Build authenticated data for check
-        ad = bytearray()
-        for field in fields(self):
-            if field.type == CipherData:
-                cipher_data = getattr(self, field.name)
-                continue
-            ad += bytes(getattr(self, field.name))
-
-        # If no cipher data was found, we can't decrypt
-        if cipher_data is None:
-            return None
-
-        return cipher_data.to_plaintext(cipher, bytes(ad))
+        # Authenticated data is the header as sent
+        layout = self._layout()
+        cipher_data = getattr(self, layout.cipher_name)
+        return cipher_data.to_plaintext(cipher, self._header(layout))
 
 
 @dataclass(frozen=True)
@@ -114,3 +136,42 @@ class SessionDataMessage(SessionMessage):
     seq: SequenceNumber
     cipher_data: CipherData
 
+    @classmethod
+    def chunk_size(cls) -> int:
+        # Leftover of CAN-FD frame size
+        return 64 - cls.min_length()
+
+    @classmethod
+    def encrypt_frames(
+        cls,
+        cipher: Cipher,
+        session_id: Session,
+        data: bytes,
+        arbitration_id: int
+    ) -> List[can.Message]:
+        """
+        Split data into chunks and build the frames of all of them in
+        one pass, the same as encrypting them one by one with
+        sequence numbers counting up from 0
+        """
+        layout = cls._layout()
+        chunk_size = cls.chunk_size()
+        headers = [
+            layout.header.pack(session_id.value, seq)
+            for seq in range(-(-len(data) // chunk_size))
+        ]
+        assert len(headers) <= SequenceNumber.MAX_SIZE, \
+            'Sequence number has to fit into 1 byte'
+        cipher_data = cipher.encrypt_many(
+            (data[seq * chunk_size:(seq + 1) * chunk_size], header)
+            for seq, header in enumerate(headers)
+        )
+        return [
+            can.Message(
+                arbitration_id=arbitration_id,
+                data=header + cd,
+                is_fd=True,
+                is_extended_id=False
+            )
+            for header, cd in zip(headers, cipher_data)
+        ]
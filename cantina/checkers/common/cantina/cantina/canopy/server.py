@@ -6,10 +6,9 @@ from typing import Dict, Optional
 from functools import partial
 
 from cantina import Cipher
-from .fields import Session, CipherData, MessageLength, \
-    SequenceNumber
+from .fields import Session, CipherData, MessageLength, ExtraData
 from .messages import SessionStartMessage, SessionDataMessage
-from .session import SessionState
+from .session import SessionState, SessionTable, CompletedSessions
 
 
 class Server:
@@ -22,7 +21,11 @@ class Server:
     ):
         self.cipher = cipher
         self.send_queue = send_queue
-        self.sessions: Dict[Session, SessionState] = dict()
+        self.sessions = SessionTable()
+        # Frames dropped for belonging to a session completed just
+        # before, instead of opening a new session
+        self.completed = CompletedSessions()
+        self.late_frames = 0
         if logger:
             self.logger = logger
         else:
@@ -43,7 +46,8 @@ class Server:
         msg = SessionStartMessage.encrypt(
             session_state.cipher,
             session_id,
-            length 
+            length,
+            ExtraData.empty()
         )
         await self.send_queue.put(msg.can_msg(self.mid_reply_start))
 
@@ -53,17 +57,14 @@ class Server:
         session_state: SessionState,
         data: bytes
     ) -> None:
-        # Chunk size is leftover of CAN-FD frame size 
-        chunk_size = 64 - SessionDataMessage.min_length()
-        for offset in range(0, len(data), chunk_size):
-            chunk = data[offset:offset + chunk_size]
-            msg = SessionDataMessage.encrypt(
-                session_state.cipher,
-                session_id,
-                SequenceNumber(offset // chunk_size),
-                data=chunk
-            )
-            await self.send_queue.put(msg.can_msg(self.mid_reply_data))
+        frames = SessionDataMessage.encrypt_frames(
+            session_state.cipher,
+            session_id,
+            data,
+            self.mid_reply_data
+        )
+        for msg in frames:
+            await self.send_queue.put(msg)
 
     async def build_reply(
         self,
@@ -77,18 +78,10 @@ class Server:
 
     async def update_loop(self) -> None:
         while True:
-            await asyncio.sleep(1)
-
-            # Remove stale sessions from session state dict
-            # TODO: locking!
-            stale_sessions = [
-                session_id
-                for session_id, state in self.sessions.items()
-                if state.is_timeout()
-            ]
-            for session_id in stale_sessions:
+            # Remove stale sessions from the session table as soon
+            # as they time out
+            for session_id, _ in await self.sessions.expired():
                 self.logger.info(f'Session {session_id} timed out')
-                del self.sessions[session_id]
 
     def _initialize_session(
         self,
@@ -102,7 +95,9 @@ class Server:
         # -------------------------------------------------
         # We received a session start packet, before we
         # verify the integrity, check if we already have
-        # an open session with the same ID.
+        # an open session with the same ID. A session
+        # that only has data frames that overtook the
+        # start is not open yet.
         #
         # If we don't have an open session, verify the
         # integrity, then create the session structure
@@ -114,7 +109,8 @@ class Server:
             return
 
         self.logger.info(f'Received session start: {msg}')
-        if msg.session_id in self.sessions:
+        state = self.sessions.get(msg.session_id)
+        if state is not None and state.started:
             # Session already exists!
             self.logger.info('Session {} exists!'.format(
                 msg.session_id
@@ -122,8 +118,11 @@ class Server:
             return
         
         # Initialize the session state
-        state = SessionState(msg.length.value)
-        self._initialize_session(msg.session_id, state)
+        if state is None:
+            if self._is_late(msg.session_id):
+                return
+            state = SessionState()
+            self._initialize_session(msg.session_id, state)
 
         # Try if we can decrypt the message
         if msg.decrypt(state.cipher) is None:
@@ -136,20 +135,25 @@ class Server:
             return 
 
         # Parse the rest of the message
-        # TODO: locking!
-        self.sessions[msg.session_id] = state
+        state.expect(msg.length.value)
+        state.refresh()
+        self.sessions.add(msg.session_id, state)
         self.logger.info('{} started, {}'.format(
             msg.session_id,
             msg.length
         ))
 
+        # All data frames may have overtaken the start
+        if state.received.is_set():
+            await self._handle_session_complete(msg.session_id, state)
+
     async def _handle_session_data(self, can_msg: can.Message):
         # STEP 2: Receive the data frames from a peer
         # -------------------------------------------------
         # Now we're receiving the data frames from the
-        # peer, hopefully in order. We're checking the
-        # order by only accepting frames that correspond
-        # the to correct sequence ID
+        # peer, hopefully in order. Frames arriving early
+        # are stored in place, as long as they are within
+        # the reassembly window
         msg = SessionDataMessage.from_msg(can_msg)
         if msg is None:
             # Message was not in expected format for given message ID!
@@ -157,17 +161,20 @@ class Server:
 
         self.logger.info(f'Received session data: {msg}')
         state = self.sessions.get(msg.session_id)
-        if state is None:
-            # No such session! We can't accept the data in this case
-            self.logger.info('No such {}!'.format(
-                msg.session_id
-            ))
-            return
+        new_session = state is None
+        if new_session:
+            # No such session (yet), the start frame may still be
+            # on its way. Keep the frame once authenticated, the
+            # session times out if the start never arrives
+            if self._is_late(msg.session_id):
+                return
+            state = SessionState()
+            self._initialize_session(msg.session_id, state)
 
-        # Make sure sequence IDs match up 
-        if state.seq != msg.seq:
+        # Make sure the sequence ID is expected
+        if not state.in_window(msg.seq):
             self.logger.info(
-                'Expected {}, got {} for {}'.format(
+                'Expected from {}, got {} for {}'.format(
                     state.seq,
                     msg.seq,
                     msg.session_id 
@@ -186,35 +193,45 @@ class Server:
             ))
             return
 
-        # Check if we still expect enough data
-        data_len = len(plain_data)
-        if data_len > state.remaining_bytes:
+        # Store the chunk, checking it has the expected size
+        if not state.add_chunk(msg.seq, plain_data):
             # I don't think this can technically
             # happen together with the other precautions,
             # but just checking it to be safe
-            self.logger.info('Payload bigger than expected, ' \
-                'got {}, expected {}'.format(
-                    data_len,
-                    state.remaining_bytes
+            self.logger.info('Unexpected payload size {} ' \
+                'for {}, {}'.format(
+                    len(plain_data),
+                    msg.session_id,
+                    msg.seq
                 )
             )
             return
 
-        # If we get something non-None here, we're done
-        # receiving
-        payload = state.add_data(plain_data)
-        if payload is None:
+        if new_session:
+            self.sessions.add(msg.session_id, state)
+
+        # If all chunks are in, we're done receiving
+        if not state.received.is_set():
             state.refresh()
             return
 
+        await self._handle_session_complete(msg.session_id, state)
+
+    async def _handle_session_complete(
+        self,
+        session_id: Session,
+        state: SessionState
+    ):
+        # STEP 3: Verify the assembled data and reply
+        # -------------------------------------------------
         # Remove state from session table
-        # TODO: locking!
-        del self.sessions[msg.session_id]
+        self.sessions.pop(session_id)
+        self.completed.add(session_id)
 
-        # Make sure payload was sent in order (
+        # Make sure payload was assembled correctly (
         # in theory our sequence number check should
         # have already taken care of that)
-        payload = bytes(payload)
+        payload = bytes(state.buffer)
         data = payload[:-CipherData.FIELD_SIZE]
         cd = CipherData(payload[-CipherData.FIELD_SIZE:])
         if cd.to_plaintext(state.cipher, data) is None:
@@ -222,7 +239,7 @@ class Server:
             # definitely don't want to send an error,
             # this is most likely malicious activity
             self.logger.info('InvalidTag for assembled {}'.format(
-                msg.session_id
+                session_id
             ))
             return
 
@@ -230,13 +247,22 @@ class Server:
         self.logger.info(f'Received data: {data.hex()}')
 
         # Build reply and send it back
-        data = await self.build_reply(msg.session_id, data)
+        data = await self.build_reply(session_id, data)
         await self._send_reply_start(
-            msg.session_id,
+            session_id,
             state,
             MessageLength(len(data))
         )
-        await self._send_reply_data(msg.session_id, state, data)
+        await self._send_reply_data(session_id, state, data)
+
+    def _is_late(self, session_id: Session) -> bool:
+        if session_id not in self.completed:
+            return False
+        self.late_frames += 1
+        self.logger.info('Frame for completed session {}'.format(
+            session_id
+        ))
+        return True
 
     def recv_handlers(self):
         return {
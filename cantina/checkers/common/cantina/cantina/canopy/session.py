@@ -1,16 +1,23 @@
 import asyncio
+import heapq
+import itertools
 import time
 
+from collections import OrderedDict
 from dataclasses import dataclass, field
-from typing import Optional, ClassVar
+from typing import Dict, List, Optional, ClassVar, Tuple
 
-from .fields import SequenceNumber
+from .fields import Session, SequenceNumber
+from .messages import SessionDataMessage
 from ..cipher import Cipher
 
 
 @dataclass
 class SessionState:
     SESSION_TIMEOUT: ClassVar[int] = 2_000_000_000 # 2s
+    CHUNK_SIZE: ClassVar[int] = SessionDataMessage.chunk_size()
+    # Frames accepted ahead of the first missing one
+    REASSEMBLY_WINDOW: ClassVar[int] = 64
 
     remaining_bytes: int = 0
     received: asyncio.Event = \
@@ -24,6 +31,15 @@ class SessionState:
         field(default_factory=lambda: bytearray())
     cipher: Cipher = \
         field(default_factory=lambda: Cipher())
+    # Whether the message length is known, chunks received before
+    # that, received flag of each chunk, and number of chunks
+    # received out of order
+    started: bool = False
+    early: Dict[int, bytes] = \
+        field(default_factory=lambda: dict())
+    chunks: bytearray = \
+        field(default_factory=lambda: bytearray())
+    reordered: int = 0
 
     def __post_init__(self):
         self.refresh()
@@ -34,6 +50,13 @@ class SessionState:
         """
         self.last_checked = time.monotonic_ns()
 
+    def deadline(self) -> int:
+        """
+        Monotonic time in nanoseconds after which this session
+        times out, unless refreshed
+        """
+        return self.last_checked + self.SESSION_TIMEOUT
+
     def is_timeout(self) -> bool:
         """
         Check if this session timed out (i.e. hasn't been refreshed
@@ -42,13 +65,247 @@ class SessionState:
         ntime = time.monotonic_ns()
         return ntime - self.last_checked > self.SESSION_TIMEOUT
 
-    def add_data(self, data: bytes) -> Optional[bytearray]:
-        self.seq = SequenceNumber(self.seq.value + 1)
-        self.buffer += data
+    def expect(self, length: int):
+        """
+        Set up reassembly of a message of the given length, sent in
+        chunks of CHUNK_SIZE bytes with sequence numbers counting up
+        from 0
+        """
+        self.started = True
+        self.remaining_bytes = length
+        self.buffer = bytearray(length)
+        self.chunks = bytearray(-(-length // self.CHUNK_SIZE))
+        self.seq = SequenceNumber(0)
+        if length == 0:
+            self.received.set()
+
+        # Place the chunks that overtook the start
+        early, self.early = self.early, dict()
+        for seq, data in sorted(early.items()):
+            self.add_chunk(SequenceNumber(seq), data)
+
+    def in_window(self, seq: SequenceNumber) -> bool:
+        """
+        Check if a chunk is still missing and within the reassembly
+        window, starting at the first missing chunk (self.seq)
+        """
+        if not self.started:
+            return seq.value < self.REASSEMBLY_WINDOW and \
+                seq.value not in self.early
+
+        first = self.seq.value
+        end = min(first + self.REASSEMBLY_WINDOW, len(self.chunks))
+        return first <= seq.value < end and not self.chunks[seq.value]
+
+    def add_chunk(self, seq: SequenceNumber, data: bytes) -> bool:
+        """
+        Store a chunk in place (or aside until the length is known),
+        returns False if it is not expected or has the wrong length.
+        Once all chunks are in, the message is in self.buffer and
+        self.received is set
+        """
+        if not self.in_window(seq):
+            return False
+        if not self.started:
+            # Length checked once known
+            if len(data) > self.CHUNK_SIZE:
+                return False
+            self.early[seq.value] = data
+            return True
+
+        offset = seq.value * self.CHUNK_SIZE
+        if len(data) != min(self.CHUNK_SIZE, len(self.buffer) - offset):
+            return False
+
+        self.buffer[offset:offset + len(data)] = data
+        self.chunks[seq.value] = 1
         self.remaining_bytes -= len(data)
-        if self.remaining_bytes > 0:
-            return None
+        if seq != self.seq:
+            self.reordered += 1
+
+        # Slide the window up to the next missing chunk
+        first = self.seq.value
+        while first < len(self.chunks) and self.chunks[first]:
+            first += 1
+        self.seq = SequenceNumber(first)
+
+        if self.remaining_bytes == 0:
+            # We're done
+            self.received.set()
+        return True
+
+
+class SessionTable:
+    """
+    Session states by session ID, with a min-heap of deadlines so
+    that expiring sessions costs in proportion to the sessions that
+    actually expire, instead of a scan over all of them.
+
+    Each session has a single heap entry. Refreshing a session only
+    updates its state: when its entry comes up, it is pushed back
+    with the new deadline. Entries of deleted or replaced sessions
+    are dropped when they come up, or all at once by rebuilding the
+    heap when they make up more than half of it.
+
+    None of the methods await, so each one is atomic with respect to
+    the handlers running concurrently on the event loop.
+    """
+
+    def __init__(self):
+        self._sessions: Dict[Session, SessionState] = dict()
+        # (deadline, insertion counter, session ID, state)
+        self._heap: List[Tuple[int, int, Session, SessionState]] = []
+        self._counter = itertools.count()
+        self._scheduled = asyncio.Event()
+        # Heap entries of deleted or replaced sessions
+        self._stale = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, session_id: Session) -> bool:
+        return session_id in self._sessions
+
+    def __getitem__(self, session_id: Session) -> SessionState:
+        return self._sessions[session_id]
+
+    def __setitem__(self, session_id: Session, state: SessionState):
+        if session_id in self._sessions:
+            self._stale += 1
+        self._sessions[session_id] = state
+        self._schedule(session_id, state)
+
+    def __delitem__(self, session_id: Session):
+        del self._sessions[session_id]
+        self._discard()
+
+    def get(
+        self,
+        session_id: Session,
+        default: Optional[SessionState] = None
+    ) -> Optional[SessionState]:
+        return self._sessions.get(session_id, default)
+
+    def pop(
+        self,
+        session_id: Session,
+        default: Optional[SessionState] = None
+    ) -> Optional[SessionState]:
+        if session_id not in self._sessions:
+            return default
+        state = self._sessions.pop(session_id)
+        self._discard()
+        return state
+
+    def add(self, session_id: Session, state: SessionState) -> bool:
+        """
+        Insert a session unless one with the same ID exists, returns
+        whether it was inserted
+        """
+        if session_id in self._sessions:
+            return False
+        self[session_id] = state
+        return True
+
+    def expire(self) -> List[Tuple[Session, SessionState]]:
+        """
+        Remove and return all sessions that timed out
+        """
+        expired = []
+        now = time.monotonic_ns()
+        while self._heap and self._heap[0][0] < now:
+            _, _, session_id, state = heapq.heappop(self._heap)
+            if self._sessions.get(session_id) is not state:
+                self._stale -= 1
+                continue
+            if state.deadline() >= now:
+                # Refreshed since scheduled
+                self._schedule(session_id, state)
+                continue
+            del self._sessions[session_id]
+            expired.append((session_id, state))
+        return expired
+
+    async def expired(self) -> List[Tuple[Session, SessionState]]:
+        """
+        Wait until sessions time out, then remove and return them
+        """
+        while True:
+            expired = self.expire()
+            if expired:
+                return expired
+
+            self._scheduled.clear()
+            if not self._heap:
+                await self._scheduled.wait()
+                continue
+
+            # New sessions expire after the ones already scheduled,
+            # so only the earliest deadline needs to be waited for
+            timeout = (self._heap[0][0] - time.monotonic_ns()) / 1e9
+            await asyncio.sleep(max(timeout, 0))
+
+    def _schedule(self, session_id: Session, state: SessionState):
+        # Drop the entries of deleted sessions as they come up, so
+        # that tables nobody expires do not grow
+        while self._heap and \
+                self._sessions.get(self._heap[0][2]) is not self._heap[0][3]:
+            heapq.heappop(self._heap)
+            self._stale -= 1
+
+        if not self._heap:
+            self._scheduled.set()
+        heapq.heappush(
+            self._heap,
+            (state.deadline(), next(self._counter), session_id, state)
+        )
+        self._compact()
+
+    def _discard(self):
+        self._stale += 1
+        self._compact()
+
+    def _compact(self):
+        # Rebuild the heap from the live sessions once stale entries
+        # make up more than half of it, so that it stays in proportion
+        # to the number of sessions
+        if self._stale <= len(self._heap) // 2:
+            return
+        self._heap = [
+            (state.deadline(), next(self._counter), session_id, state)
+            for session_id, state in self._sessions.items()
+        ]
+        heapq.heapify(self._heap)
+        self._stale = 0
+
+
+class CompletedSessions:
+    """
+    IDs of the sessions completed within the last SESSION_TIMEOUT, up
+    to MAX_SIZE of them, so that late or replayed frames of a finished
+    session are not taken for the start of a new one
+    """
+    MAX_SIZE: ClassVar[int] = 1024
+
+    def __init__(self):
+        # Completion time by session ID, oldest first
+        self._completed: 'OrderedDict[Session, int]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._completed)
+
+    def __contains__(self, session_id: Session) -> bool:
+        self._prune()
+        return session_id in self._completed
+
+    def add(self, session_id: Session):
+        self._completed[session_id] = time.monotonic_ns()
+        self._completed.move_to_end(session_id)
+        self._prune()
 
-        # We're done, return data
-        self.received.set()
-        return self.buffer
+    def _prune(self):
+        cutoff = time.monotonic_ns() - SessionState.SESSION_TIMEOUT
+        while self._completed and (
+                len(self._completed) > self.MAX_SIZE or
+                next(iter(self._completed.values())) < cutoff):
+            self._completed.popitem(last=False)
@@ -1,11 +1,14 @@
 import secrets
 
-from typing import Optional
+from typing import Iterable, List, Optional, Tuple
 from cryptography.hazmat.primitives.ciphers.aead \
     import ChaCha20Poly1305
 from cryptography.exceptions import InvalidTag
 
 
+NONCE_SIZE = 12
+
+
 class Cipher:
     def __init__(self):
         self.cipher = None
@@ -22,10 +25,30 @@ class Cipher:
     ) -> bytes:
         assert self.cipher is not None, \
             'Check cipher is ok before attempting encryption'
-        nonce = secrets.token_bytes(12)
+        nonce = secrets.token_bytes(NONCE_SIZE)
         ciphertext = self.cipher.encrypt(nonce, data, ad)
         return nonce + ciphertext
 
+    def encrypt_many(
+        self,
+        chunks: Iterable[Tuple[bytes, Optional[bytes]]]
+    ) -> List[bytes]:
+        """
+        Encrypt a batch of (data, ad) pairs like encrypt, but with
+        nonces counting up from a single random base instead of
+        drawing a random nonce for each
+        """
+        assert self.cipher is not None, \
+            'Check cipher is ok before attempting encryption'
+        aead = self.cipher
+        base = int.from_bytes(secrets.token_bytes(NONCE_SIZE), 'big')
+        result = []
+        for i, (data, ad) in enumerate(chunks):
+            nonce = ((base + i) % (1 << (8 * NONCE_SIZE))) \
+                .to_bytes(NONCE_SIZE, 'big')
+            result.append(nonce + aead.encrypt(nonce, data, ad))
+        return result
+
     def decrypt(
         self,
         nonce: bytes,
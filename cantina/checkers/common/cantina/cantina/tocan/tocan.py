@@ -26,14 +26,45 @@ def pack_can_message(msg: can.Message):
     return can_frame.pack()
 
 class ToCan:
-    def __init__(self):
-        self.messages_in = janus.Queue()
-        self.messages_out = janus.Queue()
+    # Reads grow while they come back full (bursts of frames), and
+    # shrink back once the connection calms down
+    READ_SIZE_MIN = 256
+    READ_SIZE_MAX = 64 * 1024
+    # Leftover of a full read plus the messages fed after it
+    UNPACKER_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, sync: bool = False):
+        """
+        Messages are queued in plain asyncio queues. With sync set,
+        thread-safe janus queues are used instead, which the *_sync
+        methods require
+        """
+        self.sync = sync
+        if sync:
+            self.messages_in = janus.Queue()
+            self.messages_out = janus.Queue()
+            self._queue_in = self.messages_in.async_q
+            self._queue_out = self.messages_out.async_q
+        else:
+            self.messages_in = asyncio.Queue()
+            self.messages_out = asyncio.Queue()
+            self._queue_in = self.messages_in
+            self._queue_out = self.messages_out
+
+    def _check_sync(self):
+        if not self.sync:
+            raise RuntimeError("Synchronous access requires sync=True")
 
     async def _recv(self, reader):
-        unpacker = msgpack.Unpacker(max_buffer_size=1024)
+        unpacker = msgpack.Unpacker(
+            max_buffer_size=self.UNPACKER_BUFFER_SIZE)
+        read_size = self.READ_SIZE_MIN
         while not reader.at_eof():
-            data = await reader.read(256)
+            data = await reader.read(read_size)
+            if len(data) == read_size:
+                read_size = min(read_size * 2, self.READ_SIZE_MAX)
+            elif len(data) < read_size // 4:
+                read_size = max(read_size // 2, self.READ_SIZE_MIN)
             unpacker.feed(data)
             for data in unpacker:
                 msg = load_message(data)
@@ -44,37 +75,56 @@ class ToCan:
         raise NotImplementedError("Need to implement handler function")
 
     async def _send(self, writer):
-        while msg := await self.messages_out.async_q.get():
-            writer.write(msg)
+        while True:
+            msg = await self._queue_out.get()
+            # Write out everything queued meanwhile before draining,
+            # an empty message stops the sender
+            written = 0
+            while msg:
+                writer.write(msg)
+                written += 1
+                if self._queue_out.empty():
+                    break
+                msg = self._queue_out.get_nowait()
             await writer.drain()
-            self.messages_out.async_q.task_done()
+            # Only flushed messages count as done
+            for _ in range(written):
+                self._queue_out.task_done()
+            if not msg:
+                # The stop message counts as done as well
+                self._queue_out.task_done()
+                return
 
     async def recv(self):
-        data = await self.messages_in.async_q.get()
-        self.messages_in.sync_q.task_done()
+        data = await self._queue_in.get()
+        self._queue_in.task_done()
         return data
 
     def recv_sync(self):
+        self._check_sync()
         data = self.messages_in.sync_q.get()
         self.messages_in.sync_q.task_done()
         return data
 
     async def send(self, msg: can.Message):
-        return await self.messages_out.async_q.put(pack_can_message(msg))
+        return await self._queue_out.put(pack_can_message(msg))
 
     def send_sync(self, msg: can.Message):
+        self._check_sync()
         return self.messages_out.sync_q.put(pack_can_message(msg))
 
     async def send_msg(self, msg: ToCanMessage):
-        return await self.messages_out.async_q.put(msg.pack())
+        return await self._queue_out.put(msg.pack())
 
     def send_msg_sync(self, msg: ToCanMessage):
+        self._check_sync()
         return self.messages_out.sync_q.put(msg.pack())
 
     async def send_raw(self, msg: bytes):
-        return await self.messages_out.async_q.put(msg)
+        return await self._queue_out.put(msg)
 
     def send_raw_sync(self, msg: bytes):
+        self._check_sync()
         return self.messages_out.sync_q.put(msg)
 
     async def start(self, reader, writer, additional_tasks=[]):
@@ -93,8 +143,9 @@ class ToCan:
 
 
 class ToCanClient(ToCan):
-    def __init__(self, host, port, bot_privkey=None, receive_own_messages=False):
-        super(ToCanClient, self).__init__()
+    def __init__(self, host, port, bot_privkey=None, receive_own_messages=False,
+                 sync=False):
+        super(ToCanClient, self).__init__(sync)
         self.host = host
         self.port = port
         self.receive_own_messages = receive_own_messages
@@ -105,7 +156,7 @@ class ToCanClient(ToCan):
         raise Exception("Connection closed")
 
     async def _handle(self, msg: ToCanMessage):
-        await self.messages_in.async_q.put(msg)
+        await self._queue_in.put(msg)
 
        # if isinstance(msg, CanFrame):
        #     can_message = msg.can_message
@@ -115,12 +166,6 @@ class ToCanClient(ToCan):
        # else:
        #     print("Unexpected: ", msg)
 
-    async def _send(self, writer):
-        while msg := await self.messages_out.async_q.get():
-            writer.write(msg)
-            await writer.drain()
-            self.messages_out.async_q.task_done()
-
 
 #class ToCanHandler(ToCan):
 #    def __init__(self, bot_pubkey):
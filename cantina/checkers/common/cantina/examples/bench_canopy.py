@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+from cryptography.hazmat.primitives.ciphers.aead \
+    import ChaCha20Poly1305 as AEAD
+
+from cantina import Cipher
+from cantina.canopy.fields import Session, MessageLength, ExtraData, \
+    SequenceNumber
+from cantina.canopy.messages import SessionStartMessage, SessionDataMessage
+
+
+def bench(name, func, frames):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<24} {frames / elapsed:>12,.0f} frames/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Canopy message encoding micro-benchmark')
+    parser.add_argument('-n', '--frames', type=int, default=100_000,
+                        help='Frames per operation')
+    args = parser.parse_args()
+    n = args.frames
+
+    cipher = Cipher()
+    cipher.update(AEAD(AEAD.generate_key()))
+    session_id = Session()
+    chunk = bytes(64 - SessionDataMessage.min_length())
+
+    start = SessionStartMessage.encrypt(
+        cipher, session_id, MessageLength(1000), ExtraData.empty())
+    data = SessionDataMessage.encrypt(
+        cipher, session_id, SequenceNumber(1), data=chunk)
+    start_msg = start.can_msg(1)
+    data_msg = data.can_msg(2)
+
+    for cls, msg, can_msg, fields in [
+        (SessionStartMessage, start, start_msg,
+            (session_id, MessageLength(1000), ExtraData.empty())),
+        (SessionDataMessage, data, data_msg,
+            (session_id, SequenceNumber(1)))
+    ]:
+        print(f'{cls.__name__}:')
+        bench('  encrypt', lambda: [
+            cls.encrypt(cipher, *fields, data=chunk) for _ in range(n)], n)
+        bench('  can_msg', lambda: [
+            msg.can_msg(1) for _ in range(n)], n)
+        bench('  from_msg', lambda: [
+            cls.from_msg(can_msg) for _ in range(n)], n)
+        bench('  decrypt', lambda: [
+            msg.decrypt(cipher) for _ in range(n)], n)
+
+    # A whole message of the maximum size, as sent by clients and
+    # servers
+    message = bytes(MessageLength.MAX_SIZE - 1)
+    chunk_size = SessionDataMessage.chunk_size()
+    frames = -(-len(message) // chunk_size)
+    messages = max(n // frames, 1)
+    print(f'Message of {len(message)} bytes ({frames} frames):')
+    bench('  per frame', lambda: [[
+        SessionDataMessage.encrypt(
+            cipher, session_id, SequenceNumber(offset // chunk_size),
+            data=message[offset:offset + chunk_size]
+        ).can_msg(2) for offset in range(0, len(message), chunk_size)
+    ] for _ in range(messages)], messages * frames)
+    bench('  encrypt_frames', lambda: [
+        SessionDataMessage.encrypt_frames(cipher, session_id, message, 2)
+        for _ in range(messages)], messages * frames)
+
+    print('Round trip:')
+    bench('  SessionStartMessage', lambda: [
+        SessionStartMessage.from_msg(SessionStartMessage.encrypt(
+            cipher, session_id, MessageLength(1000), ExtraData.empty()
+        ).can_msg(1)).decrypt(cipher) for _ in range(n)], n)
+    bench('  SessionDataMessage', lambda: [
+        SessionDataMessage.from_msg(SessionDataMessage.encrypt(
+            cipher, session_id, SequenceNumber(i % 256), data=chunk
+        ).can_msg(2)).decrypt(cipher) for i in range(n)], n)
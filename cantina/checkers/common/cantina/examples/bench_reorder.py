@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from cryptography.hazmat.primitives.ciphers.aead \
+    import ChaCha20Poly1305 as AEAD
+
+from cantina import Cipher
+from cantina.canopy import Client, Server
+
+
+MSG_IDS = {
+    'canopy_start': 1,
+    'canopy_data': 2,
+    'canopy_reply_start': 3,
+    'canopy_reply_data': 4
+}
+
+
+class EchoServer(Server):
+    async def build_reply(self, _, data: bytes) -> bytes:
+        return data
+
+
+class Link:
+    """
+    In-process bus from a send queue to receive handlers, holding
+    back a share of the frames behind up to a number of later ones.
+    Held frames are released once the queue runs dry.
+    """
+
+    def __init__(self, queue, handlers, rate: float, distance: int):
+        self.queue = queue
+        self.handlers = handlers
+        self.rate = rate
+        self.distance = distance
+        self.frames = 0
+        self.reordered = 0
+
+    async def _deliver(self, msg):
+        self.frames += 1
+        await self.handlers[msg.arbitration_id](msg)
+
+    async def run(self):
+        held = []
+        while True:
+            msg = await self.queue.get()
+            if random.random() < self.rate:
+                self.reordered += 1
+                held.append([random.randint(1, self.distance), msg])
+            else:
+                await self._deliver(msg)
+                for entry in held:
+                    entry[0] -= 1
+
+            while held and (self.queue.empty() or held[0][0] <= 0):
+                await self._deliver(held.pop(0)[1])
+
+
+async def main(args):
+    cipher = Cipher()
+    cipher.update(AEAD(AEAD.generate_key()))
+    client_queue = asyncio.Queue()
+    server_queue = asyncio.Queue()
+    client = Client(cipher, client_queue, MSG_IDS)
+    server = EchoServer(cipher, server_queue, MSG_IDS)
+    links = [
+        Link(client_queue, server.recv_handlers(), args.rate, args.distance),
+        Link(server_queue, client.recv_handlers(), args.rate, args.distance)
+    ]
+    tasks = [asyncio.create_task(link.run()) for link in links]
+    tasks.append(asyncio.create_task(server.update_loop()))
+
+    latencies = []
+    failures = 0
+    payload = bytes(args.size)
+
+    async def session():
+        nonlocal failures
+        start = time.perf_counter()
+        reply, _ = await client.send(payload)
+        if reply != payload:
+            failures += 1
+        else:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(args.sessions // args.concurrency):
+        await asyncio.gather(*[session() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+    for task in tasks:
+        task.cancel()
+
+    frames = sum(link.frames for link in links)
+    reordered = sum(link.reordered for link in links)
+    sessions = args.sessions // args.concurrency * args.concurrency
+    print(f'{sessions} sessions of {args.size} bytes in {elapsed:.2f} s, '
+          f'{reordered} of {frames} frames reordered')
+    print(f'Failed: {failures} ({100 * failures / sessions:.1f}%)')
+    if latencies:
+        latencies.sort()
+        print('Completion latency (ms): mean {:.2f}, p50 {:.2f}, '
+              'p99 {:.2f}, max {:.2f}'.format(
+                  statistics.mean(latencies) * 1e3,
+                  latencies[len(latencies) // 2] * 1e3,
+                  latencies[int(len(latencies) * 0.99)] * 1e3,
+                  latencies[-1] * 1e3
+              ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Canopy session benchmark under frame reordering')
+    parser.add_argument('-n', '--sessions', type=int, default=200,
+                        help='Number of sessions')
+    parser.add_argument('-c', '--concurrency', type=int, default=10,
+                        help='Concurrent sessions')
+    parser.add_argument('-s', '--size', type=int, default=1000,
+                        help='Message size in bytes')
+    parser.add_argument('-r', '--rate', type=float, default=0.05,
+                        help='Share of frames held back')
+    parser.add_argument('-d', '--distance', type=int, default=4,
+                        help='Maximum frames a frame is held back by')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import time
+
+import can
+import msgpack
+
+from cantina.tocan import ToCanClient, pack_can_message
+
+
+def frame(i: int) -> can.Message:
+    return can.Message(
+        arbitration_id=i % 0x800,
+        data=bytes(64),
+        is_fd=True,
+        is_extended_id=False
+    )
+
+
+async def bench_recv(args, client, writer):
+    # Server streams frames in bursts, client reads them off its queue
+    packed = [pack_can_message(frame(i)) for i in range(args.burst)]
+    start = time.perf_counter()
+    for _ in range(args.frames // args.burst):
+        writer.write(b''.join(packed))
+        await writer.drain()
+    for _ in range(args.frames // args.burst * args.burst):
+        await client.recv()
+    return time.perf_counter() - start
+
+
+async def bench_send(args, client, reader):
+    # Client queues frames, server unpacks them off the socket
+    messages = [frame(i) for i in range(args.burst)]
+    unpacker = msgpack.Unpacker()
+    received = 0
+    start = time.perf_counter()
+    for burst in range(1, args.frames // args.burst + 1):
+        for msg in messages:
+            await client.send(msg)
+        while received < burst * args.burst:
+            unpacker.feed(await reader.read(65536))
+            received += sum(1 for _ in unpacker)
+    return time.perf_counter() - start
+
+
+async def main(args):
+    accepted = asyncio.Queue()
+
+    async def on_connect(reader, writer):
+        await accepted.put((reader, writer))
+
+    server = await asyncio.start_server(on_connect, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    kwargs = {'sync': True} if args.sync else {}
+    client = ToCanClient('127.0.0.1', port, **kwargs)
+    connection = asyncio.create_task(client.connect())
+    reader, writer = await accepted.get()
+
+    frames = args.frames // args.burst * args.burst
+    mode = 'janus' if args.sync else 'default'
+    for name, bench in [
+        ('recv', lambda: bench_recv(args, client, writer)),
+        ('send', lambda: bench_send(args, client, reader))
+    ]:
+        elapsed = await bench()
+        print(f'{name} ({mode}) {frames / elapsed:>12,.0f} frames/s')
+
+    connection.cancel()
+    writer.close()
+    server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='ToCan loopback throughput benchmark')
+    parser.add_argument('-n', '--frames', type=int, default=200_000,
+                        help='Number of frames per direction')
+    parser.add_argument('-b', '--burst', type=int, default=100,
+                        help='Frames per burst')
+    parser.add_argument('--sync', action='store_true',
+                        help='Use the thread-safe (janus) queues')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))